@@ -5,9 +5,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pdb
 import random
+import os
 from scipy import sparse
-from pvtools import readpvpfile
 import TFSparseCode.dataObj.utils as utils
+from TFSparseCode.dataObj.pvp_reader import pvpReader
+from TFSparseCode.dataObj.sparse_store import sparseStoreReader
 
 """
 An object that handles data input
@@ -16,6 +18,9 @@ class dataObj(object):
     imgIdx = 0
     #inputShape = (32, 32, 3)
     maxDim = 0
+    #readImage is readRawImage followed by normalizeImages, so getData reads raw images into
+    #the batch and normalizes it all at once. Subclasses that override readImage set this to False
+    batchNormalize = True
 
     #Constructor takes a text file containing a list of absolute filenames
     #Will calculate the mean/std of image for normalization
@@ -26,12 +31,14 @@ class dataObj(object):
     #"max" will find the max dimension of the list of images, and pad the surrounding area
     #Additionally, if inMaxDim is set with resizeMethod of "max", it will explicitly set
     #the max dimension to inMaxDim
-    def __init__(self, imgList, resizeMethod="crop", shuffle=True, skip=1, seed=None, getGT=False, rangeIdx=None):
+    #If cacheFile is set, resized images are read from a uint8 memmap cache (see buildCache),
+    #which is built on the first run
+    def __init__(self, imgList, resizeMethod="crop", shuffle=True, skip=1, seed=None, getGT=False, rangeIdx=None, cacheFile=None):
         self.resizeMethod=resizeMethod
         self.imgFiles = utils.readList(imgList)
         self.numImages = len(self.imgFiles)
         if(rangeIdx == None):
-            self.shuffleIdx = range(self.numImages)
+            self.shuffleIdx = list(range(self.numImages))
         else:
             self.shuffleIdx=rangeIdx
         self.numData = len(self.shuffleIdx)
@@ -57,6 +64,52 @@ class dataObj(object):
         else:
             print("Method ", resizeMethod, "not supported")
             assert(0)
+        self.cache = None
+        if(cacheFile is not None):
+            self.loadCache(cacheFile)
+        #Preallocated float32 output batches
+        self.batchBufs = utils.batchBuffers()
+
+    #Decodes and resizes every image once, and writes them into one uint8 memmap at cacheFile
+    #Per image mean/std of the /255 image used for normalization and the file list used as the
+    #index are written to cacheFile + ".idx.npz"
+    def buildCache(self, cacheFile):
+        print("Building image cache", cacheFile)
+        (ny, nx, nf) = self.inputShape
+        cache = np.lib.format.open_memmap(cacheFile, mode='w+', dtype=np.uint8, shape=(self.numImages, ny, nx, nf))
+        mean = np.zeros((self.numImages), dtype=np.float32)
+        std = np.zeros((self.numImages), dtype=np.float32)
+        for i, imgFile in enumerate(self.imgFiles):
+            image = self.resizeImage(imread(imgFile))
+            cache[i] = image
+            image = image.astype(np.float32)/255
+            mean[i] = np.mean(image)
+            std[i] = np.std(image)
+            if(i%1000 == 0):
+                print("Cached", i, "out of", self.numImages)
+        cache.flush()
+        del cache
+        np.savez(cacheFile + ".idx.npz", files=np.array(self.imgFiles), mean=mean, std=std,
+                inputShape=np.array(self.inputShape), resizeMethod=self.resizeMethod)
+
+    #Opens cacheFile as a read only memmap, building it first if it doesn't exist or doesn't match
+    #this object's file list, inputShape or resizeMethod
+    def loadCache(self, cacheFile):
+        idxFile = cacheFile + ".idx.npz"
+        valid = False
+        if(os.path.exists(cacheFile) and os.path.exists(idxFile)):
+            idx = np.load(idxFile)
+            valid = (list(idx["files"]) == list(self.imgFiles) and
+                    tuple(idx["inputShape"]) == tuple(self.inputShape) and
+                    str(idx["resizeMethod"]) == self.resizeMethod)
+            if(not valid):
+                print("Image cache", cacheFile, "does not match image list, rebuilding")
+        if(not valid):
+            self.buildCache(cacheFile)
+            idx = np.load(idxFile)
+        self.cacheMean = idx["mean"]
+        self.cacheStd = idx["std"]
+        self.cache = np.load(cacheFile, mmap_mode='r')
 
     ##Explicitly sets the mean and standard deviation for normalization
     #def setMeanVar(self, inMean, inStd):
@@ -104,14 +157,14 @@ class dataObj(object):
                 scale = float(self.inputShape[1])/nx
                 targetNy = int(round(ny * scale))
                 scaleImage = imresize(inImage, (targetNy, self.inputShape[1]))
-                cropTop = (targetNy-self.inputShape[0])/2
+                cropTop = (targetNy-self.inputShape[0])//2
                 outImage = scaleImage[cropTop:cropTop+self.inputShape[0], :, :]
             elif(ny <= nx):
                 #Get percentage of scale
                 scale = float(self.inputShape[0])/ny
                 targetNx = int(round(nx * scale))
                 scaleImage = imresize(inImage, (self.inputShape[0], targetNx))
-                cropLeft = (targetNx-self.inputShape[1])/2
+                cropLeft = (targetNx-self.inputShape[1])//2
                 outImage = scaleImage[:, cropLeft:cropLeft+self.inputShape[1], :]
         elif(self.resizeMethod == "pad"):
             if(ny > nx):
@@ -119,7 +172,7 @@ class dataObj(object):
                 scale = float(self.inputShape[0])/ny
                 targetNx = int(round(nx * scale))
                 scaleImage = imresize(inImage, (self.inputShape[0], targetNx))
-                padLeft = (self.inputShape[1]-targetNx)/2
+                padLeft = (self.inputShape[1]-targetNx)//2
                 padRight = self.inputShape[1] - (padLeft + targetNx)
                 outImage = np.pad(scaleImage, ((0, 0), (padLeft, padRight), (0, 0)), 'constant')
             elif(ny <= nx):
@@ -127,16 +180,16 @@ class dataObj(object):
                 scale = float(self.inputShape[1])/nx
                 targetNy = int(round(ny * scale))
                 scaleImage = imresize(inImage, (targetNy, self.inputShape[1]))
-                padTop = (self.inputShape[0]-targetNy)/2
+                padTop = (self.inputShape[0]-targetNy)//2
                 padBot = self.inputShape[0] - (padTop + targetNy)
                 outImage = np.pad(scaleImage, ((padTop, padBot), (0, 0), (0, 0)), 'constant')
         elif(self.resizeMethod=="max"):
             #We pad entire image with 0
             assert(ny <= self.inputShape[0])
             assert(nx <= self.inputShape[1])
-            padTop   = (self.inputShape[0]-ny)/2
+            padTop   = (self.inputShape[0]-ny)//2
             padBot   = self.inputShape[0]-(padTop+ny)
-            padLeft  = (self.inputShape[1]-nx)/2
+            padLeft  = (self.inputShape[1]-nx)//2
             padRight = self.inputShape[1]-(padLeft+nx)
             outImage = np.pad(inImage, ((padTop, padBot), (padLeft, padRight), (0, 0)), 'constant')
         else:
@@ -147,24 +200,39 @@ class dataObj(object):
     #Reads image provided in the argument, resizes, and normalizes image
     #Returns the image
     def readImage(self, filename, frameIdx):
+        image = self.readRawImage(filename, frameIdx)
+        return self.normalizeImages(image)
+
+    #Reads and resizes image provided in the argument, scaled to [0, 1] but not normalized
+    def readRawImage(self, filename, frameIdx):
+        if(self.cache is not None):
+            return self.cache[frameIdx].astype(np.float32)/255
         image = imread(filename)
         image = (self.resizeImage(image).astype(np.float32)/255)
-        image = (image-np.mean(image))/np.std(image)
         #gt = np.zeros((10))
         #s = filename.split('/')[-2]
         #gt[int(s)] = 1
         return image
 
+    #Normalizes each [ny, nx, nf] image in data to zero mean and unit std, in place
+    #data can have any number of leading (batch, frame) dimensions
+    def normalizeImages(self, data):
+        mean = data.mean(axis=(-3, -2, -1), keepdims=True)
+        std = data.std(axis=(-3, -2, -1), keepdims=True)
+        data -= mean
+        data /= std
+        return data
+
     #Grabs the next image in the list. Will shuffle images when rewinding
     #Num frames define how many in the clip it will grab
     def nextImage(self, numFrames = 1):
         assert(numFrames >= 1)
-        startIdx = self.shuffleIdx[self.imgIdx]
+        startIdx = self.nextIdx()
         if(numFrames == 1):
             imgFile = self.imgFiles[startIdx]
             outImg = self.readImage(imgFile, startIdx)
         else:
-            outImg = np.zeros((numFrames, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+            outImg = np.zeros((numFrames, self.inputShape[0], self.inputShape[1], self.inputShape[2]), dtype=np.float32)
             for f in range(numFrames):
                 imgFile = self.imgFiles[startIdx+f]
                 outImg[f, :, :, :] = self.readImage(imgFile, startIdx+f)
@@ -173,6 +241,15 @@ class dataObj(object):
             outGt = np.zeros((self.numClasses))
             outGt[self.calcGT(startIdx)] = 1
 
+        if(self.getGT):
+            return (outImg, outGt)
+        else:
+            return outImg
+
+    #Returns the file index of the next image and updates imgIdx
+    #Will shuffle images when rewinding
+    def nextIdx(self):
+        startIdx = self.shuffleIdx[self.imgIdx]
         #Update imgIdx
         self.imgIdx = self.imgIdx + self.skip
 
@@ -181,11 +258,17 @@ class dataObj(object):
             self.imgIdx = 0
             if(self.doShuffle):
                 random.shuffle(self.shuffleIdx)
+        return startIdx
 
-        if(self.getGT):
-            return (outImg, outGt)
-        else:
-            return outImg
+    #Advances the image index as if numExample images were read, without reading them
+    #Shuffles on rewind like nextImage. Used by mpWrapper so workers read disjoint batches in order
+    def skipData(self, numExample):
+        for i in range(numExample):
+            self.imgIdx = self.imgIdx + self.skip
+            if(self.imgIdx >= self.numData):
+                self.imgIdx = 0
+                if(self.doShuffle):
+                    random.shuffle(self.shuffleIdx)
 
     ##Get all segments of current image. This is what evaluation calls for testing
     #def allImages(self):
@@ -201,14 +284,30 @@ class dataObj(object):
     #This is what TF object calls to get images for training
     def getData(self, numExample, numFrames=1):
         assert(numFrames >= 1)
+        if(self.cache is not None and numFrames == 1):
+            return self.getCachedData(numExample)
         if(numFrames == 1):
-            outData = np.zeros((numExample, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+            outData = self.batchBufs.get("data", (numExample, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
         else:
-            outData = np.zeros((numExample, numFrames, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+            outData = self.batchBufs.get("data", (numExample, numFrames, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
         if(self.getGT):
-            outGt = np.zeros((numExample, self.numClasses))
+            outGt = self.batchBufs.get("gt", (numExample, self.numClasses))
+            outGt.fill(0)
 
         for i in range(numExample):
+            if(self.batchNormalize):
+                #Read raw images straight into the batch, normalized below
+                startIdx = self.nextIdx()
+                for f in range(numFrames):
+                    data = self.readRawImage(self.imgFiles[startIdx+f], startIdx+f)
+                    if(numFrames == 1):
+                        outData[i, :, :, :] = data
+                    else:
+                        outData[i, f, :, :, :] = data
+                if(self.getGT):
+                    outGt[i, self.calcGT(startIdx)] = 1
+                continue
+
             if(self.getGT):
                 (data, gt) = self.nextImage(numFrames)
                 outGt[i, :] = gt
@@ -219,7 +318,27 @@ class dataObj(object):
                 outData[i, :, :, :] = data
             else:
                 outData[i, :, :, :, :] = data
+        if(self.batchNormalize):
+            self.normalizeImages(outData)
+        if(self.getGT):
+            return (outData, outGt)
+        else:
+            return outData
+
+    #Same as getData, but reads the whole batch from the image cache with one fancy index
+    def getCachedData(self, numExample):
+        idxs = np.array([self.nextIdx() for i in range(numExample)])
+        #Memmap fancy indexing is fastest with sorted indices
+        order = np.argsort(idxs)
+        outData = self.batchBufs.get("data", (numExample, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+        outData[order] = self.cache[idxs[order]]
+        outData /= 255
+        outData -= self.cacheMean[idxs][:, None, None, None]
+        outData /= self.cacheStd[idxs][:, None, None, None]
         if(self.getGT):
+            outGt = self.batchBufs.get("gt", (numExample, self.numClasses))
+            outGt.fill(0)
+            outGt[np.arange(numExample), [self.calcGT(i) for i in idxs]] = 1
             return (outData, outGt)
         else:
             return outData
@@ -228,8 +347,8 @@ class cifarObj(dataObj):
     inputShape = (32, 32, 3)
     numClasses = 10
 
-    def __init__(self, imgList, resizeMethod="crop", shuffle=True, skip=1, seed=None, getGT=False, rangeIdx=None):
-        super(cifarObj, self).__init__(imgList, resizeMethod, shuffle, skip, seed, getGT, rangeIdx)
+    def __init__(self, imgList, resizeMethod="crop", shuffle=True, skip=1, seed=None, getGT=False, rangeIdx=None, cacheFile=None):
+        super(cifarObj, self).__init__(imgList, resizeMethod, shuffle, skip, seed, getGT, rangeIdx, cacheFile)
         self.gtIdx = [int(fn.split('/')[-2]) for fn in self.imgFiles]
 
     def calcGT(self, targetIdx):
@@ -240,21 +359,33 @@ class imageNetObj(dataObj):
     #inputShape = (64, 128, 3)
     inputShape = (64, 64, 3)
     numClasses = 1000
-    def __init__(self, imgList, resizeMethod="crop", shuffle=True, skip=1, seed=None, getGT=False, rangeIdx=None):
+    def __init__(self, imgList, resizeMethod="crop", shuffle=True, skip=1, seed=None, getGT=False, rangeIdx=None, cacheFile=None):
         assert(getGT==False)
-        super(imagenetObj, self).__init__(imgList, resizeMethod, shuffle, skip, seed, getGT, rangeIdx)
+        super(imageNetObj, self).__init__(imgList, resizeMethod, shuffle, skip, seed, getGT, rangeIdx, cacheFile)
 
 
 #TODO this object is specific for cifar right now. Do multiple inheritence for this obj in the future
 class tfObj(dataObj):
     numClasses = 10
+    batchNormalize = False
+    #imgList is either a list of npz files (one per example, see save_sparse_csr)
+    #or a sparse store directory (see dataObj/sparse_store.py), read with image id as the example index
     def __init__(self, imgList, gtList, inputShape, resizeMethod="crop", shuffle=True, skip=1, seed=None, getGT=True, rangeIdx=None):
         self.inputShape = inputShape
-        gtFnList = readList(gtList)
-        self.gtIdx = [int(fn.split('/')[-2]) for fn in gtFnList]
-        #Call superclass constructor
-        super(tfObj, self).__init__(imgList, resizeMethod, shuffle, skip, seed, getGT, rangeIdx)
-        assert(len(self.gtIdx) ==  self.numImages)
+        if(os.path.isdir(imgList)):
+            self.store = sparseStoreReader(imgList)
+            assert(self.store.rowSize == np.prod(self.inputShape))
+            #Call superclass constructor with the gt list, as in pvpObj
+            super(tfObj, self).__init__(gtList, resizeMethod, shuffle, skip, seed, getGT, rangeIdx)
+            self.gtIdx = [int(fn.split('/')[-2]) for fn in self.imgFiles]
+            assert(self.store.numRows == self.numImages)
+        else:
+            self.store = None
+            gtFnList = utils.readList(gtList)
+            self.gtIdx = [int(fn.split('/')[-2]) for fn in gtFnList]
+            #Call superclass constructor
+            super(tfObj, self).__init__(imgList, resizeMethod, shuffle, skip, seed, getGT, rangeIdx)
+            assert(len(self.gtIdx) ==  self.numImages)
 
     def load_sparse_csr(self, filename):
         loader = np.load(filename)
@@ -262,8 +393,11 @@ class tfObj(dataObj):
                              shape = loader['shape'])
 
     def readImage(self, filename, frameIdx):
-        data = self.load_sparse_csr(filename)
-        outData = np.array(data.todense()).reshape((1, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+        if(self.store is not None):
+            outData = self.store.readDense(self.store.rows([frameIdx]))
+        else:
+            outData = np.array(self.load_sparse_csr(filename).todense())
+        outData = outData.reshape((1, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
         return outData
 
     def calcGT(self, targetIdx):
@@ -275,26 +409,40 @@ class tfObj(dataObj):
 
     #Gets numExample images and stores it into an outer dimension.
     #This is what TF object calls to get images for training
+    #With a sparse store, the whole batch is decoded from the memory mapped shards at once
     def getData(self, numExample, numFrames=1):
         assert(numFrames == 1)
-        return super(tfObj, self).getData(numExample, numFrames)
+        if(self.store is None):
+            return super(tfObj, self).getData(numExample, numFrames)
+        idxs = [self.nextIdx() for i in range(numExample)]
+        outData = self.batchBufs.get("data", (numExample, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+        self.store.readDense(self.store.rows(idxs), outData)
+        if(self.getGT):
+            outGt = self.batchBufs.get("gt", (numExample, self.numClasses))
+            outGt.fill(0)
+            outGt[np.arange(numExample), [self.calcGT(i) for i in idxs]] = 1
+            return (outData, outGt)
+        else:
+            return outData
 
 class pvpObj(dataObj):
     numClasses = 10
+    batchNormalize = False
     #imgList here is the pvp file
     def __init__(self, imgList, gtList, inputShape, resizeMethod="crop", shuffle=True, skip=1, seed=None, getGT=True, rangeIdx=None):
         self.inputShape = inputShape
         #Read gt file
-        #Read pvp file
-        self.inData = readpvpfile(imgList, progressPeriod = 100)["values"]
-        [numFrames, numVals] = self.inData.shape
+        #Memory map pvp file, frames are only decoded when read
+        self.reader = pvpReader(imgList)
+        numFrames = self.reader.numFrames
+        assert(self.reader.frameSize == np.prod(self.inputShape))
         #Call superclass constructor
         super(pvpObj, self).__init__(gtList, resizeMethod, shuffle, skip, seed, getGT, rangeIdx)
         self.gtIdx = [int(fn.split('/')[-2]) for fn in self.imgFiles]
         assert(len(self.gtIdx) ==  numFrames)
 
     def readImage(self, filename, frameIdx):
-        outData = self.inData.getrow(frameIdx).toarray()
+        outData = self.reader.readDense([frameIdx])
         outData = np.reshape(outData, self.inputShape)
         return outData
 
@@ -307,9 +455,30 @@ class pvpObj(dataObj):
 
     #Gets numExample images and stores it into an outer dimension.
     #This is what TF object calls to get images for training
+    #Decodes the whole batch from the pvp file at once into a preallocated buffer
     def getData(self, numExample, numFrames=1):
         assert(numFrames == 1)
-        return super(pvpObj, self).getData(numExample, numFrames)
+        idxs = [self.nextIdx() for i in range(numExample)]
+        outData = self.batchBufs.get("data", (numExample, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+        self.reader.readDense(idxs, outData)
+        if(self.getGT):
+            outGt = self.batchBufs.get("gt", (numExample, self.numClasses))
+            outGt.fill(0)
+            outGt[np.arange(numExample), [self.calcGT(i) for i in idxs]] = 1
+            return (outData, outGt)
+        else:
+            return outData
+
+    #Same as getData, but returns the batch as a [numExample, ny*nx*nf] csr matrix
+    def getSparseData(self, numExample):
+        idxs = [self.nextIdx() for i in range(numExample)]
+        outData = self.reader.readSparse(idxs)
+        if(self.getGT):
+            outGt = np.zeros((numExample, self.numClasses), dtype=np.float32)
+            outGt[np.arange(numExample), [self.calcGT(i) for i in idxs]] = 1
+            return (outData, outGt)
+        else:
+            return outData
 
 if __name__ == '__main__':
     filelist = "/home/slundquist/mountData/tfLCA/cifar_eval/train_tmp.txt"
@@ -0,0 +1,135 @@
+import multiprocessing as mp
+import numpy as np
+import random
+import traceback
+
+#Process based version of mtWrapper. Same factory interface, but batches are loaded by
+#numWorkers processes (so imread/imresize and obspy slicing are not held up by the GIL)
+#and handed back through shared memory instead of being pickled through a pipe.
+
+#Each worker owns queueDepth slots of a shared memory ring buffer, and batches are
+#returned round robin over workers, so sequential objects (e.g. dataObj with shuffle=False)
+#still return batches in the same order as the unwrapped object.
+#If cls has a "skipData(self, batchSize)" method, workers use it to skip the batches
+#loaded by the other workers. Otherwise each worker is reseeded so random sampling
+#objects don't load the same examples.
+
+#Workers are forked from the object after its constructor runs, so the object must be
+#created before the tensorflow session.
+
+#cls is the object reference, input_batchSize is the batchSize that will be
+#called from getData, *args is the list of arguments for the constructor of cls
+def mpWrapper(cls, input_batchSize, numWorkers=4, queueDepth=2):
+    #Note, cls must have a "getData(self, batchSize)" method that returns
+    #a numpy array or a tuple of numpy arrays of the same shapes every call
+
+    #Inherite from input class, we overload getData
+    class mpDataObj(cls):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._input_batchSize = input_batchSize
+            self._numWorkers = numWorkers
+            self._queueDepth = queueDepth
+
+            #Load first batch here to get the shapes of the shared buffers
+            firstBuf = super().getData(self._input_batchSize)
+            self._isTuple = isinstance(firstBuf, tuple)
+            if(not self._isTuple):
+                firstBuf = (firstBuf,)
+            self._bufSpec = [(b.shape, b.dtype) for b in firstBuf]
+            self._firstBuf = firstBuf
+            self._nextWorker = 0
+
+            #Allocate ring buffer, one raw block per slot with each output 8 byte aligned
+            self._offsets = []
+            slotBytes = 0
+            for (shape, dtype) in self._bufSpec:
+                self._offsets.append(slotBytes)
+                slotBytes += int(np.prod(shape))*np.dtype(dtype).itemsize
+                slotBytes += (-slotBytes) % 8
+            numSlots = self._numWorkers * self._queueDepth
+            self._slots = [mp.RawArray('b', max(slotBytes, 1)) for s in range(numSlots)]
+
+            ctx = mp.get_context('fork')
+            self._freeQs = [ctx.Queue() for w in range(self._numWorkers)]
+            self._readyQs = [ctx.Queue() for w in range(self._numWorkers)]
+            for w in range(self._numWorkers):
+                for s in range(self._queueDepth):
+                    self._freeQs[w].put(w*self._queueDepth + s)
+
+            baseSeed = random.randint(0, 2**31)
+            self._workers = []
+            for w in range(self._numWorkers):
+                p = ctx.Process(target=self.__worker__, args=(w, baseSeed))
+                p.daemon = True
+                p.start()
+                self._workers.append(p)
+
+        #Numpy views into a shared slot
+        def __slotViews__(self, slot):
+            buf = np.frombuffer(self._slots[slot], dtype=np.uint8)
+            views = []
+            for ((shape, dtype), offset) in zip(self._bufSpec, self._offsets):
+                nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+                views.append(buf[offset:offset+nbytes].view(dtype).reshape(shape))
+            return views
+
+        def __skip__(self, numBatches):
+            if(hasattr(self, "skipData")):
+                for i in range(numBatches):
+                    self.skipData(self._input_batchSize)
+
+        #Worker w loads batches 1 + w + k*numWorkers (batch 0 was loaded in the constructor)
+        def __worker__(self, w, baseSeed):
+            if(not hasattr(self, "skipData")):
+                random.seed(baseSeed + w)
+                np.random.seed((baseSeed + w) % (2**32))
+            try:
+                self.__skip__(w)
+                while True:
+                    slot = self._freeQs[w].get()
+                    if(slot is None):
+                        return
+                    outBuf = super(mpDataObj, self).getData(self._input_batchSize)
+                    if(not self._isTuple):
+                        outBuf = (outBuf,)
+                    for (view, b) in zip(self.__slotViews__(slot), outBuf):
+                        view[...] = b
+                    self._readyQs[w].put(slot)
+                    self.__skip__(self._numWorkers-1)
+            except Exception:
+                traceback.print_exc()
+                self._readyQs[w].put(-1)
+
+        #This function doesn't actually need numExample , but this api matches that of
+        #cls. So all we do here is assert numExample is the same
+        def getData(self, numExample):
+            assert(numExample == self._input_batchSize)
+            if(self._firstBuf is not None):
+                returnBuf = self._firstBuf
+                self._firstBuf = None
+            else:
+                w = self._nextWorker
+                slot = self._readyQs[w].get()
+                if(slot < 0):
+                    print("Error: mpWrapper worker", w, "failed")
+                    assert(0)
+                #Copy out of the shared slot so it can be refilled
+                returnBuf = tuple([np.copy(v) for v in self.__slotViews__(slot)])
+                self._freeQs[w].put(slot)
+                self._nextWorker = (w + 1) % self._numWorkers
+            if(self._isTuple):
+                return returnBuf
+            else:
+                return returnBuf[0]
+
+        #Stops worker processes
+        def closeWorkers(self):
+            for q in self._freeQs:
+                q.put(None)
+            for p in self._workers:
+                p.join(timeout=1)
+                if(p.is_alive()):
+                    p.terminate()
+
+    return mpDataObj
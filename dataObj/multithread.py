@@ -35,7 +35,7 @@ def mtWrapper(cls, input_batchSize):
             #Block loadThread here
             self.loadThread.join()
             #Store loaded data into local variable
-            #This should copy, not access reference
+            #This is a view, the parent's batchBuffers don't reuse a buffer while it's held
             returnBuf = self.loadBuf[:]
             #Launch new thread to load new buffer
             self.loadThread = threading.Thread(target=self.__loadData__, args=(self._input_batchSize,))
@@ -6,9 +6,66 @@ import TFSparseCode.dataObj.utils as utils
 import datetime
 from matplotlib.dates import datestr2num
 import csv
+import os
+import pickle
+import hashlib
+import multiprocessing as mp
+
+#Reads one file into a Stream. If cacheDir is set, the parsed stream is pickled into cacheDir,
+#keyed by absolute path and mtime, and read back from there while the file is unchanged
+#Module level so it can run in a process pool
+def read_stream_file(args):
+    (fn, cacheDir) = args
+    if(cacheDir is None):
+        return ob.read(fn)
+    key = (os.path.abspath(fn), os.path.getmtime(fn))
+    cacheFn = os.path.join(cacheDir, hashlib.md5(repr(key).encode()).hexdigest() + ".pkl")
+    if(os.path.exists(cacheFn)):
+        with open(cacheFn, 'rb') as f:
+            (cacheKey, st) = pickle.load(f)
+        if(cacheKey == key):
+            return st
+    st = ob.read(fn)
+    #Write to a temp file first so an interrupted run doesn't leave a partial cache file
+    tmpFn = cacheFn + "." + str(os.getpid()) + ".tmp"
+    with open(tmpFn, 'wb') as f:
+        pickle.dump((key, st), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpFn, cacheFn)
+    return st
+
+#Merges intervals [starts, ends) into sorted disjoint intervals
+def merge_intervals(starts, ends):
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
+    if(len(starts) == 0):
+        return (starts, ends)
+    #An interval starts a new merged block if it begins after every previous interval ended
+    prevEnd = np.maximum.accumulate(ends)
+    newBlock = np.concatenate(([True], starts[1:] > prevEnd[:-1]))
+    mergedStart = starts[newBlock]
+    mergedEnd = prevEnd[np.concatenate((np.nonzero(newBlock)[0][1:]-1, [len(ends)-1]))]
+    return (mergedStart, mergedEnd)
+
+#Samples uniformly over disjoint intervals given their starts and cumulative lengths
+#Binary search, so O(log n) per sample
+def sample_intervals(starts, cumLen):
+    u = random.uniform(0, cumLen[-1])
+    i = np.searchsorted(cumLen, u, side='right')
+    i = min(i, len(cumLen)-1)
+    prevLen = cumLen[i-1] if i > 0 else 0
+    return starts[i] + (u - prevLen)
 
 class obspySeismicData(object):
-    def __init__(self, filename, example_size, target_rate=40, seed=None, time_range=None, event_csv=None, get_type=None, event_window = 7200):
+    #If gridCacheFile is set, the stream is converted once into dense [numSamples, num_channels] arrays
+    #on the target_rate grid (see buildGrid), memory mapped from disk, and examples are sliced from those
+    #If min_valid_fraction > 0, windows are only drawn where at least min_valid_fraction of the samples
+    #(over all channels) are covered by traces, sampled from cells of coverage_step seconds (defaults to
+    #time_window/16). See buildCoverage. Otherwise windows are drawn as before, with no coverage index
+    #Files are read by num_read_workers processes (defaults to the cpu count, 1 reads in this process),
+    #and parsed files are cached in stream_cache_dir if set (see read_stream_file)
+    def __init__(self, filename, example_size, target_rate=40, seed=None, time_range=None, event_csv=None, get_type=None, event_window = 7200, gridCacheFile=None,
+            min_valid_fraction=0, coverage_step=None, num_read_workers=None, stream_cache_dir=None):
         if seed is not None:
             random.seed(seed)
         self.get_type = get_type
@@ -17,27 +74,45 @@ class obspySeismicData(object):
         assert(self.example_size > 0)
         self.target_rate = target_rate
         self.time_range = time_range
-        (self.stream, self.trace_dict, self.start_time, self.end_time) = self.loadStream(filename)
+        self.gridCacheFile = gridCacheFile
+        self.gridData = None
+        self.min_valid_fraction = min_valid_fraction
+        self.num_read_workers = num_read_workers
+        self.stream_cache_dir = stream_cache_dir
+        if(self.stream_cache_dir is not None and not os.path.exists(self.stream_cache_dir)):
+            os.makedirs(self.stream_cache_dir)
+        if(self.gridCacheFile is None or not self.loadGrid(filename)):
+            (self.stream, self.trace_dict, self.start_time, self.end_time) = self.loadStream(filename)
+            self.buildCoverageIntervals()
+            if(self.gridCacheFile is not None):
+                self.buildGrid(filename)
+                self.loadGrid(filename)
         print(self.trace_dict)
         self.num_channels = len(self.trace_dict.keys())
         self.time_window = self.example_size / self.target_rate
         self.delta_time = self.end_time - self.start_time
         self.inputShape = [1, self.example_size, self.num_channels]
+        if(coverage_step is None):
+            coverage_step = self.time_window/16
+        self.coverage_step = max(coverage_step, 1.0/self.target_rate)
+        #Preallocated float32 output batches
+        self.batchBufs = utils.batchBuffers()
 
         if(event_csv is not None):
-            with open(event_csv, 'r') as file:
-                csv_txt = file.readlines()
-            self.event_times = [v.split(',')[0] for v in csv_txt]
-            #Remove first entry
-            self.event_times.pop(0)
-            self.event_times = [ob.UTCDateTime(v) for v in self.event_times]
-            #Only select times in time range
-            self.event_times = [v for v in self.event_times if v >= self.start_time
-                    and v <= self.end_time]
+            self.loadEvents(event_csv)
             print("Number of events:", len(self.event_times))
             if(len(self.event_times) == 0):
                 print("Error: no events between ", self.start_time, "and", self.end_time)
                 pdb.set_trace()
+            if(self.get_type == 'no_event'):
+                self.buildNoEventIntervals()
+        elif(self.get_type is not None):
+            print("Error: get_type", self.get_type, "needs an event_csv")
+            assert(0)
+
+        self.cell_cumLen = None
+        if(self.min_valid_fraction > 0 and self.coverage_intervals is not None):
+            self.buildCoverage()
 
 
 
@@ -45,11 +120,17 @@ class obspySeismicData(object):
         fns = utils.readList(filename)
         st = ob.Stream()
         print("Reading files")
-        #Read into stream
-        for i in range(len(fns)):
-            current_st = ob.read(fns[i])
+        #Read into stream in parallel, in file order
+        #Daemonic processes (e.g. mpWrapper or data parallel workers) can't start a pool, so they read serially
+        args = [(fn, self.stream_cache_dir) for fn in fns]
+        serial = self.num_read_workers == 1 or mp.current_process().daemon
+        pool = None if serial else mp.Pool(self.num_read_workers)
+        for (i, current_st) in enumerate(map(read_stream_file, args) if serial else pool.imap(read_stream_file, args)):
             print(fns[i], np.round(100*i/len(fns)), "%", end='\r', flush=True)
             st += current_st
+        if(pool is not None):
+            pool.close()
+            pool.join()
 
         if self.time_range is not None:
             start_time = ob.UTCDateTime(self.time_range[0])
@@ -115,37 +196,224 @@ class obspySeismicData(object):
 
         return(new_st, trace_dict, start_time, end_time)
 
-    def getExample(self):
-        outData = np.zeros([self.example_size, self.num_channels])
+    #Reads event times from the first column of event_csv (with a header line) as a sorted float
+    #array of seconds from self.start_time, only keeping events in the time range
+    def loadEvents(self, event_csv):
+        times = np.loadtxt(event_csv, dtype=str, delimiter=',', skiprows=1, usecols=(0,), ndmin=1)
+        timestamps = utils.parse_utc_times(times)
+        event_times = np.sort(timestamps - self.start_time.timestamp)
+        self.event_times = event_times[np.logical_and(event_times >= 0, event_times <= self.delta_time)]
+
+    #Window start offsets that don't overlap any event window, as sorted disjoint intervals
+    #A window [s, s+time_window] overlaps the event at e when e-h-time_window < s < e+h,
+    #so the complement of the union of those intervals in [0, delta_time-time_window] is precomputed
+    #with cumulative lengths for sampling uniformly with a binary search
+    def buildNoEventIntervals(self):
+        half_event_window = self.event_window/2
+        maxStart = self.delta_time - self.time_window
+        blockStart = self.event_times - half_event_window - self.time_window
+        blockEnd = self.event_times + half_event_window
+        (mergedStart, mergedEnd) = merge_intervals(blockStart, blockEnd)
+        #Complement in [0, maxStart]
+        freeStart = np.clip(np.concatenate(([0], mergedEnd)), 0, maxStart)
+        freeEnd = np.clip(np.concatenate((mergedStart, [maxStart])), 0, maxStart)
+        keep = freeEnd > freeStart
+        self.free_start = freeStart[keep]
+        self.free_end = freeEnd[keep]
+        self.free_cumLen = np.cumsum(freeEnd[keep] - freeStart[keep])
+        if(len(self.free_cumLen) == 0):
+            print("Error: every window between", self.start_time, "and", self.end_time, "overlaps an event")
+            assert(0)
+
+    #Samples a window start offset uniformly over windows that don't overlap an event
+    def sampleNoEventOffset(self):
+        return sample_intervals(self.free_start, self.free_cumLen)
+
+    #Stores the time each channel is covered by a trace as [n, 3] (channel, start, end) in seconds
+    #from start_time, from the trace_stats collected in loadStream
+    def buildCoverageIntervals(self):
+        intervals = []
+        for (id_val, stats) in self.trace_stats.items():
+            for (trace_st, trace_et, trace_max) in stats:
+                #Last sample covers up to one sample period past endtime
+                intervals.append((self.trace_dict[id_val], trace_st - self.start_time, trace_et - self.start_time + 1.0/self.target_rate))
+        self.coverage_intervals = np.array(intervals, dtype=np.float64).reshape((-1, 3))
+
+    #Precomputes which window starts meet min_valid_fraction
+    #Window starts in [0, delta_time-time_window] are split into cells of coverage_step seconds,
+    #and a cell is kept if the covered fraction of every window starting in it is at least
+    #min_valid_fraction (and nonzero). For no_event, cells must also be inside an event free interval
+    #The covered fraction is piecewise linear in the window start, with breaks where a window edge
+    #crosses a trace edge, so it is checked at the cell ends and at every break inside a cell
+    #Kept cells are stored with cumulative lengths (cell_cumLen) for O(log n) sampling
+    def buildCoverage(self):
+        maxStart = self.delta_time - self.time_window
+        #Merge each channel's traces so overlaps aren't counted twice
+        pts = []
+        slopes = []
+        for c in range(self.num_channels):
+            sel = self.coverage_intervals[:, 0] == c
+            (mergedStart, mergedEnd) = merge_intervals(self.coverage_intervals[sel, 1], self.coverage_intervals[sel, 2])
+            pts += [mergedStart, mergedEnd]
+            slopes += [np.ones(len(mergedStart)), -np.ones(len(mergedEnd))]
+        pts = np.concatenate(pts)
+        order = np.argsort(pts, kind='stable')
+        pts = pts[order]
+        #Number of covered channels after each point
+        slopes = np.cumsum(np.concatenate(slopes)[order])
+        #Covered channel seconds before each point, piecewise linear in between
+        covered = np.concatenate(([0], np.cumsum(slopes[:-1]*np.diff(pts))))
+        if(len(pts) == 0):
+            (pts, covered) = (np.array([0.0]), np.array([0.0]))
+
+        cellEdges = np.minimum(np.arange(int(np.floor(maxStart/self.coverage_step)) + 2)*self.coverage_step, maxStart)
+        windowCovered = np.interp(cellEdges + self.time_window, pts, covered) - np.interp(cellEdges, pts, covered)
+        frac = windowCovered / (self.num_channels*self.time_window)
+        good = np.logical_and(frac >= self.min_valid_fraction, frac > 0)
+        cellValid = np.logical_and(good[:-1], good[1:])
+        #Breaks inside cells, where a window starts or ends at a trace edge
+        breaks = np.concatenate((pts, pts - self.time_window))
+        breaks = breaks[np.logical_and(breaks > 0, breaks < maxStart)]
+        breakCovered = np.interp(breaks + self.time_window, pts, covered) - np.interp(breaks, pts, covered)
+        breakFrac = breakCovered / (self.num_channels*self.time_window)
+        badBreak = np.logical_or(breakFrac < self.min_valid_fraction, breakFrac <= 0)
+        badCell = np.minimum((breaks[badBreak]/self.coverage_step).astype(np.int64), len(cellValid)-1)
+        cellValid[badCell] = False
+        (self.cell_start, cellEnd) = (cellEdges[:-1], cellEdges[1:])
+        if(self.get_type == 'no_event'):
+            i = np.searchsorted(self.free_start, self.cell_start, side='right') - 1
+            inFree = np.logical_and(i >= 0, cellEnd <= self.free_end[np.maximum(i, 0)])
+            cellValid = np.logical_and(cellValid, inFree)
+        #Cumulative valid length, with a leading 0 so ranges of cells can be counted
+        self.cell_cumLen = np.concatenate(([0], np.cumsum((cellEnd - self.cell_start)*cellValid)))
+        print("Fraction of windows meeting coverage:", self.cell_cumLen[-1]/max(maxStart, 1e-12))
+        if(self.cell_cumLen[-1] <= 0):
+            print("Error: no windows with at least", self.min_valid_fraction, "valid samples")
+            assert(0)
+        if(self.get_type == 'event'):
+            #Cells fully inside each event's window start range, [e-h, e+h-time_window]
+            half_event_window = self.event_window/2
+            lo = np.clip(np.ceil((self.event_times - half_event_window)/self.coverage_step), 0, len(self.cell_start)).astype(np.int64)
+            hi = np.clip(np.floor((self.event_times + half_event_window - self.time_window)/self.coverage_step), 0, len(self.cell_start)).astype(np.int64)
+            hi = np.maximum(lo, hi)
+            self.event_cellRange = np.stack([lo, hi], axis=1)
+            self.covered_events = np.nonzero(self.cell_cumLen[hi] > self.cell_cumLen[lo])[0]
+            print("Events meeting coverage:", len(self.covered_events), "out of", len(self.event_times))
+            if(len(self.covered_events) == 0):
+                print("Error: no events with at least", self.min_valid_fraction, "valid samples")
+                assert(0)
+
+    #Samples a window start offset from the cells kept by buildCoverage
+    def sampleCoveredOffset(self):
+        if(self.get_type == 'event'):
+            #Uniform over covered events, then over the event's covered cells
+            e = self.covered_events[random.randrange(len(self.covered_events))]
+            (lo, hi) = self.event_cellRange[e]
+            u = random.uniform(self.cell_cumLen[lo], self.cell_cumLen[hi])
+        else:
+            u = random.uniform(0, self.cell_cumLen[-1])
+        i = np.searchsorted(self.cell_cumLen, u, side='right') - 1
+        i = min(max(i, 0), len(self.cell_start)-1)
+        return self.cell_start[i] + (u - self.cell_cumLen[i])
+
+    #Identifies the stream a grid cache was built from
+    #File mtimes are included so the cache is rebuilt when a file changes, as in read_stream_file
+    def gridKey(self, filename):
+        fns = utils.readList(filename)
+        return repr(([(fn, os.path.getmtime(fn)) for fn in fns], self.time_range, self.target_rate))
+
+    #Writes self.stream on the target_rate grid starting at self.start_time into
+    #gridCacheFile.data.npy (float32) and gridCacheFile.mask.npy (uint8, 1 is invalid),
+    #both [numSamples, num_channels], with channel ids and times in gridCacheFile.idx.npz
+    #A sample at time t goes to grid index floor(target_rate*(t - start_time))
+    def buildGrid(self, filename):
+        print("Building grid cache", self.gridCacheFile)
+        num_channels = len(self.trace_dict.keys())
+        numSamples = int(self.target_rate * (self.end_time - self.start_time)) + 1
+        gridData = np.lib.format.open_memmap(self.gridCacheFile + ".data.npy", mode='w+', dtype=np.float32, shape=(numSamples, num_channels))
+        gridMask = np.lib.format.open_memmap(self.gridCacheFile + ".mask.npy", mode='w+', dtype=np.uint8, shape=(numSamples, num_channels))
+        gridMask[:] = 1
+        for trace in self.stream:
+            channelIdx = self.trace_dict[trace.get_id()]
+            #Grid indices from start time and sample rate, without per sample UTCDateTime objects
+            offset = self.target_rate * (trace.stats['starttime'] - self.start_time)
+            step = self.target_rate / trace.stats['sampling_rate']
+            #Floor, not truncation, so samples before start_time are placed like sliceGrid places them
+            sampleIdx = np.floor(offset + np.arange(trace.stats['npts']) * step).astype(np.int64)
+            valid = np.logical_and(sampleIdx >= 0, sampleIdx < numSamples)
+            #Masked (gap) samples stay invalid
+            valid = np.logical_and(valid, np.logical_not(np.ma.getmaskarray(trace.data)))
+            gridData[sampleIdx[valid], channelIdx] = np.ma.getdata(trace.data)[valid]
+            gridMask[sampleIdx[valid], channelIdx] = 0
+        gridData.flush()
+        gridMask.flush()
+        del gridData, gridMask
+        channel_ids = sorted(self.trace_dict.keys(), key=lambda k: self.trace_dict[k])
+        np.savez(self.gridCacheFile + ".idx.npz", key=self.gridKey(filename), channel_ids=np.array(channel_ids),
+                start_time=str(self.start_time), end_time=str(self.end_time), coverage=self.coverage_intervals)
+
+    #Memory maps the grid cache if it exists and was built from the same (unmodified) files, time range and rate
+    #Sets trace_dict, start_time and end_time from the cache. Returns False if the cache can't be used
+    def loadGrid(self, filename):
+        idxFile = self.gridCacheFile + ".idx.npz"
+        if(not os.path.exists(idxFile)):
+            return False
+        idx = np.load(idxFile)
+        if(str(idx["key"]) != self.gridKey(filename)):
+            print("Grid cache", self.gridCacheFile, "was built from a different stream, rebuilding")
+            return False
+        self.trace_dict = dict([(str(c), i) for (i, c) in enumerate(idx["channel_ids"])])
+        self.start_time = ob.UTCDateTime(str(idx["start_time"]))
+        self.end_time = ob.UTCDateTime(str(idx["end_time"]))
+        self.coverage_intervals = idx["coverage"] if "coverage" in idx.files else None
+        self.gridData = np.load(self.gridCacheFile + ".data.npy", mmap_mode='r')
+        self.gridMask = np.load(self.gridCacheFile + ".mask.npy", mmap_mode='r')
+        #Examples are sliced from the grid, so the stream isn't kept
+        self.stream = None
+        return True
+
+    #Copies the grid window starting at sample_st into outData and outMask
+    def sliceGrid(self, sample_st, outData, outMask):
+        gridIdx = int(np.floor(self.target_rate * (sample_st - self.start_time)))
+        endIdx = min(gridIdx + self.example_size, self.gridData.shape[0])
+        begIdx = max(gridIdx, 0)
+        if(endIdx <= begIdx):
+            return
+        outOffset = begIdx - gridIdx
+        n = endIdx - begIdx
+        outData[outOffset:outOffset+n, :] = self.gridData[begIdx:endIdx, :]
+        outMask[outOffset:outOffset+n, :] = self.gridMask[begIdx:endIdx, :]
+
+    #outData and outMask can be given to write the example in place, e.g. into a batch
+    def getExample(self, outData=None, outMask=None):
+        if(outData is None):
+            outData = np.zeros([self.example_size, self.num_channels], dtype=np.float32)
+        else:
+            outData.fill(0)
         #Mask where 1 is invalid
-        outMask = np.ones([self.example_size, self.num_channels])
+        if(outMask is None):
+            outMask = np.ones([self.example_size, self.num_channels], dtype=np.float32)
+        else:
+            outMask.fill(1)
 
         #Define random offset
-        if(self.get_type == "event"):
+        if(self.cell_cumLen is not None):
+            #Only windows that meet min_valid_fraction
+            offset = self.sampleCoveredOffset()
+            sample_st = self.start_time + offset
+            sample_et = sample_st + self.time_window
+        elif(self.get_type == "event"):
             #Pick random event time
-            event_t = random.choice(self.event_times)
+            event_t = self.event_times[random.randrange(len(self.event_times))]
             half_event_window = self.event_window/2
             offset = random.uniform(0, self.event_window - self.time_window)
-            sample_st = event_t - half_event_window + offset
+            sample_st = self.start_time + (event_t - half_event_window + offset)
             sample_et = sample_st + self.time_window
         elif(self.get_type == 'no_event'):
-            half_event_window = self.event_window/2
-            in_event = True
-            while in_event:
-                offset = random.uniform(0, self.delta_time - self.time_window)
-                sample_st = self.start_time + offset
-                sample_et = sample_st + self.time_window
-                in_event = False
-                for e_time in self.event_times:
-                    e_start_time = e_time - half_event_window
-                    e_end_time = e_time + half_event_window
-                    latest_start = max(e_start_time, sample_st)
-                    earliest_end = min(e_end_time, sample_et)
-                    delta = (earliest_end - latest_start)
-                    #If overlap
-                    if(delta > 0):
-                        in_event = True
-                        break
+            #Sampled directly from the precomputed event free intervals
+            offset = self.sampleNoEventOffset()
+            sample_st = self.start_time + offset
+            sample_et = sample_st + self.time_window
 
         elif(self.get_type is None):
             offset = random.uniform(0, self.delta_time - self.time_window)
@@ -154,6 +422,10 @@ class obspySeismicData(object):
         else:
             print("Error: get_type", self.get_type, "not recognized")
 
+        if(self.gridData is not None):
+            self.sliceGrid(sample_st, outData, outMask)
+            return(outData, outMask)
+
         #Get data from all traces between start_time and end_time
         slice_st = self.stream.slice(sample_st, sample_et, nearest_sample=False)
         #Split masked traces into contiguous unmasked arrays
@@ -186,15 +458,14 @@ class obspySeismicData(object):
         return(outData, outMask)
 
     def getData(self, batchSize):
-        outData = np.zeros((batchSize, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+        outData = self.batchBufs.get("data", (batchSize, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
         #TODO
-        outMask = np.zeros((batchSize, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+        outMask = self.batchBufs.get("mask", (batchSize, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
         for b in range(batchSize):
-            (data, mask) = self.getExample()
-            while(np.sum(mask) == mask.size):
-                (data, mask) = self.getExample()
-            outData[b, 0, :, :] = data
-            outMask[b, 0, :, :] = mask
+            #Write straight into the batch, resampling if every value is missing
+            (data, mask) = self.getExample(outData[b, 0, :, :], outMask[b, 0, :, :])
+            while(np.all(mask)):
+                (data, mask) = self.getExample(outData[b, 0, :, :], outMask[b, 0, :, :])
         return(outData, outMask)
         #return outData
 
@@ -0,0 +1,117 @@
+import numpy as np
+from scipy import sparse
+
+#Lazy, memory mapped reader for PetaVision activity pvp files
+#The file is memory mapped and a frame offset index is built once from the frame headers,
+#so nothing is decoded until frames are requested, and a batch of frames is decoded in one step
+
+#Header fields (int32) used here
+HEADER_SIZE = 0
+FILE_TYPE = 2
+NX = 3
+NY = 4
+NF = 5
+
+#File types
+SPARSE_ACT_FILE_TYPE = 2 #Frame is time (double), numActive (int32), numActive int32 indices
+DENSE_ACT_FILE_TYPE = 4 #Frame is time (double), nx*ny*nf float32 values
+SPARSE_VALUES_FILE_TYPE = 6 #Frame is time (double), numActive (int32), numActive (int32 index, float32 value) pairs
+
+class pvpReader(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        header = np.frombuffer(self.mm[:80].tobytes(), dtype=np.int32)
+        self.headerSize = header[HEADER_SIZE]
+        self.fileType = header[FILE_TYPE]
+        self.shape = (header[NY], header[NX], header[NF])
+        self.frameSize = int(np.prod(self.shape))
+        if(self.fileType == DENSE_ACT_FILE_TYPE):
+            self.entrySize = 4
+        elif(self.fileType == SPARSE_ACT_FILE_TYPE):
+            self.entrySize = 4
+        elif(self.fileType == SPARSE_VALUES_FILE_TYPE):
+            self.entrySize = 8
+        else:
+            print("Error: pvp file type", self.fileType, "not supported")
+            assert(0)
+        self.buildIndex()
+
+    #Builds frameOffsets (byte offset of each frame's data) and frameCounts (number of entries)
+    def buildIndex(self):
+        fileSize = self.mm.shape[0]
+        if(self.fileType == DENSE_ACT_FILE_TYPE):
+            frameBytes = 8 + self.frameSize*4
+            numFrames = (fileSize - self.headerSize)//frameBytes
+            self.frameOffsets = self.headerSize + 8 + np.arange(numFrames, dtype=np.int64)*frameBytes
+            self.frameCounts = np.full((numFrames), self.frameSize, dtype=np.int64)
+            return
+        #Sparse frames have variable size, so walk the frame headers (the data itself isn't read)
+        offsets = []
+        counts = []
+        offset = int(self.headerSize)
+        while(offset + 12 <= fileSize):
+            n = int(np.frombuffer(self.mm[offset+8:offset+12].tobytes(), dtype=np.int32)[0])
+            offsets.append(offset + 12)
+            counts.append(n)
+            offset += 12 + n*self.entrySize
+        self.frameOffsets = np.array(offsets, dtype=np.int64)
+        self.frameCounts = np.array(counts, dtype=np.int64)
+
+    @property
+    def numFrames(self):
+        return len(self.frameOffsets)
+
+    #Returns (rows, indices, values) of every entry in frames, with rows indexing into frames
+    def readEntries(self, frames):
+        frames = np.asarray(frames, dtype=np.int64)
+        counts = self.frameCounts[frames]
+        total = int(counts.sum())
+        rows = np.repeat(np.arange(len(frames)), counts)
+        #Byte position of every entry, as the frame offset plus the entry's position in its frame
+        entryInFrame = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        pos = np.repeat(self.frameOffsets[frames], counts) + entryInFrame*self.entrySize
+        #Gather all entry bytes at once, then reinterpret
+        entries = self.mm[pos[:, None] + np.arange(self.entrySize)]
+        if(self.fileType == DENSE_ACT_FILE_TYPE):
+            indices = entryInFrame
+            values = entries.view(np.float32)[:, 0]
+        elif(self.fileType == SPARSE_ACT_FILE_TYPE):
+            indices = entries.view(np.int32)[:, 0]
+            values = np.ones((total), dtype=np.float32)
+        else:
+            indices = entries.view(np.int32)[:, 0]
+            values = entries.view(np.float32)[:, 1]
+        return (rows, indices, values)
+
+    #Returns the time (double) of each frame in frames
+    def readTimes(self, frames):
+        frames = np.asarray(frames, dtype=np.int64)
+        #The time is at the start of the frame, before the entry count for sparse frames
+        if(self.fileType == DENSE_ACT_FILE_TYPE):
+            timeOffsets = self.frameOffsets[frames] - 8
+        else:
+            timeOffsets = self.frameOffsets[frames] - 12
+        return self.mm[timeOffsets[:, None] + np.arange(8)].view(np.float64)[:, 0]
+
+    #Decodes frames into out, [len(frames), ny, nx, nf] (allocated if None)
+    def readDense(self, frames, out=None):
+        if(out is None):
+            out = np.zeros((len(frames),) + self.shape, dtype=np.float32)
+        if(self.fileType == DENSE_ACT_FILE_TYPE):
+            #Dense frames are contiguous, so just copy them
+            for (i, f) in enumerate(frames):
+                out[i] = self.mm[self.frameOffsets[f]:self.frameOffsets[f]+self.frameSize*4].view(np.float32).reshape(self.shape)
+            return out
+        (rows, indices, values) = self.readEntries(frames)
+        flat = out.reshape((len(frames), self.frameSize))
+        flat.fill(0)
+        flat[rows, indices] = values
+        return out
+
+    #Decodes frames into a [len(frames), ny*nx*nf] csr matrix
+    def readSparse(self, frames):
+        (rows, indices, values) = self.readEntries(frames)
+        counts = self.frameCounts[np.asarray(frames, dtype=np.int64)]
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        return sparse.csr_matrix((values, indices, indptr), shape=(len(frames), self.frameSize))
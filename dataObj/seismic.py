@@ -24,68 +24,96 @@ class seismicData(object):
         self.shuffleFnIdx = list(range(len(self.fnList)))
         self.fnIdx = 0
         self.scaleByChannel = scaleByChannel
+        #Preallocated float32 output batches
+        self.batchBufs = utils.batchBuffers()
 
         if(self.doShuffle):
             random.shuffle(self.shuffleFnIdx)
+        self.buildLengthIndex()
 
-    def getExample(self):
-        numSamples = -np.inf
-        sampleAgain = False
+    #Samples per file, from the file size, so files that are too short are never opened
+    #Files are [numFrames, numChannels, frameSamples] int16, de-interleaved into [numFrames*frameSamples, numChannels]
+    def buildLengthIndex(self):
+        self.frameSamples = [os.path.getsize(fn)//(2*self.numFrames*self.numChannels) for fn in self.fnList]
+        self.fileLengths = [self.numFrames*l for l in self.frameSamples]
+        if(self.exampleSize > 0 and max(self.fileLengths) < self.exampleSize):
+            print("Error: no file has at least", self.exampleSize, "samples")
+            assert(0)
+
+    #Reads samples [begIdx, begIdx+numSamples) of file fileIdx into out, [numSamples, numChannels]
+    #The file is memory mapped and only the frames covering the window are de-interleaved
+    def readWindow(self, fileIdx, begIdx, numSamples, out):
+        frameSamples = self.frameSamples[fileIdx]
+        mm = np.memmap(self.fnList[fileIdx], dtype=np.int16, mode='r',
+                shape=(self.numFrames, self.numChannels, frameSamples))
+        outIdx = 0
+        while(outIdx < numSamples):
+            (f, t) = divmod(begIdx + outIdx, frameSamples)
+            n = min(frameSamples - t, numSamples - outIdx)
+            out[outIdx:outIdx+n, :] = mm[f, :, t:t+n].T
+            outIdx += n
+        del mm
+        return out
+
+    #Reads the next example as [numSamples, numChannels]
+    #Writes into out if given (casting to its dtype), otherwise returns an int16 array
+    def readExample(self, out=None):
         #Only take files that are >= exampleSize
-        while(numSamples < self.exampleSize):
-            if(sampleAgain):
-                print("Skipping file", self.current_filename, "as it only contains", numSamples, "samples in the file")
-            self.current_filename = self.fnList[self.shuffleFnIdx[self.fnIdx]]
+        while(True):
+            fileIdx = self.shuffleFnIdx[self.fnIdx]
+            self.current_filename = self.fnList[fileIdx]
             #filename = "/media/data/jamal/p4681/p4681ac/run1/WF_100.ac"
             self.fnIdx += 1
             if(self.fnIdx >= len(self.fnList)):
                 self.fnIdx = 0
                 print("Rewinding")
-
-            #Load file
-            data = np.fromfile(self.current_filename, dtype=np.int16)
-            data = np.reshape(data, [self.numFrames, self.numChannels, -1])
-            data = np.transpose(data, [1, 0, 2])
-            data = np.reshape(data, [self.numChannels, -1])
-            data = np.transpose(data, [1, 0])
-
-            (numSamples, drop) = data.shape
+            numSamples = self.fileLengths[fileIdx]
             #Use all data if exampleSize < 0
-            if(self.exampleSize < 0):
+            if(self.exampleSize < 0 or numSamples >= self.exampleSize):
                 break
-            sampleAgain = True
+            print("Skipping file", self.current_filename, "as it only contains", numSamples, "samples in the file")
 
         #Grab a chunk from exampleSize
         if(self.exampleSize < 0):
-            outData = data.astype(np.float32)
+            (beg_idx, n) = (0, numSamples)
         else:
             if(self.doShuffle):
-                beg_idx = np.random.randint(0, numSamples - self.exampleSize)
+                beg_idx = np.random.randint(0, numSamples - self.exampleSize + 1)
             else:
                 beg_idx = 0
-            outData = data[beg_idx:beg_idx+self.exampleSize, :].astype(np.float32)
-
-        #Normalize data
-        #outData = data[beg_idx:beg_idx + self.exampleSize, :]
+            n = self.exampleSize
+        if(out is None):
+            out = np.empty((n, self.numChannels), dtype=np.int16)
+        return self.readWindow(fileIdx, beg_idx, n, out)
 
+    #Normalizes each example in data, [..., numSamples, numChannels], by its std, in place
+    def normalizeExamples(self, data):
         if(self.scaleByChannel):
-            std = outData.std(axis=0, keepdims=True)
+            std = data.std(axis=-2, keepdims=True)
         else:
-            std = outData.std()
-        outData = outData.astype(np.float32)/std
+            std = data.std(axis=(-2, -1), keepdims=True)
+        data /= std
+        return data
 
+    def getExample(self):
+        outData = self.readExample().astype(np.float32)
         #outData = outData * .04
-
-        return outData
+        return self.normalizeExamples(outData)
 
     def getData(self, batchSize):
         if(batchSize > 1):
             assert(self.exampleSize > 0)
 
-        outData = np.zeros((batchSize, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
+        if(self.exampleSize < 0):
+            #Example size is only known after reading
+            outData = self.getExample()
+            return outData[np.newaxis, np.newaxis, :, :]
+
+        outData = self.batchBufs.get("data", (batchSize, self.inputShape[0], self.inputShape[1], self.inputShape[2]))
         for b in range(batchSize):
-            outData[b, 0, :, :] = self.getExample()
-        return outData
+            #Casts int16 to float32 on assignment
+            self.readExample(outData[b, 0, :, :])
+        return self.normalizeExamples(outData)
 
 if __name__=="__main__":
     #List of filenames
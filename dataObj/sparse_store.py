@@ -0,0 +1,129 @@
+import numpy as np
+import os
+from scipy import sparse
+
+#Append only store of sparse codes, replacing one npz per batch (see save_sparse_csr)
+#A store is a directory holding:
+#   meta.npy: [rowSize]
+#   index.bin: int64 records of [imageId, shard, offset, nnz], one per row, in write order
+#   shard<k>.data / shard<k>.indices: raw float32 values and int32 column indices of the rows
+#A new shard is started when the current one reaches shardBytes
+#Rows are read back through memory maps, and contiguous rows from one shard are returned without copies
+
+INDEX_FIELDS = 4
+
+def shard_names(path, shard):
+    prefix = os.path.join(path, "shard" + str(shard))
+    return (prefix + ".data", prefix + ".indices")
+
+class sparseStoreWriter(object):
+    #rowSize is the length of a dense row (e.g. nt*ny*nx*nf)
+    #Opening an existing store appends to it
+    def __init__(self, path, rowSize, shardBytes=2**30):
+        self.path = path
+        self.shardBytes = shardBytes
+        if(not os.path.exists(path)):
+            os.makedirs(path)
+        metaFile = os.path.join(path, "meta.npy")
+        if(os.path.exists(metaFile)):
+            assert(np.load(metaFile)[0] == rowSize)
+        else:
+            np.save(metaFile, np.array([rowSize], dtype=np.int64))
+        self.rowSize = rowSize
+        self.indexFile = open(os.path.join(path, "index.bin"), 'ab')
+        #Continue the last shard
+        index = np.fromfile(os.path.join(path, "index.bin"), dtype=np.int64).reshape((-1, INDEX_FIELDS))
+        self.shard = int(index[-1, 1]) if index.shape[0] > 0 else 0
+        self.openShard()
+
+    def openShard(self):
+        (dataFn, indicesFn) = shard_names(self.path, self.shard)
+        self.dataFile = open(dataFn, 'ab')
+        self.indicesFile = open(indicesFn, 'ab')
+        #Offset in elements of the next row
+        self.offset = os.path.getsize(dataFn)//4
+
+    #Appends the rows of csr (a scipy csr matrix, [numRows, rowSize]) with their image ids
+    def append(self, csr, ids):
+        csr = sparse.csr_matrix(csr)
+        assert(csr.shape[1] == self.rowSize)
+        assert(len(ids) == csr.shape[0])
+        if(self.offset*4 >= self.shardBytes):
+            self.closeShard()
+            self.shard += 1
+            self.openShard()
+        nnz = np.diff(csr.indptr)
+        records = np.zeros((csr.shape[0], INDEX_FIELDS), dtype=np.int64)
+        records[:, 0] = ids
+        records[:, 1] = self.shard
+        records[:, 2] = self.offset + csr.indptr[:-1]
+        records[:, 3] = nnz
+        self.dataFile.write(csr.data.astype(np.float32).tobytes())
+        self.indicesFile.write(csr.indices.astype(np.int32).tobytes())
+        self.offset += int(csr.indptr[-1])
+        #Index is written last, so a row is only visible once its data is
+        self.dataFile.flush()
+        self.indicesFile.flush()
+        self.indexFile.write(records.tobytes())
+        self.indexFile.flush()
+
+    def closeShard(self):
+        self.dataFile.close()
+        self.indicesFile.close()
+
+    def close(self):
+        self.closeShard()
+        self.indexFile.close()
+
+class sparseStoreReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.rowSize = int(np.load(os.path.join(path, "meta.npy"))[0])
+        self.index = np.fromfile(os.path.join(path, "index.bin"), dtype=np.int64).reshape((-1, INDEX_FIELDS))
+        self.numRows = self.index.shape[0]
+        #Image id to row
+        self.rowOfId = dict(zip(self.index[:, 0].tolist(), range(self.numRows)))
+        self.data = []
+        self.indices = []
+        for shard in range(int(self.index[:, 1].max()) + 1 if self.numRows > 0 else 0):
+            (dataFn, indicesFn) = shard_names(path, shard)
+            if(os.path.getsize(dataFn) == 0):
+                self.data.append(np.zeros((0), dtype=np.float32))
+                self.indices.append(np.zeros((0), dtype=np.int32))
+            else:
+                self.data.append(np.memmap(dataFn, dtype=np.float32, mode='r'))
+                self.indices.append(np.memmap(indicesFn, dtype=np.int32, mode='r'))
+
+    def rows(self, ids):
+        return np.array([self.rowOfId[i] for i in ids], dtype=np.int64)
+
+    #Returns rows as a [len(rows), rowSize] csr matrix
+    #Consecutive rows from one shard are views into the memory map
+    def readRows(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        if(len(rows) == 0):
+            return sparse.csr_matrix((0, self.rowSize), dtype=np.float32)
+        (shards, offsets, nnz) = (self.index[rows, 1], self.index[rows, 2], self.index[rows, 3])
+        indptr = np.concatenate(([0], np.cumsum(nnz)))
+        contiguous = np.all(shards == shards[0]) and np.all(offsets[1:] == offsets[:-1] + nnz[:-1])
+        if(contiguous):
+            s = shards[0]
+            data = self.data[s][offsets[0]:offsets[0]+indptr[-1]]
+            indices = self.indices[s][offsets[0]:offsets[0]+indptr[-1]]
+        else:
+            data = np.empty((indptr[-1]), dtype=np.float32)
+            indices = np.empty((indptr[-1]), dtype=np.int32)
+            for (i, (s, o, n)) in enumerate(zip(shards, offsets, nnz)):
+                data[indptr[i]:indptr[i+1]] = self.data[s][o:o+n]
+                indices[indptr[i]:indptr[i+1]] = self.indices[s][o:o+n]
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), self.rowSize), copy=False)
+
+    #Decodes rows into out, [len(rows), rowSize] or any shape with that many values per row
+    def readDense(self, rows, out=None):
+        csr = self.readRows(rows)
+        if(out is None):
+            out = np.zeros((len(rows), self.rowSize), dtype=np.float32)
+        flat = out.reshape((len(rows), self.rowSize))
+        flat.fill(0)
+        flat[np.repeat(np.arange(len(rows)), np.diff(csr.indptr)), csr.indices] = csr.data
+        return out
@@ -1,3 +1,6 @@
+import numpy as np
+import sys
+
 def readList(filename):
     f = open(filename, 'r')
     allLines = f.readlines()
@@ -5,3 +8,41 @@ def readList(filename):
     #Remove newlines from all lines
     return [line[:-1] for line in allLines]
 
+
+#Ring of preallocated float32 batch buffers, so getData doesn't allocate every batch
+#A buffer is only reused once nothing else references it (or a view of it), so batches that callers,
+#stage threads or wrappers still hold are never overwritten. A held buffer is replaced in the ring
+#by a new one instead, so numBuffers only needs to cover the batches usually in flight
+class batchBuffers(object):
+    def __init__(self, numBuffers=3, dtype=np.float32):
+        self.numBuffers = numBuffers
+        self.dtype = dtype
+        self.bufs = {}
+        self.bufIdx = {}
+
+    #Returns the next buffer of shape for name
+    def get(self, name, shape):
+        shape = tuple(shape)
+        if(name not in self.bufs or self.bufs[name][0].shape != shape):
+            self.bufs[name] = [np.zeros(shape, dtype=self.dtype) for i in range(self.numBuffers)]
+            self.bufIdx[name] = 0
+        idx = self.bufIdx[name]
+        self.bufIdx[name] = (idx + 1) % self.numBuffers
+        #The ring's list and getrefcount's argument are the only references to a free buffer
+        if(sys.getrefcount(self.bufs[name][idx]) > 2):
+            self.bufs[name][idx] = np.zeros(shape, dtype=self.dtype)
+        return self.bufs[name][idx]
+
+#Parses ISO 8601 UTC time strings (e.g. the time column of an event catalog csv) into POSIX seconds
+#Quotes and whitespace are stripped, and a space date/time separator, a "Z" suffix or a +00:00 offset
+#are accepted. All rows are parsed at once as datetime64, falling back to obspy's UTCDateTime
+#per row (e.g. for other UTC offsets) if that fails
+def parse_utc_times(times):
+    times = np.char.strip(np.char.strip(np.asarray(times, dtype=str)), '"\'')
+    try:
+        iso = np.char.replace(np.char.replace(times, ' ', 'T'), '+00:00', '')
+        iso = np.char.rstrip(iso, 'Z').astype('datetime64[us]')
+        return (iso - np.datetime64('1970-01-01T00:00:00', 'us')) / np.timedelta64(1, 's')
+    except ValueError:
+        import obspy as ob
+        return np.array([ob.UTCDateTime(t).timestamp for t in times], dtype=np.float64)
@@ -0,0 +1,261 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+#Sparse inference with a trained dictionary using only numpy
+#No tensorflow graph is built, so this is meant for eval only jobs
+
+#Loads a dictionary of shape [patchSizeY, patchSizeX, nf, numV]
+#filename can be a .npy file (see base.writeNpyWeights), a pvp weight file (see writePvpWeights),
+#or a tensorflow checkpoint, in which case varName is the name of the dictionary in the checkpoint
+def load_weights(filename, varName="V1_W"):
+    if(filename.endswith(".npy")):
+        return np.load(filename).astype(np.float32)
+    elif(filename.endswith(".pvp")):
+        from pvtools import readpvpfile
+        vals = readpvpfile(filename)["values"]
+        #6D dense numpy array of size [numFrames, numArbors, numKernels, ny, nx, nf]
+        return vals[0, 0, :, :, :, :].transpose((1, 2, 3, 0)).astype(np.float32)
+    else:
+        #Only checkpoints need tensorflow
+        import tensorflow as tf
+        reader = tf.train.NewCheckpointReader(filename)
+        return reader.get_tensor(varName).astype(np.float32)
+
+#Top and left padding used by tensorflow for SAME padding
+def same_pad(inSize, patchSize, stride):
+    outSize = int(np.ceil(float(inSize)/stride))
+    return max((outSize-1)*stride + patchSize - inSize, 0)//2
+
+class npSparseEncoder(object):
+    #Sets dictionary of params to member variables
+    #Uses the same keys as the tensorflow solvers
+    def loadParams(self, params):
+        self.batchSize = params['batchSize']
+        self.displayPeriod = params['displayPeriod']
+        self.learningRateA = params['learningRateA']
+        self.thresh = params['thresh']
+        self.VStrideY = params['VStrideY']
+        self.VStrideX = params['VStrideX']
+        self.patchSizeY = params['patchSizeY']
+        self.patchSizeX = params['patchSizeX']
+        #Input scaling as in LCA_ADAM, defaults match LCA, ISTA and FISTA
+        self.normalize = params.get('normalize', False)
+        self.inputMult = params.get('inputMult', 1.0)
+        #1-D kernels at least this long are applied with FFTs
+        self.fftMinPatch = params.get('fftMinPatch', 64)
+        #FISTA only, same as in FISTA
+        self.autoStepA = params.get('autoStepA', False)
+        self.powerIters = params.get('powerIters', 10)
+        self.restart = params.get('restart', None)
+        if(self.restart not in [None, 'gradient', 'function']):
+            print("Error: restart", self.restart, "not recognized")
+            assert(0)
+
+    #method is one of "lca", "ista" or "fista"
+    #weights is a dictionary array or a filename for load_weights
+    def __init__(self, params, inputShape, weights, method="lca", varName="V1_W"):
+        self.loadParams(params)
+        if(isinstance(weights, str)):
+            weights = load_weights(weights, varName)
+        self.V1_W = weights
+        (py, px, nf, self.numV) = self.V1_W.shape
+        assert(py == self.patchSizeY)
+        assert(px == self.patchSizeX)
+        assert(nf == inputShape[2])
+        self.inputShape = inputShape
+        self.method = method
+        if(self.method not in ["lca", "ista", "fista"]):
+            print("Error: method", self.method, "not recognized")
+            assert(0)
+
+        self.V_Y = int(np.ceil(float(inputShape[0])/self.VStrideY))
+        self.V_X = int(np.ceil(float(inputShape[1])/self.VStrideX))
+        self.padTop = same_pad(inputShape[0], py, self.VStrideY)
+        self.padLeft = same_pad(inputShape[1], px, self.VStrideX)
+        #Padded image size that every strided patch fits in
+        self.padY = max((self.V_Y-1)*self.VStrideY + py, inputShape[0] + self.padTop)
+        self.padX = max((self.V_X-1)*self.VStrideX + px, inputShape[1] + self.padLeft)
+        self.patch_norm = np.sqrt(py*px*nf)
+
+        self.useFFT = (py == 1 and inputShape[0] == 1 and px >= self.fftMinPatch)
+        if(self.useFFT):
+            #Long enough that circular convolution and correlation don't wrap
+            self.nFFT = int(2**np.ceil(np.log2(self.V_X*self.VStrideX + px + inputShape[1])))
+            #[freq, nf, numV]
+            self.W_fft = np.fft.rfft(self.V1_W[0, :, :, :], n=self.nFFT, axis=0)
+
+        if(self.autoStepA):
+            #The dictionary is fixed, so the step is estimated once, with FISTA's longer initial power iteration
+            self.stepA = 1.0/self.lipschitz(10*self.powerIters)
+        else:
+            self.stepA = self.learningRateA
+        #LCA's U carries over between batches, like V1_U in LCA
+        self.U = None
+
+    #Lipschitz constant of reconGrad, 2/batchSize * ||D||^2, by power iteration as in FISTA's updateLipschitz
+    def lipschitz(self, numIters):
+        v = np.random.normal(0, 1, (1, self.V_Y, self.V_X, self.numV)).astype(np.float32)
+        v /= np.sqrt(np.sum(np.square(v))) + 1e-12
+        eig = 0.0
+        for i in range(numIters):
+            DtDv = self.correlate(self.recon(v))
+            eig = np.sqrt(np.sum(np.square(DtDv)))
+            v = DtDv/(eig + 1e-12)
+        return 2*eig/self.batchSize
+
+    #Scales input the same way as the tensorflow solvers
+    def scaleInput(self, inData):
+        scaled = inData.astype(np.float32)
+        if(self.normalize):
+            mean = scaled.mean(axis=(1, 2), keepdims=True)
+            std = scaled.std(axis=(1, 2), keepdims=True)
+            std[std == 0] = 1
+            scaled = (scaled - mean)/std
+        return scaled/self.patch_norm * self.inputMult
+
+    #Reconstruction, same as conv2d_oneToMany with SAME padding
+    #A is [batch, V_Y, V_X, numV]
+    def recon(self, A):
+        nb = A.shape[0]
+        (ny, nx, nf) = self.inputShape
+        if(self.useFFT):
+            #Upsample by stride, then convolve with each atom
+            up = np.zeros((nb, self.V_X*self.VStrideX, self.numV), dtype=np.float32)
+            up[:, ::self.VStrideX, :] = A[:, 0, :, :]
+            up_fft = np.fft.rfft(up, n=self.nFFT, axis=1)
+            out = np.fft.irfft(np.einsum('bwk,wfk->bwf', up_fft, self.W_fft), n=self.nFFT, axis=1)
+            out = out[:, self.padLeft:self.padLeft+nx, :]
+            return out[:, np.newaxis, :, :].astype(np.float32)
+
+        (py, px) = (self.patchSizeY, self.patchSizeX)
+        #[batch, V_Y, V_X, py, px, nf]
+        patches = np.tensordot(A, self.V1_W, axes=([3], [3]))
+        out = np.zeros((nb, self.padY, self.padX, nf), dtype=np.float32)
+        #Overlap add each patch offset
+        for dy in range(py):
+            for dx in range(px):
+                out[:, dy:dy+self.V_Y*self.VStrideY:self.VStrideY, dx:dx+self.V_X*self.VStrideX:self.VStrideX, :] += patches[:, :, :, dy, dx, :]
+        return out[:, self.padTop:self.padTop+ny, self.padLeft:self.padLeft+nx, :]
+
+    #Adjoint of recon (strided correlation with the dictionary)
+    #err is [batch, ny, nx, nf], returns [batch, V_Y, V_X, numV]
+    def correlate(self, err):
+        nb = err.shape[0]
+        (ny, nx, nf) = self.inputShape
+        if(self.useFFT):
+            err_fft = np.fft.rfft(err[:, 0, :, :], n=self.nFFT, axis=1)
+            corr = np.fft.irfft(np.einsum('bwf,wfk->bwk', err_fft, np.conj(self.W_fft)), n=self.nFFT, axis=1)
+            #Correlation at shift s is stored at index s mod nFFT
+            idx = (np.arange(self.V_X)*self.VStrideX - self.padLeft) % self.nFFT
+            return corr[:, np.newaxis, idx, :].astype(np.float32)
+
+        (py, px) = (self.patchSizeY, self.patchSizeX)
+        pad = np.zeros((nb, self.padY, self.padX, nf), dtype=np.float32)
+        pad[:, self.padTop:self.padTop+ny, self.padLeft:self.padLeft+nx, :] = err
+        #View of every strided patch, [batch, V_Y, V_X, py, px, nf]
+        (sb, sy, sx, sf) = pad.strides
+        patches = as_strided(pad, shape=(nb, self.V_Y, self.V_X, py, px, nf),
+                strides=(sb, sy*self.VStrideY, sx*self.VStrideX, sy, sx, sf))
+        return np.tensordot(patches, self.V1_W, axes=([3, 4, 5], [0, 1, 2]))
+
+    #Gradient of reconError wrt A. Like the tensorflow solvers, reconError is averaged over the
+    #training batchSize, so the step size means the same thing here
+    def reconGrad(self, A, scaled):
+        err = scaled - self.recon(A)
+        return -(2.0/self.batchSize) * self.correlate(err)
+
+    #U is warm started from the previous batch, as LCA doesn't reset V1_U between batches
+    #(LCA_ADAM does reset it, so codes from an LCA_ADAM dictionary differ from LCA_ADAM.evalData)
+    def encodeLCA(self, scaled):
+        nb = scaled.shape[0]
+        assert(nb <= self.batchSize)
+        if(self.U is None):
+            self.U = np.random.uniform(0, 1.25*self.thresh, (self.batchSize, self.V_Y, self.V_X, self.numV)).astype(np.float32)
+        #View, so the update carries over
+        U = self.U[:nb]
+        for i in range(self.displayPeriod):
+            A = np.maximum(U - self.thresh, 0)
+            U += self.learningRateA * (-self.reconGrad(A, scaled) + A - U)
+        return A
+
+    #A is the initial code, random as in ISTA.initV1 if None
+    def encodeISTA(self, scaled, A=None):
+        VShape = (scaled.shape[0], self.V_Y, self.V_X, self.numV)
+        if(A is None):
+            A = np.clip(np.random.normal(0, 1e-3, VShape), -2e-3, 2e-3).astype(np.float32)
+        for i in range(self.displayPeriod):
+            grad = self.learningRateA * self.reconGrad(A, scaled)
+            A = np.maximum(np.abs(A - grad) - self.thresh*self.learningRateA, 0) * np.sign(A)
+        return A
+
+    #Same updates as FISTA.optimizerA0 and FISTA.optimizerA, including the gradient taken at A,
+    #the step size and restarts
+    #A is the initial code, random as in FISTA.resetV1 if None
+    def encodeFISTA(self, scaled, A=None):
+        VShape = (scaled.shape[0], self.V_Y, self.V_X, self.numV)
+        if(A is None):
+            A = np.clip(np.random.normal(0, 1e-3, VShape), -2e-3, 2e-3).astype(np.float32)
+        Y = A.copy()
+        T = 1.0
+        #Previous step's A and Y, as set by FISTA.resetRestart
+        (oldA, oldY) = (A, Y)
+        prevLoss = np.inf
+        for i in range(self.displayPeriod):
+            if(self.restart is not None):
+                if(self.restart == 'gradient'):
+                    doRestart = np.sum((oldY - A)*(A - oldA)) > 0
+                else:
+                    #Same loss as FISTA, a mean over the batch
+                    err = scaled - self.recon(A)
+                    loss = (np.sum(np.square(err))/2 + self.thresh*np.sum(np.abs(A)))/self.batchSize
+                    doRestart = loss > prevLoss
+                    prevLoss = loss
+                #Restarting drops the momentum term for this step
+                if(doRestart):
+                    Y = A
+                    T = 1.0
+            grad = self.stepA * self.reconGrad(A, scaled)
+            newA = np.maximum(np.abs(Y - grad) - self.thresh*self.stepA, 0) * np.sign(A)
+            newT = (1+np.sqrt(4*T*T))/2
+            newY = newA + ((T-1)/(newT+1e-8))*(newA-A)
+            (oldA, oldY) = (A, Y)
+            (A, Y, T) = (newA, newY, newT)
+        return A
+
+    #Finds sparse encoding of inData
+    #inData must be in the shape of the image
+    #[batch, nY, nX, nF]
+    def evalData(self, inData):
+        (nb, ny, nx, nf) = inData.shape
+        assert(ny == self.inputShape[0])
+        assert(nx == self.inputShape[1])
+        assert(nf == self.inputShape[2])
+        scaled = self.scaleInput(inData)
+        if(self.method == "lca"):
+            return self.encodeLCA(scaled)
+        elif(self.method == "ista"):
+            return self.encodeISTA(scaled)
+        else:
+            return self.encodeFISTA(scaled)
+
+    #Encodes every image in evalDataObj and writes the codes to a sparse pvp file
+    def evalSet(self, evalDataObj, outFilename):
+        from pvtools import pvpOpen
+        from scipy import sparse
+        #Number of images in the (possibly rangeIdx limited) list
+        numImages = evalDataObj.numData
+        #skip must be 1 for now
+        assert(evalDataObj.skip == 1)
+        numIterations = int(np.ceil(float(numImages)/self.batchSize))
+
+        pvFile = pvpOpen(outFilename, 'w')
+        for it in range(numIterations):
+            print(str((float(it)*100)/numIterations) + "% done (" + str(it) + " out of " + str(numIterations) + ")")
+            #The last batch only reads the remaining images, so wrapped images aren't read, encoded or written
+            numValid = min(self.batchSize, numImages - it*self.batchSize)
+            npV1_A = self.evalData(evalDataObj.getData(numValid))
+            v1Sparse = sparse.csr_matrix(np.reshape(npV1_A, (npV1_A.shape[0], -1)))
+            time = range(it*self.batchSize, it*self.batchSize + numValid)
+            data = {"values":v1Sparse, "time":time}
+            pvFile.write(data, shape=(self.V_Y, self.V_X, self.numV))
+        pvFile.close()
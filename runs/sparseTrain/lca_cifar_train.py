@@ -54,6 +54,8 @@ params = {
     #Patch size
     'patchSizeY':      12,
     'patchSizeX':      12,
+    #Run LCA steps in an in-graph loop between summaries
+    'fusedEncode':     True,
 }
 
 #Allocate tensorflow object
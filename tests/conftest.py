@@ -0,0 +1,16 @@
+import importlib.util
+import os
+import sys
+
+#Modules import each other as TFSparseCode.*, which only works when the parent of a checkout named
+#TFSparseCode is on the path. Otherwise, register this checkout under that name so a plain pytest
+#from the repo root works
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+try:
+    import TFSparseCode
+except ImportError:
+    spec = importlib.util.spec_from_file_location("TFSparseCode", os.path.join(root, "__init__.py"),
+        submodule_search_locations=[root])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["TFSparseCode"] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,30 @@
+import numpy as np
+from TFSparseCode.dataObj.utils import batchBuffers
+
+#Fills numBatches batches from the ring like a data object's getData, each with its own value
+def get_batches(bufs, numBatches, start=0):
+    batches = []
+    for i in range(numBatches):
+        data = bufs.get("data", (2, 3))
+        data.fill(start + i)
+        batches.append(data)
+    return batches
+
+def test_held_batches_are_not_overwritten():
+    bufs = batchBuffers(numBuffers=3)
+    held = get_batches(bufs, 5)
+    #Views of a batch, e.g. one example of it, hold it as well
+    view = get_batches(bufs, 1, start=5)[0][0]
+    get_batches(bufs, 4, start=6)
+    for (i, data) in enumerate(held):
+        assert np.all(data == i)
+    assert np.all(view == 5)
+
+def test_released_buffers_are_reused():
+    bufs = batchBuffers(numBuffers=3)
+    ids = []
+    for i in range(9):
+        data = bufs.get("data", (2, 3))
+        ids.append(id(data))
+        del data
+    assert len(set(ids)) == 3
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+def make_params(tmp_path, batchSize, **kwargs):
+    params = {
+        'outDir':          str(tmp_path) + "/",
+        'runDir':          "run/",
+        'tfDir':           "tfout",
+        'ckptDir':         "checkpoints/",
+        'saveFile':        "save-model",
+        'savePeriod':      1,
+        'plotDir':         "plots/",
+        'plotReconPeriod': 10**6,
+        'plotWeightPeriod':10**6,
+        'progress':        10**6,
+        'writeStep':       10**6,
+        'load':            False,
+        'loadFile':        "",
+        'device':          '/cpu:0',
+        'numIterations':   1,
+        'displayPeriod':   20,
+        'batchSize':       batchSize,
+        'learningRateA':   .05,
+        'learningRateW':   .01,
+        'thresh':          .01,
+        'numV':            4,
+        'VStrideY':        1,
+        'VStrideX':        2,
+        'patchSizeY':      1,
+        'patchSizeX':      8,
+        'fc':              False,
+        'normalize':       True,
+        'inputMult':       .4,
+    }
+    params.update(kwargs)
+    return params
+
+class randomDataObj(object):
+    inputShape = (1, 32, 2)
+    def __init__(self, mask=True):
+        self.mask = mask
+    def getData(self, batchSize):
+        data = np.random.normal(0, 1, (batchSize,) + self.inputShape).astype(np.float32)
+        if(self.mask):
+            return (data, np.zeros(data.shape, dtype=np.float32))
+        return data
+
+#V1_U, V1_A and V1_U's Adam moments are batch sized, so none of them may be restored
+def test_restore_at_different_batch_size(tmp_path):
+    from TFSparseCode.tf.lca_adam import LCA_ADAM
+    tf.reset_default_graph()
+    model = LCA_ADAM(make_params(tmp_path, 4), randomDataObj())
+    model.trainA(False)
+    savePath = model.saver.save(model.sess, model.saveFile)
+    W = model.sess.run(model.V1_W)
+    model.closeSess()
+
+    tf.reset_default_graph()
+    model = LCA_ADAM(make_params(tmp_path, 2, load=True, loadFile=savePath, loadBatchState=False), randomDataObj())
+    assert np.array_equal(model.sess.run(model.V1_W), W)
+    assert model.evalData(randomDataObj(mask=False).getData(1)).shape[0] == 1
+    model.closeSess()
+
+#Padded rows of a partial batch stay at zero, so they add nothing to the batch wide restart test
+def test_padded_rows_stay_zero(tmp_path):
+    from TFSparseCode.tf.fista import FISTA
+    tf.reset_default_graph()
+    inputShape = (8, 8, 3)
+    class imageDataObj(object):
+        def __init__(self):
+            self.inputShape = inputShape
+        def getData(self, batchSize):
+            return np.random.normal(0, 1, (batchSize,) + inputShape).astype(np.float32)
+    model = FISTA(make_params(tmp_path, 3, VStrideX=2, VStrideY=2, patchSizeY=4, patchSizeX=4, restart='gradient'), imageDataObj())
+    codes = model.evalData(imageDataObj().getData(1))
+    assert codes.shape[0] == 1
+    assert np.any(codes != 0)
+    A = model.sess.run(model.V1_A)
+    assert np.all(A[1:] == 0)
+    #Training batches use every row again
+    assert np.all(model.sess.run(model.rowMask) == 1)
+    model.closeSess()
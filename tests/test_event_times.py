@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from TFSparseCode.dataObj.utils import parse_utc_times
+
+#2016-02-24T21:38:10.450 UTC
+EXPECTED = 1456349890.45
+
+#USGS ComCat csv export, read the same way as obspySeismicData.loadEvents
+def test_usgs_catalog_csv(tmp_path):
+    fn = tmp_path / "query.csv"
+    fn.write_text(
+        "time,latitude,longitude,depth,mag,magType,nst,gap,dmin,rms,net,id,updated,place,type\n"
+        "2016-02-24T21:38:10.450Z,49.1,-123.2,10,2.5,ml,,,,0.3,us,us1,2016-03-01T00:00:00.000Z,\"10km N of Nanaimo, Canada\",earthquake\n"
+        "2016-02-24T21:38:20.450Z,49.1,-123.2,10,2.5,ml,,,,0.3,us,us2,2016-03-01T00:00:00.000Z,\"20km N of Nanaimo, Canada\",earthquake\n")
+    times = np.loadtxt(str(fn), dtype=str, delimiter=',', skiprows=1, usecols=(0,), ndmin=1)
+    assert np.allclose(parse_utc_times(times), [EXPECTED, EXPECTED + 10])
+
+@pytest.mark.parametrize("fmt", [
+    "2016-02-24T21:38:10.450Z",
+    "\"2016-02-24T21:38:10.450Z\"",
+    " 2016-02-24T21:38:10.45 ",
+    "2016-02-24 21:38:10.450",
+    "2016-02-24T21:38:10.450+00:00",
+    "'2016-02-24 21:38:10.450000+00:00'",
+])
+def test_catalog_time_formats(fmt):
+    assert np.allclose(parse_utc_times([fmt]), [EXPECTED])
+
+#Other offsets fall back to obspy's per row parse
+def test_offset_fallback():
+    pytest.importorskip("obspy")
+    assert np.allclose(parse_utc_times(["2016-02-24T13:38:10.450-08:00", "2016-02-24T21:38:10.450Z"]), [EXPECTED, EXPECTED])
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+from TFSparseCode.infer.np_encode import npSparseEncoder
+
+def make_params(**kwargs):
+    params = {
+        'batchSize':       2,
+        'displayPeriod':   100,
+        'learningRateA':   .05,
+        'thresh':          .01,
+        'VStrideY':        2,
+        'VStrideX':        2,
+        'patchSizeY':      4,
+        'patchSizeX':      4,
+        'autoStepA':       True,
+        'powerIters':      10,
+    }
+    params.update(kwargs)
+    return params
+
+def make_weights(WShape, seed=0):
+    rng = np.random.RandomState(seed)
+    W = rng.normal(0, 1, WShape).astype(np.float32)
+    return W/np.sqrt(np.sum(np.square(W), axis=(0, 1, 2), keepdims=True))
+
+def test_correlate_is_adjoint_of_recon():
+    rng = np.random.RandomState(1)
+    for (params, inputShape) in [(make_params(), (8, 8, 3)),
+            (make_params(patchSizeY=1, patchSizeX=64, VStrideY=1, VStrideX=4), (1, 128, 2))]:
+        W = make_weights((params['patchSizeY'], params['patchSizeX'], inputShape[2], 6))
+        enc = npSparseEncoder(params, inputShape, W, method="fista")
+        A = rng.normal(0, 1, (2, enc.V_Y, enc.V_X, enc.numV)).astype(np.float32)
+        E = rng.normal(0, 1, (2,) + inputShape).astype(np.float32)
+        lhs = np.sum(enc.recon(A) * E)
+        rhs = np.sum(A * enc.correlate(E))
+        assert np.isclose(lhs, rhs, rtol=1e-3)
+
+def test_lipschitz_matches_dictionary_norm():
+    params = make_params(powerIters=50)
+    inputShape = (8, 8, 3)
+    enc = npSparseEncoder(params, inputShape, make_weights((4, 4, 3, 6)), method="fista")
+    #Explicit matrix of recon for one image
+    numA = enc.V_Y*enc.V_X*enc.numV
+    D = np.stack([enc.recon(np.eye(numA, dtype=np.float32)[i].reshape((1, enc.V_Y, enc.V_X, enc.numV))).ravel()
+        for i in range(numA)], axis=1)
+    eig = np.linalg.norm(D, 2)**2
+    assert np.isclose(1.0/enc.stepA, 2*eig/params['batchSize'], rtol=1e-3)
+
+#One 1x1 atom on 1x1 images, so each image has one coefficient a and the energy is
+#(x-a)^2/batchSize + thresh*|a|, minimized by a = max(x - thresh*batchSize/2, 0) for x >= 0
+@pytest.mark.parametrize("method,restart", [("lca", None), ("ista", None), ("fista", None), ("fista", 'gradient'), ("fista", 'function')])
+def test_single_atom_closed_form(method, restart):
+    params = make_params(batchSize=4, displayPeriod=500, learningRateA=.2, thresh=.1, VStrideY=1, VStrideX=1,
+        patchSizeY=1, patchSizeX=1, restart=restart)
+    enc = npSparseEncoder(params, (1, 1, 1), np.ones((1, 1, 1, 1), dtype=np.float32), method=method)
+    x = np.array([.5, 1.0, .02, 2.0], dtype=np.float32).reshape((4, 1, 1, 1))
+    expected = np.maximum(x - params['thresh']*params['batchSize']/2, 0)
+    #ISTA and FISTA keep the sign of the initial code, so start from positive codes
+    A0 = np.full((4, 1, 1, 1), 1e-3, dtype=np.float32)
+    if(method == "lca"):
+        A = enc.encodeLCA(enc.scaleInput(x))
+    elif(method == "ista"):
+        A = enc.encodeISTA(enc.scaleInput(x), A0)
+    else:
+        A = enc.encodeFISTA(enc.scaleInput(x), A0)
+    assert np.allclose(A, expected, atol=1e-4)
+
+#Runs FISTA's graph steps from the same initial code as the numpy encoder
+@pytest.mark.parametrize("restart", [None, 'gradient', 'function'])
+def test_fista_matches_tensorflow(tmp_path, restart):
+    tf = pytest.importorskip("tensorflow")
+    from TFSparseCode.tf.fista import FISTA
+
+    inputShape = (8, 8, 3)
+    batchSize = 2
+    rng = np.random.RandomState(2)
+    data = rng.normal(0, 1, (batchSize,) + inputShape).astype(np.float32)
+
+    class fixedDataObj(object):
+        def __init__(self):
+            self.inputShape = inputShape
+        def getData(self, numExample):
+            return data
+
+    params = make_params(restart=restart)
+    params.update({
+        'outDir':          str(tmp_path) + "/",
+        'runDir':          "run/",
+        'tfDir':           "tfout",
+        'ckptDir':         "checkpoints/",
+        'saveFile':        "save-model",
+        'savePeriod':      1,
+        'plotDir':         "plots/",
+        'plotPeriod':      10**6,
+        'plotReconPeriod': 10**6,
+        'plotWeightPeriod':10**6,
+        'progress':        10**6,
+        'writeStep':       10**6,
+        'load':            False,
+        'loadFile':        "",
+        'device':          '/cpu:0',
+        'numIterations':   1,
+        'learningRateW':   1,
+        'numV':            6,
+    })
+    W = make_weights((4, 4, 3, 6))
+
+    tf.reset_default_graph()
+    model = FISTA(params, fixedDataObj())
+    model.sess.run(model.V1_W.assign(W))
+    model.sess.run(model.updateLipschitz, feed_dict={model.numPowerIters: 10*model.powerIters})
+
+    A0 = np.clip(rng.normal(0, 1e-3, model.VShape), -2e-3, 2e-3).astype(np.float32)
+    feedDict = {model.inputImage: data}
+    model.sess.run(model.V1_A.assign(A0))
+    model.sess.run(model.resetY)
+    model.sess.run(model.resetT)
+    if(restart is not None):
+        model.sess.run(model.resetRestart)
+    for i in range(params['displayPeriod']):
+        model.sess.run(model.optimizerA0, feed_dict=feedDict)
+        model.sess.run(model.optimizerA, feed_dict=feedDict)
+    tfCodes = model.sess.run(model.V1_A)
+    model.closeSess()
+
+    enc = npSparseEncoder(params, inputShape, W, method="fista")
+    npCodes = enc.encodeFISTA(enc.scaleInput(data), A0.copy())
+
+    assert np.allclose(npCodes, tfCodes, atol=1e-4)
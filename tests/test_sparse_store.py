@@ -0,0 +1,19 @@
+import numpy as np
+from scipy import sparse
+from TFSparseCode.dataObj.sparse_store import sparseStoreWriter, sparseStoreReader
+
+def test_roundtrip_and_empty_rows(tmp_path):
+    path = str(tmp_path / "store")
+    rng = np.random.RandomState(0)
+    dense = rng.normal(0, 1, (6, 10)).astype(np.float32) * (rng.uniform(0, 1, (6, 10)) > .7)
+    writer = sparseStoreWriter(path, 10)
+    writer.append(sparse.csr_matrix(dense[:4]), [0, 1, 2, 3])
+    writer.append(sparse.csr_matrix(dense[4:]), [4, 5])
+    writer.close()
+
+    reader = sparseStoreReader(path)
+    assert np.array_equal(reader.readDense(reader.rows([5, 0, 3])), dense[[5, 0, 3]])
+    assert np.array_equal(reader.readRows(reader.rows(range(6))).toarray(), dense)
+    empty = reader.readRows([])
+    assert empty.shape == (0, 10)
+    assert reader.readDense([]).shape == (0, 10)
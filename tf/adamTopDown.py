@@ -7,6 +7,7 @@ from plots.plotRecon import plotRecon
 from .utils import sparse_weight_variable, weight_variable, node_variable, conv2d, conv2d_oneToMany, convertToSparse4d, save_sparse_csr
 #Using pvp files for saving
 from pvtools import *
+from .code_writer import pvpCodeWriter
 
 class AdamTopDown(base):
     #Sets dictionary of params to member variables
@@ -26,6 +27,8 @@ class AdamTopDown(base):
     def runModel(self):
         #Normalize weights to start
         self.normWeights()
+        #Load the next batch in the background while the first is encoded
+        self.startStage()
 
         #Training
         for i in range(self.numIterations):
@@ -40,7 +43,7 @@ class AdamTopDown(base):
     #Constructor takes inputShape, which is a 3 tuple (ny, nx, nf) based on the size of the image being fed in
     def __init__(self, params, dataObj):
         super(AdamTopDown, self).__init__(params, dataObj)
-        self.currImg = self.dataObj.getData(self.batchSize)
+        self.currImg = self.firstBatch()
 
     #Builds the model. inMatFilename should be the vgg file
     def buildModel(self, inputShape):
@@ -50,7 +53,7 @@ class AdamTopDown(base):
             with tf.name_scope("inputOps"):
                 self.imageShape = (self.batchSize, inputShape[0], inputShape[1], inputShape[2])
                 #Get convolution variables as placeholders
-                self.inputImage = node_variable(self.imageShape, "inputImage")
+                self.inputImage = self.stagedInput(self.imageShape, "inputImage")
 
             self.V1_W = []
             self.normalize_W = []
@@ -260,7 +263,7 @@ class AdamTopDown(base):
     #Trains model for numSteps
     def trainA(self, save):
         #Define session
-        feedDict = {self.inputImage: self.currImg}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg})
         self.encodeImage(feedDict)
 
         if(save):
@@ -273,7 +276,7 @@ class AdamTopDown(base):
             self.sess.run(self.normalize_W[l])
 
     def trainW(self):
-        feedDict = {self.inputImage: self.currImg}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg})
 
         #Visualization
         if (self.plotTimestep % self.plotPeriod == 0):
@@ -291,7 +294,7 @@ class AdamTopDown(base):
         #Update weights
         self.sess.run(self.optimizerW, feed_dict=feedDict)
         #New image
-        self.currImg = self.dataObj.getData(self.batchSize)
+        self.currImg = self.nextBatch()
         self.plotTimestep += 1
 
 
@@ -321,9 +324,12 @@ class AdamTopDown(base):
         numImages = evalDataObj.numImages
         #skip must be 1 for now
         assert(evalDataObj.skip == 1)
+        #Batches are read here, so no stage thread may be reading the data object
+        self.stopStage()
         numIterations = int(np.ceil(float(numImages)/self.batchSize))
 
-        pvFile = pvpOpen(outFilename, 'w')
+        #Sparse conversion and file writes happen on a background thread
+        codeWriter = pvpCodeWriter(outFilename, (self.VShape[1], self.VShape[2], self.VShape[3]))
         for it in range(numIterations):
             print(str((float(it)*100)/numIterations) + "% done (" + str(it) + " out of " + str(numIterations) + ")")
             #Evaluate
@@ -331,12 +337,10 @@ class AdamTopDown(base):
             pdb.set_trace()
             #TODO
 
-            v1Sparse = convertToSparse4d(npV1_A)
             time = range(it*self.batchSize, (it+1)*self.batchSize)
-            data = {"values":v1Sparse, "time":time}
-            pvFile.write(data, shape=(self.VShape[1], self.VShape[2], self.VShape[3]))
+            codeWriter.write(npV1_A, time)
             self.currImg = self.dataObj.getData(self.batchSize)
-        pvFile.close()
+        codeWriter.close()
 
     #TODO
     #def writePvpWeights(self, outputPrefix, rect=False):
@@ -3,7 +3,9 @@ import numpy as np
 import tensorflow as tf
 from plots.plotWeights import make_plot_time
 import os
-from .utils import sparse_weight_variable, weight_variable, node_variable, conv3d, transpose5dData, transpose5dWeight, undoTranspose5dData, convertToSparse5d, save_sparse_csr
+from .base import base
+from .utils import sparse_weight_variable, weight_variable, node_variable, conv3d, transpose5dData, transpose5dWeight, undoTranspose5dData, convertToSparse5d
+from TFSparseCode.dataObj.sparse_store import sparseStoreWriter
 #import matplotlib.pyplot as plt
 #from pvtools import writepvpfile
 
@@ -15,7 +17,7 @@ class AdamTimeSp(base):
 
     #Sets dictionary of params to member variables
     def loadParams(self, params):
-        super(AdamTimeSP, self).loadParams(params)
+        super(AdamTimeSp, self).loadParams(params)
         #Initialize tf parameters here
         self.learningRateA = params['learningRateA']
         self.learningRateW = params['learningRateW']
@@ -46,7 +48,7 @@ class AdamTimeSp(base):
 
     #Constructor takes inputShape, which is a 3 tuple (ny, nx, nf) based on the size of the image being fed in
     def __init__(self, params, dataObj):
-        super(AdamTimeSP, self).__init__(params, dataObj)
+        super(AdamTimeSp, self).__init__(params, dataObj)
         self.currImg = self.dataObj.getData(self.batchSize, self.nT)
 
     #Builds the model. inMatFilename should be the vgg file
@@ -89,8 +91,8 @@ class AdamTimeSp(base):
             with tf.name_scope("ISTA"):
                 #Variable for activity
                 self.V1_A = weight_variable(self.VShape, "V1_A", 1e-4)
-                self.zeroConst = tf.zeros(self.VShape)
-                self.t_V1_A = tf.select(tf.abs(self.V1_A) < self.zeroThresh, self.zeroConst, self.V1_A)
+                #zeros_like keeps batch sized constants out of the graph
+                self.t_V1_A = tf.where(tf.abs(self.V1_A) < self.zeroThresh, tf.zeros_like(self.V1_A), self.V1_A)
 
                 #self.V1_A= weight_variable((self.batchSize, inputShape[0], inputShape[1], self.numV), "V1_A", .01)
 
@@ -98,7 +100,8 @@ class AdamTimeSp(base):
                 assert(self.VStrideT >= 1)
                 assert(self.VStrideY >= 1)
                 assert(self.VStrideX >= 1)
-                #We build index tensor in numpy to gather
+                #Strides are folded into the feature dimension (transpose5dData), so this is a unit stride
+                #conv3d on the folded input with no index tensors
                 self.recon = conv3d(self.V1_A, self.V1_W, "recon")
                 self.t_recon = conv3d(self.t_V1_A, self.V1_W, "recon")
 
@@ -247,18 +250,31 @@ class AdamTimeSp(base):
         outVals = self.t_V1_A.eval(session=self.sess)
         return outVals
 
-    def evalSet(self, evalDataObj, outPrefix, displayPeriod=None):
+    #Codes are appended to a sparse store at outDir (see dataObj/sparse_store.py),
+    #with the iteration as the image id, instead of one npz per iteration
+    #outPrefix is the old name of outDir, and is deprecated
+    def evalSet(self, evalDataObj, outDir=None, displayPeriod=None, outPrefix=None):
+        if(outPrefix is not None):
+            print("Warning: evalSet's outPrefix is deprecated, writing a sparse store directory at", outPrefix, "instead of npz files")
+            outDir = outPrefix
+        if(outDir is None):
+            print("Error: evalSet needs outDir")
+            assert(0)
         numImages = evalDataObj.numImages
         numIterations = int(numImages/evalDataObj.skip)
         #batchSize must be 1 for now
         assert(self.batchSize == 1)
-        #Open h5py file
+        outStore = None
         for it in range(numIterations):
             print(str((float(it)*100)/numIterations) + "% done (" + str(it) + " out of " + str(numIterations) + ")")
             #Evaluate
             npV1_A = self.evalData(evalDataObj.getData(self.batchSize, self.nT), displayPeriod=displayPeriod)
             v1Sparse = convertToSparse5d(npV1_A)
-            save_sparse_csr(outPrefix+str(it), v1Sparse)
+            if(outStore is None):
+                outStore = sparseStoreWriter(outDir, v1Sparse.shape[1])
+            outStore.append(v1Sparse, [it])
+        if(outStore is not None):
+            outStore.close()
 
     #def writePvpWeights(self, outputPrefix):
     #    npw = self.sess.run(self.reshape_weight)
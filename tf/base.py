@@ -2,6 +2,7 @@ import pdb
 import numpy as np
 import tensorflow as tf
 import os
+import threading
 from TFSparseCode.tf.utils import sparse_weight_variable, weight_variable, node_variable, conv2d, conv2d_oneToMany, convertToSparse4d, save_sparse_csr
 #import matplotlib.pyplot as plt
 #from pvtools import writepvpfile
@@ -31,6 +32,19 @@ class base(object):
         self.batchSize = params['batchSize']
         self.writeStep = params['writeStep']
         self.progress = params['progress']
+        #Loads each batch into a graph resident double buffer instead of feeding it every step
+        self.stageInput = params.get('stageInput', False)
+        #Stops encoding early once the relative change in V1_A (or energy) drops below stopTol,
+        #checked every stopPeriod steps. displayPeriod is the hard cap on steps
+        self.stopTol = params.get('stopTol', None)
+        self.stopPeriod = params.get('stopPeriod', 10)
+        self.stopMetric = params.get('stopMetric', 'A')
+        #If False, per batch solver state (batchStateVars, e.g. V1_A) is not restored from loadFile,
+        #so a model can be loaded with a different batchSize than it was trained with (e.g. for evalSet)
+        self.loadBatchState = params.get('loadBatchState', True)
+        #Session thread pool sizes, 0 lets tensorflow pick (e.g. set per process by shard_eval)
+        self.intraOpThreads = params.get('intraOpThreads', 0)
+        self.interOpThreads = params.get('interOpThreads', 0)
 
     #Make approperiate directories if they don't exist
     def makeDirs(self):
@@ -49,10 +63,22 @@ class base(object):
         config = tf.ConfigProto()
         config.gpu_options.allow_growth=True
         config.allow_soft_placement=True
+        config.intra_op_parallelism_threads=self.intraOpThreads
+        config.inter_op_parallelism_threads=self.interOpThreads
         self.sess = tf.Session(config=config)
         self.dataObj = dataObj
         self.inputShape = self.dataObj.inputShape
+        self.stagedBuffers = []
+        self.stageThread = None
+        self.stageFlag = None
+        #Variables with a batch dimension, set by buildModel
+        self.batchStateVars = []
+        #1 for the rows of the batch holding real data, see setValidRows
+        with tf.device(self.device):
+            self.rowMask = tf.Variable(tf.ones([self.batchSize]), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="rowMask")
+            self.rowMask4d = tf.reshape(self.rowMask, [self.batchSize, 1, 1, 1])
         self.buildModel(self.dataObj.inputShape)
+        self.buildRowMaskOps()
         self.initialize()
         self.writeSummary()
 
@@ -76,11 +102,34 @@ class base(object):
            self.loadModel()
 
     def getLoadVars(self):
-        return tf.global_variables()
+        if(self.loadBatchState):
+            return tf.global_variables()
+        batchStateNames = [v.name for v in self.batchStateVars]
+        return [v for v in tf.global_variables() if v.name not in batchStateNames]
+
+    #Padded rows of a partial batch (see evalData) are held at zero: their input is blank, so a zero state
+    #gets a zero gradient and stays zero. They then add nothing to batch wide reductions (e.g. FISTA's
+    #restart test or the stop check), so codes of the real rows don't depend on the padding
+    #Solvers multiply their random batch state resets by rowMask4d
+    def buildRowMaskOps(self):
+        self.inRowMask = tf.placeholder(tf.float32, [self.batchSize], name="inRowMask")
+        self.setRowMask = self.rowMask.assign(self.inRowMask)
+        self.maskBatchState = tf.group(*[v.assign(v * tf.reshape(self.rowMask, [self.batchSize] + [1]*(len(v.get_shape())-1)))
+            for v in self.batchStateVars])
+
+    #Marks the first numValid rows of the batch as real data and zeros the batch state of the rest
+    def setValidRows(self, numValid):
+        mask = np.zeros((self.batchSize), dtype=np.float32)
+        mask[:numValid] = 1
+        self.sess.run(self.setRowMask, feed_dict={self.inRowMask: mask})
+        if(numValid < self.batchSize):
+            self.sess.run(self.maskBatchState)
 
     #Initializes session.
     def initSess(self):
         self.sess.run(tf.global_variables_initializer())
+        #Staging buffers are local variables so they stay out of checkpoints
+        self.sess.run(tf.local_variables_initializer())
 
     def closeSess(self):
         self.sess.close()
@@ -90,4 +139,134 @@ class base(object):
         self.loader.restore(self.sess, self.loadFile)
         print("Model %s loaded" % self.loadFile)
 
+    #Exports the dictionary as a numpy file, e.g. for infer/np_encode.py
+    def writeNpyWeights(self, filename):
+        np.save(filename, self.sess.run(self.V1_W))
+
+
+
+    #Creates an input node for the model. In staged mode, the node defaults to the front of a
+    #graph resident double buffer that is loaded once per batch, so solver steps don't need to feed it.
+    #Feeding the node still overrides the buffer (e.g., in evalData)
+    def stagedInput(self, shape, inName, default=None):
+        if(not self.stageInput):
+            if(default is None):
+                return node_variable(shape, inName)
+            return tf.placeholder_with_default(default, shape, name=inName)
+
+        with tf.name_scope("stage"):
+            if(self.stageFlag is None):
+                #Which buffer is the front buffer
+                self.stageFlag = tf.Variable(0, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="stageFlag")
+                self.flipStage = self.stageFlag.assign(1 - self.stageFlag)
+                self.frontIdx = 0
+            bufs = [tf.Variable(tf.zeros(shape), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name=inName+"Buf"+str(i)) for i in range(2)]
+            loadVal = node_variable(shape, inName+"Load")
+            loadOps = [b.assign(loadVal) for b in bufs]
+            front = tf.cond(tf.equal(self.stageFlag, 0), lambda: tf.identity(bufs[0]), lambda: tf.identity(bufs[1]))
+        self.stagedBuffers.append((loadVal, loadOps))
+        return tf.placeholder_with_default(front, shape, name=inName)
+
+    #Returns feedDict, or nothing to feed if inputs are staged
+    def inputFeedDict(self, feedDict):
+        if(self.stageInput):
+            return {}
+        return feedDict
+
+    #Gets one batch from the data object. Tuples (e.g., data and mask) map to staged inputs in creation order
+    def getBatch(self):
+        return self.dataObj.getData(self.batchSize)
+
+    #Gets the first training batch, loading it into the front buffer if staging
+    #The stage thread isn't started here, so an object only used for evalSet never prefetches
+    def firstBatch(self):
+        data = self.getBatch()
+        if(self.stageInput):
+            self.loadStaged(self.frontIdx, data)
+        return data
+
+    #Starts loading the next batch into the back buffer, if staging and not already loading
+    #Only the training loop (runModel and nextBatch) starts staging
+    def startStage(self):
+        if(self.stageInput and self.stageThread is None):
+            self.launchStage()
+
+    #Waits for the stage thread, so the data object can be read from this thread (e.g. in evalSet)
+    #A batch already loaded by the thread is dropped
+    def stopStage(self):
+        if(self.stageThread is not None):
+            self.stageThread.join()
+            self.stageThread = None
+
+    #Gets the next training batch. If staging, this swaps in the batch that was loaded
+    #into the back buffer while the current one was being encoded
+    def nextBatch(self):
+        if(not self.stageInput):
+            return self.getBatch()
+        self.startStage()
+        self.stageThread.join()
+        self.sess.run(self.flipStage)
+        self.frontIdx = 1 - self.frontIdx
+        data = self.stagedData
+        self.launchStage()
+        return data
+
+    def loadStaged(self, bufIdx, data):
+        if(not isinstance(data, tuple)):
+            data = (data,)
+        assert(len(data) == len(self.stagedBuffers))
+        feedDict = {}
+        loadOps = []
+        for ((loadVal, bufLoadOps), d) in zip(self.stagedBuffers, data):
+            feedDict[loadVal] = d
+            loadOps.append(bufLoadOps[bufIdx])
+        self.sess.run(loadOps, feed_dict=feedDict)
+
+    def __stageData__(self):
+        self.stagedData = self.getBatch()
+        self.loadStaged(1 - self.frontIdx, self.stagedData)
+
+    #Loads the next batch into the back buffer in the background
+    def launchStage(self):
+        self.stageThread = threading.Thread(target=self.__stageData__)
+        self.stageThread.setDaemon(True)
+        self.stageThread.start()
+
+    #Builds the in graph convergence check for early stopping
+    #Monitors V1_A or the energy, depending on stopMetric
+    def buildStopCheck(self):
+        if(self.stopMetric == 'A'):
+            value = self.V1_A
+        elif(self.stopMetric == 'energy'):
+            value = self.loss
+        else:
+            print("Error: stopMetric", self.stopMetric, "not recognized")
+            assert(0)
+
+        with tf.name_scope("stopCheck"):
+            stopPrev = tf.Variable(tf.zeros(value.get_shape()), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="stopPrev")
+            stopDelta = tf.sqrt(tf.reduce_sum(tf.square(value - stopPrev)))/(tf.sqrt(tf.reduce_sum(tf.square(stopPrev))) + 1e-8)
+            #Store value for the next check only after the change has been computed
+            with tf.control_dependencies([stopDelta]):
+                updatePrev = stopPrev.assign(value)
+            with tf.control_dependencies([updatePrev]):
+                self.stopCheck = tf.identity(stopDelta)
+            self.resetStopCheck = stopPrev.assign(tf.zeros(value.get_shape()))
+
+    def resetConverged(self):
+        self.sess.run(self.resetStopCheck)
+        self.numStopChecks = 0
+
+    #Returns True if encoding has converged. The first check after a reset only stores the reference value
+    def checkConverged(self, feedDict):
+        delta = self.sess.run(self.stopCheck, feed_dict=feedDict)
+        self.numStopChecks += 1
+        return (self.numStopChecks > 1 and delta < self.stopTol)
 
+    #Stores and reports the number of encoding steps used on the current batch
+    def reportEncodeSteps(self, numSteps):
+        self.encodeSteps = numSteps
+        summary = tf.Summary(value=[tf.Summary.Value(tag="encode_steps", simple_value=numSteps)])
+        self.train_writer.add_summary(summary, self.timestep)
+        if(numSteps < self.displayPeriod):
+            print("Converged after", numSteps, "steps")
@@ -0,0 +1,70 @@
+import numpy as np
+import threading
+import queue
+import traceback
+from scipy import sparse
+from .utils import convertToSparse4d
+#Using pvp files for saving
+from pvtools import pvpOpen
+
+#Writes code batches from evalSet to a pvp file on a background thread
+#write only queues the batch, and the thread does any sparse conversion and the file
+#appends, so the session can encode the next batch meanwhile (session runs release the GIL)
+#Batches are gathered into chunks of chunkSize batches, written with one pvFile.write call
+#At most queueDepth batches are waiting, so write blocks if the disk falls behind
+class pvpCodeWriter(object):
+    def __init__(self, outFilename, shape, chunkSize=8, queueDepth=4):
+        self.pvFile = pvpOpen(outFilename, 'w')
+        #[ny, nx, nf] of each frame
+        self.shape = shape
+        self.chunkSize = chunkSize
+        self.queue = queue.Queue(maxsize=queueDepth)
+        self.failed = False
+        self.thread = threading.Thread(target=self.__writer__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __writer__(self):
+        chunkValues = []
+        chunkTime = []
+        try:
+            while True:
+                item = self.queue.get()
+                if(item is not None):
+                    (v1, time) = item
+                    if(not sparse.issparse(v1)):
+                        v1 = convertToSparse4d(v1)
+                    chunkValues.append(v1)
+                    chunkTime.extend(time)
+                if(len(chunkValues) > 0 and (item is None or len(chunkValues) >= self.chunkSize)):
+                    data = {"values":sparse.vstack(chunkValues, format="csr"), "time":chunkTime}
+                    self.pvFile.write(data, shape=self.shape)
+                    chunkValues = []
+                    chunkTime = []
+                if(item is None):
+                    return
+        except Exception:
+            traceback.print_exc()
+            self.failed = True
+            #Keep draining so write and close don't block
+            while(self.queue.get() is not None):
+                pass
+
+    def checkFailed(self):
+        if(self.failed):
+            print("Error: pvpCodeWriter background writer failed")
+            assert(0)
+
+    #v1 is either a dense [batch, ny, nx, nf] array or a [batch, ny*nx*nf] csr matrix
+    #(see evalData's returnSparse), and time is a list of the batch's frame times
+    #v1 must not be modified after this call
+    def write(self, v1, time):
+        self.checkFailed()
+        self.queue.put((v1, list(time)))
+
+    #Flushes the remaining batches and closes the file
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.pvFile.close()
+        self.checkFailed()
@@ -0,0 +1,165 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import queue
+import random
+import traceback
+
+#Data parallel dictionary learning on one machine (e.g. for LCA_ADAM)
+#numWorkers processes each build their own model and data object. Every iteration, each worker loads
+#the current dictionary from shared memory, encodes its own batch, and writes its gradient of the loss
+#wrt V1_W back to shared memory. The model in the calling process acts as a local parameter server:
+#it averages the gradients, applies them with its optimizer, renormalizes, and publishes the new dictionary.
+#The effective batch is numWorkers*batchSize.
+
+#solverCls must provide computeGradW, loadW, trainWFromGrad and normWeights (see LCA_ADAM)
+#Workers are spawned, not forked, since the calling process already has a tensorflow session.
+#Only workers load data. Each reports its data object's inputShape at startup, the coordinator model is
+#built on a shapeOnlyData, and the shared buffers are then created and sent to the workers by name
+
+#Stand in data object for the coordinator, which never encodes
+#getData returns zero (data, mask) batches, as LCA_ADAM's firstBatch expects
+class shapeOnlyData(object):
+    def __init__(self, inputShape):
+        self.inputShape = inputShape
+
+    def getData(self, batchSize):
+        shape = (batchSize, self.inputShape[0], self.inputShape[1], self.inputShape[2])
+        return (np.zeros(shape, dtype=np.float32), np.ones(shape, dtype=np.float32))
+
+#Worker process w
+def train_worker(w, solverCls, params, dataObjCls, dataArgs, dataKwargs, seed, startQ, doneQ):
+    try:
+        #Different data order in each worker
+        random.seed(seed + w)
+        np.random.seed((seed + w) % (2**32))
+        dataObj = dataObjCls(*dataArgs, **dataKwargs)
+        solver = solverCls(params, dataObj)
+        doneQ.put((w, list(dataObj.inputShape)))
+        #Names of the shared dictionary and of this worker's gradient buffer
+        (wName, gradName) = startQ.get()
+        shmW = shared_memory.SharedMemory(name=wName)
+        shmGrad = shared_memory.SharedMemory(name=gradName)
+        npW = np.ndarray(solver.WShape, dtype=np.float32, buffer=shmW.buf)
+        npGrad = np.ndarray(solver.WShape, dtype=np.float32, buffer=shmGrad.buf)
+        while True:
+            if(startQ.get() is None):
+                break
+            solver.loadW(npW)
+            npGrad[...] = solver.computeGradW()
+            doneQ.put((w, None))
+        del npW, npGrad
+        shmW.close()
+        shmGrad.close()
+        solver.closeSess()
+    except Exception:
+        traceback.print_exc()
+        doneQ.put((-1, None))
+
+#Stops every worker still running
+def stop_workers(workers):
+    for p in workers:
+        if(p.is_alive()):
+            p.terminate()
+    for p in workers:
+        p.join()
+
+#Stops every worker still running and fails
+def fail_workers(workers, msg):
+    stop_workers(workers)
+    print("Error: data parallel", msg)
+    assert(0)
+
+#Gets numMsgs messages (one per worker by default) from doneQ, as a list of (w, payload)
+#Fails if a worker reports an error or exits without reporting, checked every pollTimeout seconds
+def wait_workers(doneQ, workers, numMsgs=None, pollTimeout=10):
+    if(numMsgs is None):
+        numMsgs = len(workers)
+    msgs = []
+    while(len(msgs) < numMsgs):
+        try:
+            (w, payload) = doneQ.get(timeout=pollTimeout)
+        except queue.Empty:
+            dead = [k for (k, p) in enumerate(workers) if not p.is_alive()]
+            if(len(dead) > 0):
+                fail_workers(workers, "workers " + str(dead) + " exited")
+            continue
+        if(w < 0):
+            fail_workers(workers, "worker failed")
+        msgs.append((w, payload))
+    return msgs
+
+#Trains solverCls(params, dataObjCls(*dataArgs, **dataKwargs)) for params['numIterations'] iterations
+#Returns the coordinator model, which holds the trained dictionary
+#Worker 0 builds its data object before the others start, so a cache the data object builds on first use
+#(e.g. obspySeismicData's gridCacheFile) is built once and then loaded by the other workers
+def data_parallel_train(solverCls, params, dataObjCls, dataArgs, numWorkers, dataKwargs=None):
+    if(dataKwargs is None):
+        dataKwargs = {}
+    ctx = mp.get_context('spawn')
+    startQs = [ctx.Queue() for w in range(numWorkers)]
+    doneQ = ctx.Queue()
+    seed = random.randint(0, 2**31)
+    workers = []
+    shms = []
+    try:
+        shapes = []
+        for w in range(numWorkers):
+            workerParams = dict(params)
+            #Separate run directories so workers don't share summaries and plots
+            workerParams['runDir'] = params['runDir'] + "worker" + str(w) + "/"
+            #Not daemonic, so workers can start their own processes (e.g. a file reading pool)
+            #Workers are stopped explicitly if anything fails
+            p = ctx.Process(target=train_worker, args=(w, solverCls, workerParams, dataObjCls, dataArgs, dataKwargs, seed,
+                startQs[w], doneQ))
+            p.start()
+            workers.append(p)
+            if(w == 0):
+                shapes += [shape for (k, shape) in wait_workers(doneQ, workers)]
+        shapes += [shape for (k, shape) in wait_workers(doneQ, workers, numWorkers-1)]
+        if(any(shape != shapes[0] for shape in shapes)):
+            fail_workers(workers, "workers have different input shapes " + str(shapes))
+        #Coordinator, only its dictionary and optimizer state are used
+        solver = solverCls(params, shapeOnlyData(shapes[0]))
+
+        numBytes = int(np.prod(solver.WShape))*4
+        shms = [shared_memory.SharedMemory(create=True, size=numBytes) for w in range(numWorkers+1)]
+        (shmW, shmGrads) = (shms[0], shms[1:])
+        npW = np.ndarray(solver.WShape, dtype=np.float32, buffer=shmW.buf)
+        npGrads = [np.ndarray(solver.WShape, dtype=np.float32, buffer=g.buf) for g in shmGrads]
+        for w in range(numWorkers):
+            startQs[w].put((shmW.name, shmGrads[w].name))
+
+        #Normalize weights to start
+        solver.normWeights()
+        gradW = np.zeros(solver.WShape, dtype=np.float32)
+        for i in range(solver.numIterations):
+            #Publish dictionary, workers are idle until they are started
+            npW[...] = solver.sess.run(solver.V1_W)
+            for q in startQs:
+                q.put(i)
+            wait_workers(doneQ, workers)
+            #Each worker's loss is a mean over its batch, so the mean gradient is the gradient over all batches
+            gradW.fill(0)
+            for g in npGrads:
+                gradW += g
+            gradW /= numWorkers
+            solver.trainWFromGrad(gradW)
+            solver.normWeights()
+            solver.timestep += solver.displayPeriod
+            if(i%solver.savePeriod == 0):
+                save_path = solver.saver.save(solver.sess, solver.saveFile, global_step=solver.timestep, write_meta_graph=False)
+                print("Model saved in file: %s" % save_path)
+
+        for q in startQs:
+            q.put(None)
+        for p in workers:
+            p.join()
+        del npW, npGrads
+    finally:
+        #Workers aren't daemonic, so any that are still running (e.g. after an error here) must be stopped
+        stop_workers(workers)
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return solver
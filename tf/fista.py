@@ -4,9 +4,10 @@ import tensorflow as tf
 from base import base
 from plots.plotWeights import plot_weights
 from plots.plotRecon import plotRecon
-from .utils import sparse_weight_variable, weight_variable, node_variable, conv2d, conv2d_oneToMany, convertToSparse4d, save_sparse_csr
+from .utils import sparse_weight_variable, weight_variable, node_variable, conv2d, conv2d_oneToMany, active_atom_indices, active_conv2d_oneToMany, active_conv2d, conv_power_iteration, convertToSparse4d, save_sparse_csr, sparse_fetch_ops, sparse_fetch_to_csr, pad_batch
 #Using pvp files for saving
 from pvtools import *
+from .code_writer import pvpCodeWriter
 
 class FISTA(base):
     #Sets dictionary of params to member variables
@@ -20,10 +21,22 @@ class FISTA(base):
         self.VStrideX = params['VStrideX']
         self.patchSizeY = params['patchSizeY']
         self.patchSizeX = params['patchSizeX']
+        #Sets the step size to 1/L, with the Lipschitz constant L estimated from the dictionary by power iteration
+        self.autoStepA = params.get('autoStepA', False)
+        self.powerIters = params.get('powerIters', 10)
+        #Adaptive restart of momentum, either None, 'gradient' or 'function'
+        self.restart = params.get('restart', None)
+        #Restricts all but every activeSetPeriod-th step to the nonzero coefficients, 0 disables
+        self.activeSetPeriod = params.get('activeSetPeriod', 0)
+        #Active steps are only used while the working set is at most this fraction of the coefficients,
+        #since past that the gathers and scatters cost more than the dense convolutions
+        self.activeSetMaxFraction = params.get('activeSetMaxFraction', .05)
 
     def runModel(self):
         #Normalize weights to start
         self.normWeights()
+        #Load the next batch in the background while the first is encoded
+        self.startStage()
 
         #Training
         for i in range(self.numIterations):
@@ -38,7 +51,10 @@ class FISTA(base):
     #Constructor takes inputShape, which is a 3 tuple (ny, nx, nf) based on the size of the image being fed in
     def __init__(self, params, dataObj):
         super(FISTA, self).__init__(params, dataObj)
-        self.currImg = self.dataObj.getData(self.batchSize)
+        self.currImg = self.firstBatch()
+        if(self.autoStepA):
+            #Power iteration starts from a random vector here, so run it longer
+            self.sess.run(self.updateLipschitz, feed_dict={self.numPowerIters: 10*self.powerIters})
 
     #Builds the model. inMatFilename should be the vgg file
     def buildModel(self, inputShape):
@@ -54,7 +70,7 @@ class FISTA(base):
         with tf.device(self.device):
             with tf.name_scope("inputOps"):
                 #Get convolution variables as placeholders
-                self.inputImage = node_variable(self.imageShape, "inputImage")
+                self.inputImage = self.stagedInput(self.imageShape, "inputImage")
                 #Scale inputImage
                 self.scaled_inputImage = self.inputImage/np.sqrt(self.patchSizeX*self.patchSizeY*inputShape[2])
 
@@ -65,6 +81,19 @@ class FISTA(base):
                 self.normVals = tf.sqrt(tf.reduce_sum(tf.square(self.V1_W), reduction_indices=[0, 1, 2], keep_dims=True))
                 self.normalize_W = self.V1_W.assign(self.V1_W/(self.normVals + 1e-8))
 
+            with tf.name_scope("StepSize"):
+                if(self.autoStepA):
+                    #Warm started power iteration vector for a single image, kept out of checkpoints
+                    self.powerV = tf.Variable(tf.truncated_normal((1, V_Y, V_X, self.numV)), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="powerV")
+                    self.lipschitz = tf.Variable(1.0/self.learningRateA, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="lipschitz")
+                    self.numPowerIters = tf.placeholder_with_default(self.powerIters, shape=[], name="numPowerIters")
+                    (newPowerV, eig) = conv_power_iteration(self.powerV, self.V1_W, (1,)+self.imageShape[1:], self.VStrideY, self.VStrideX, self.numPowerIters)
+                    #reconError is a batch mean of squared errors, so its gradient is Lipschitz with 2/batchSize * ||D||^2
+                    self.updateLipschitz = tf.group(self.powerV.assign(newPowerV), self.lipschitz.assign(2*eig/self.batchSize))
+                    self.stepA = 1/self.lipschitz
+                else:
+                    self.stepA = self.learningRateA
+
             with tf.name_scope("FISTA"):
                 #Soft threshold
                 self.V1_A = weight_variable(self.VShape, "V1_A", 1e-3)
@@ -73,11 +102,13 @@ class FISTA(base):
 
                 self.oldA = weight_variable(self.VShape, "oldA", 1e-3)
                 self.oldY = weight_variable(self.VShape, "oldY", 1e-3)
+                #Per batch state, sized by batchSize
+                self.batchStateVars = [self.V1_A, self.V1_Y, self.oldA, self.oldY]
                 self.oldT = tf.Variable(1.0, "oldT")
 
                 self.randV1 = tf.truncated_normal(self.VShape, mean=0, stddev=1e-3)
                 #Reassign nodes
-                self.resetV1 = self.V1_A.assign(self.randV1)
+                self.resetV1 = self.V1_A.assign(self.randV1 * self.rowMask4d)
                 self.resetT = self.T.assign(1.0)
                 self.resetY = self.V1_Y.assign(self.V1_A)
 
@@ -103,17 +134,41 @@ class FISTA(base):
                 #        var_list=[
                 #            self.V1_A
                 #        ])
-                self.reconGrad = self.learningRateA * tf.gradients(self.reconError, [self.V1_A])[0]
+                self.reconGrad = self.stepA * tf.gradients(self.reconError, [self.V1_A])[0]
 
                 #Store old values in tensors
                 #This is to avoid updating a variable too early to affect new values
-                self.optimizerA0 = tf.tuple([
-                    self.oldA.assign(self.V1_A),
-                    self.oldT.assign(self.T),
-                    self.oldY.assign(self.V1_Y),
-                ])
+                if(self.restart is None):
+                    self.optimizerA0 = tf.tuple([
+                        self.oldA.assign(self.V1_A),
+                        self.oldT.assign(self.T),
+                        self.oldY.assign(self.V1_Y),
+                    ])
+                else:
+                    #Energy at oldA
+                    self.prevLoss = tf.Variable(np.float32(np.inf), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="prevLoss")
+                    #V1_A is x_k, oldA is x_(k-1), and oldY is the y_(k-1) that x_k was computed from
+                    if(self.restart == 'gradient'):
+                        self.doRestart = tf.reduce_sum((self.oldY - self.V1_A)*(self.V1_A - self.oldA)) > 0
+                    elif(self.restart == 'function'):
+                        self.doRestart = self.loss > self.prevLoss
+                    else:
+                        print("Error: restart", self.restart, "not recognized")
+                        assert(0)
+                    #Restarting drops the momentum term for the next step
+                    restartY = tf.cond(self.doRestart, lambda: tf.identity(self.V1_A), lambda: tf.identity(self.V1_Y))
+                    restartT = tf.cond(self.doRestart, lambda: tf.constant(1.0), lambda: tf.identity(self.T))
+                    with tf.control_dependencies([self.doRestart]):
+                        self.optimizerA0 = tf.tuple([
+                            self.oldA.assign(self.V1_A),
+                            self.oldT.assign(restartT),
+                            self.oldY.assign(restartY),
+                            self.prevLoss.assign(self.loss),
+                        ])
+                    #Makes sure the first step on a new batch never restarts
+                    self.resetRestart = tf.group(self.oldA.assign(self.V1_A), self.oldY.assign(self.V1_A), self.prevLoss.assign(np.inf))
 
-                self.newA = tf.nn.relu(tf.abs(self.oldY - self.reconGrad) - self.thresh*self.learningRateA) * tf.sign(self.oldA)
+                self.newA = tf.nn.relu(tf.abs(self.oldY - self.reconGrad) - self.thresh*self.stepA) * tf.sign(self.oldA)
                 self.newT = (1+tf.sqrt(4*tf.square(self.oldT)))/2
                 self.newY = self.newA + ((self.oldT-1)/(self.newT+1e-8))*(self.newA-self.oldA)
 
@@ -128,8 +183,42 @@ class FISTA(base):
                             self.V1_W
                         ])
 
+            if(self.activeSetPeriod):
+                #Restart checks compare against the previous step's dense state
+                assert(self.restart is None)
+                with tf.name_scope("ActiveOpt"):
+                    #Working set of coefficients, refreshed by a dense step every activeSetPeriod steps
+                    #The shrinkage keeps zeros of A at zero, so only the nonzeros of A and Y can change until the next dense step
+                    self.V1_ws = tf.Variable(tf.ones(self.VShape), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="V1_ws")
+                    #Evaluates to the fraction of the real rows' coefficients in the working set
+                    self.updateWs = tf.reduce_sum(self.V1_ws.assign(tf.cast(tf.logical_or(tf.not_equal(self.V1_A, 0), tf.not_equal(self.V1_Y, 0)), tf.float32)) * self.rowMask4d)/(tf.reduce_sum(self.rowMask)*np.prod(self.VShape[1:]))
+                    wsIdx = tf.where(tf.not_equal(self.V1_ws, 0))
+                    #Atom element indices of the working set, built once for both the recon and its adjoint
+                    wsAtomIdx = active_atom_indices(wsIdx, self.WShape, self.imageShape, self.VStrideY, self.VStrideX)
+                    #Same update as optimizerA0 followed by optimizerA, restricted to the working set
+                    wsA = tf.gather_nd(self.V1_A, wsIdx)
+                    wsY = tf.gather_nd(self.V1_Y, wsIdx)
+                    #A is zero outside the working set, so this is the full reconstruction from A
+                    activeRecon = active_conv2d_oneToMany(wsIdx, wsAtomIdx, wsA, self.V1_W, self.imageShape)
+                    activeError = self.scaled_inputImage - activeRecon
+                    #Gradient of reconError wrt A, evaluated at A like reconGrad in the dense step
+                    wsGrad = -(2.0/self.batchSize) * active_conv2d(wsIdx, wsAtomIdx, activeError, self.V1_W)
+                    newWsA = tf.nn.relu(tf.abs(wsY - self.stepA*wsGrad) - self.thresh*self.stepA) * tf.sign(wsA)
+                    activeNewT = (1+tf.sqrt(4*tf.square(self.T)))/2
+                    newWsY = newWsA + ((self.T-1)/(activeNewT+1e-8))*(newWsA-wsA)
+                    #T is only updated after newWsY has read it
+                    with tf.control_dependencies([newWsY]):
+                        activeUpdateT = self.T.assign(activeNewT)
+                    self.activeOptimizerA = tf.tuple([
+                        tf.scatter_nd_update(self.V1_A, wsIdx, newWsA),
+                        tf.scatter_nd_update(self.V1_Y, wsIdx, newWsY),
+                        activeUpdateT,
+                    ])
+
             with tf.name_scope("stats"):
                 self.nnz = tf.reduce_mean(tf.cast(tf.not_equal(self.V1_A, 0), tf.float32))
+                #Nonzeros of V1_A, fetched by evalData instead of the dense array
+                (self.V1_A_rowCounts, self.V1_A_indices, self.V1_A_values) = sparse_fetch_ops(self.V1_A)
 
                 self.errorStd = tf.sqrt(tf.reduce_mean(tf.square(self.error-tf.reduce_mean(self.error))))*np.sqrt(self.patchSizeY*self.patchSizeX*inputShape[2])
                 self.l1_mean = tf.reduce_mean(tf.abs(self.V1_A))
@@ -139,6 +228,9 @@ class FISTA(base):
                 #For log of activities
                 self.log_V1_A = tf.log(tf.abs(self.V1_A)+1e-15)
 
+            if(self.stopTol is not None):
+                self.buildStopCheck()
+
         #Summaries
         self.s_loss = tf.scalar_summary('loss', self.loss, name="lossSum")
         self.s_recon = tf.scalar_summary('recon error', self.reconError, name="reconError")
@@ -155,28 +247,46 @@ class FISTA(base):
         self.h_log_v1_a = tf.histogram_summary('Log_V1_A', self.log_V1_A, name="Log_V1_A")
 
         self.h_normVals = tf.histogram_summary('normVals', self.normVals, name="normVals")
+        if(self.autoStepA):
+            self.s_lipschitz = tf.scalar_summary('lipschitz', self.lipschitz, name="lipschitz")
 
     def encodeImage(self, feedDict):
         #Reset all vars
         self.sess.run(self.resetV1)
         self.sess.run(self.resetY)
         self.sess.run(self.resetT)
+        if(self.restart is not None):
+            self.sess.run(self.resetRestart)
+        if(self.stopTol is not None):
+            self.resetConverged()
 
+        numSteps = self.displayPeriod
         for i in range(self.displayPeriod):
             #Run optimizer
-            self.sess.run(self.optimizerA0, feed_dict=feedDict)
-            self.sess.run(self.optimizerA, feed_dict=feedDict)
+            if(self.activeSetPeriod and i%self.activeSetPeriod != 0 and useActive):
+                self.sess.run(self.activeOptimizerA, feed_dict=feedDict)
+            else:
+                self.sess.run(self.optimizerA0, feed_dict=feedDict)
+                self.sess.run(self.optimizerA, feed_dict=feedDict)
+                if(self.activeSetPeriod):
+                    useActive = self.sess.run(self.updateWs) <= self.activeSetMaxFraction
             self.timestep+=1
             if((i+1)%self.writeStep == 0):
                 summary = self.sess.run(self.mergedSummary, feed_dict=feedDict)
                 self.train_writer.add_summary(summary, self.timestep)
             if((i+1)%self.progress == 0):
                 print("Timestep ", self.timestep)
+            if(self.stopTol is not None and (i+1)%self.stopPeriod == 0):
+                if(self.checkConverged(feedDict)):
+                    numSteps = i+1
+                    break
+        if(self.stopTol is not None):
+            self.reportEncodeSteps(numSteps)
 
     #Trains model for numSteps
     def trainA(self, save):
         #Define session
-        feedDict = {self.inputImage: self.currImg}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg})
         self.encodeImage(feedDict)
 
         if(save):
@@ -186,9 +296,12 @@ class FISTA(base):
     def normWeights(self):
         #Normalize weights
         self.sess.run(self.normalize_W)
+        #Dictionary changed, so refresh the step size
+        if(self.autoStepA):
+            self.sess.run(self.updateLipschitz)
 
     def trainW(self):
-        feedDict = {self.inputImage: self.currImg}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg})
 
         #Visualization
         if (self.plotTimestep % self.plotPeriod == 0):
@@ -202,44 +315,59 @@ class FISTA(base):
         #Update weights
         self.sess.run(self.optimizerW, feed_dict=feedDict)
         #New image
-        self.currImg = self.dataObj.getData(self.batchSize)
+        self.currImg = self.nextBatch()
         self.plotTimestep += 1
 
 
     #Finds sparse encoding of inData
     #inData must be in the shape of the image
     #[batch, nY, nX, nF]
-    def evalData(self, inData):
+    def evalData(self, inData, returnSparse=False):
         (nb, ny, nx, nf) = inData.shape
-        #Check size
-        assert(nb == self.batchSize)
+        #Check size, smaller batches (e.g. the last batch of evalSet) are padded below
+        assert(nb <= self.batchSize)
         assert(ny == self.inputShape[0])
         assert(nx == self.inputShape[1])
         assert(nf == self.inputShape[2])
+        #The graph batch size is fixed, so blank images fill the rest of the batch and their codes are dropped
+        inData = pad_batch(inData, self.batchSize)
+        #Padded rows are held at zero so they don't change the real rows' codes
+        self.setValidRows(nb)
 
         feedDict = {self.inputImage: inData}
         self.encodeImage(feedDict)
+        self.setValidRows(self.batchSize)
+        if(returnSparse):
+            #Only the nonzeros of thresholded v1 are fetched, as a [batch, ny*nx*nf] csr matrix
+            (rowCounts, indices, values) = self.sess.run([self.V1_A_rowCounts, self.V1_A_indices, self.V1_A_values])
+            return sparse_fetch_to_csr(rowCounts, indices, values, int(np.prod(self.VShape[1:])))[:nb]
         #Get thresholded v1 as an output
         outVals = self.V1_A.eval(session=self.sess)
-        return outVals
+        return outVals[:nb]
 
-    def evalSet(self, evalDataObj, outFilename):
-        numImages = evalDataObj.numImages
+    #Frame times are image indices, starting at timeOffset
+    def evalSet(self, evalDataObj, outFilename, timeOffset=0):
+        #Number of images in the (possibly rangeIdx limited) list
+        numImages = evalDataObj.numData
         #skip must be 1 for now
         assert(evalDataObj.skip == 1)
+        #Batches are read here, so no stage thread may be reading the data object
+        self.stopStage()
         numIterations = int(np.ceil(float(numImages)/self.batchSize))
 
-        pvFile = pvpOpen(outFilename, 'w')
+        #Sparse conversion and file writes happen on a background thread
+        codeWriter = pvpCodeWriter(outFilename, (self.VShape[1], self.VShape[2], self.VShape[3]))
         for it in range(numIterations):
             print(str((float(it)*100)/numIterations) + "% done (" + str(it) + " out of " + str(numIterations) + ")")
             #Evaluate
-            npV1_A = self.evalData(self.currImg)
-            v1Sparse = convertToSparse4d(npV1_A)
-            time = range(it*self.batchSize, (it+1)*self.batchSize)
-            data = {"values":v1Sparse, "time":time}
-            pvFile.write(data, shape=(self.VShape[1], self.VShape[2], self.VShape[3]))
-            self.currImg = self.dataObj.getData(self.batchSize)
-        pvFile.close()
+            #Only the remaining images of the last batch are encoded, evalData holds the padded rows at zero
+            numValid = min(self.batchSize, numImages - it*self.batchSize)
+            v1Sparse = self.evalData(self.currImg[:numValid], returnSparse=True)
+            time = range(timeOffset + it*self.batchSize, timeOffset + it*self.batchSize + numValid)
+            codeWriter.write(v1Sparse, time)
+            if(it+1 < numIterations):
+                self.currImg = self.dataObj.getData(self.batchSize)
+        codeWriter.close()
 
     def writePvpWeights(self, outputPrefix, rect=False):
         npw = self.sess.run(self.V1_W)
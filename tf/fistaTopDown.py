@@ -21,6 +21,11 @@ class FISTATopDown(base):
         self.patchSizeY = params['patchSizeY']
         self.patchSizeX = params['patchSizeX']
         self.numLayers = params['numLayers']
+        #Sets each layer's step size to 1/L, with the Lipschitz constant L estimated by power iteration
+        self.autoStepA = params.get('autoStepA', False)
+        self.powerIters = params.get('powerIters', 10)
+        #Adaptive restart of momentum, either None, 'gradient' or 'function'
+        self.restart = params.get('restart', None)
 
     def runModel(self):
         #Normalize weights to start
@@ -40,6 +45,10 @@ class FISTATopDown(base):
     def __init__(self, params, dataObj):
         super(FISTATopDown, self).__init__(params, dataObj)
         self.currImg = self.dataObj.getData(self.batchSize)
+        if(self.autoStepA):
+            #Step sizes are needed before any encoding (e.g. eval only runs after a checkpoint load)
+            #Power iteration starts from a random vector here, so run it longer
+            self.sess.run(self.updateLipschitz, feed_dict={self.numPowerIters: 10*self.powerIters})
 
     #Builds the model. inMatFilename should be the vgg file
     def buildModel(self, inputShape):
@@ -78,6 +87,12 @@ class FISTATopDown(base):
             self.VShape = []
             self.inShape = []
 
+            self.stepA = []
+            self.lipschitz = []
+            updateLipschitzList = []
+            if(self.autoStepA):
+                self.numPowerIters = tf.placeholder_with_default(self.powerIters, shape=[], name="numPowerIters")
+
             for l in range(self.numLayers):
                 if l == 0:
                     numInF = inputShape[2]
@@ -111,6 +126,23 @@ class FISTATopDown(base):
                     self.normVals = tf.sqrt(tf.reduce_sum(tf.square(self.V1_W[l]), reduction_indices=[0, 1, 2], keep_dims=True))
                     self.normalize_W.append(self.V1_W[l].assign(self.V1_W[l]/(self.normVals+1e-8)))
 
+                with tf.name_scope("StepSize"):
+                    if(self.autoStepA):
+                        #Warm started power iteration vector for a single image, kept out of checkpoints
+                        powerV = tf.Variable(tf.truncated_normal((1,)+self.VShape[l][1:]), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="powerV"+str(l))
+                        lipschitz = tf.Variable(1.0/self.learningRateA[l], trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="lipschitz"+str(l))
+                        (newPowerV, eig) = conv_power_iteration(powerV, self.V1_W[l], (1,)+self.inShape[l][1:], self.VStrideY[l], self.VStrideX[l], self.numPowerIters)
+                        #reconLoss is half the batch mean of squared errors, so the gradient wrt V1_A[l] is Lipschitz with ||D_l||^2/batchSize,
+                        #plus 1/batchSize from V1_A[l] being the input of the layer above
+                        if(l < self.numLayers-1):
+                            eig = eig + 1
+                        updateLipschitzList.append(powerV.assign(newPowerV))
+                        updateLipschitzList.append(lipschitz.assign(eig/self.batchSize))
+                        self.lipschitz.append(lipschitz)
+                        self.stepA.append(1/lipschitz)
+                    else:
+                        self.stepA.append(self.learningRateA[l])
+
                 with tf.name_scope("FISTA"):
                     #Soft threshold
                     self.V1_A.append(weight_variable(self.VShape[l], "V1_A"+str(l), 1e-3))
@@ -179,18 +211,50 @@ class FISTATopDown(base):
 
                 #Store old values in tensors
                 #This is to avoid updating a variable too early to affect new values
-                assignList = []
-                for l in range(self.numLayers):
-                    assignList.append(self.oldA[l].assign(self.V1_A[l]))
-                    assignList.append(self.oldY[l].assign(self.V1_Y[l]))
-                assignList.append(self.oldT.assign(self.T))
-                self.optimizerA0 = tf.tuple(assignList)
+                if(self.restart is None):
+                    assignList = []
+                    for l in range(self.numLayers):
+                        assignList.append(self.oldA[l].assign(self.V1_A[l]))
+                        assignList.append(self.oldY[l].assign(self.V1_Y[l]))
+                    assignList.append(self.oldT.assign(self.T))
+                    self.optimizerA0 = tf.tuple(assignList)
+                else:
+                    #Energy at oldA
+                    self.prevLoss = tf.Variable(np.float32(np.inf), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="prevLoss")
+                    #V1_A is x_k, oldA is x_(k-1), and oldY is the y_(k-1) that x_k was computed from
+                    #Momentum is shared across layers, so all layers restart together
+                    if(self.restart == 'gradient'):
+                        restartDot = tf.add_n([tf.reduce_sum((self.oldY[l] - self.V1_A[l])*(self.V1_A[l] - self.oldA[l])) for l in range(self.numLayers)])
+                        self.doRestart = restartDot > 0
+                    elif(self.restart == 'function'):
+                        self.doRestart = self.loss > self.prevLoss
+                    else:
+                        print("Error: restart", self.restart, "not recognized")
+                        assert(0)
+                    #Restarting drops the momentum term for the next step
+                    assignList = []
+                    resetList = []
+                    with tf.control_dependencies([self.doRestart]):
+                        for l in range(self.numLayers):
+                            restartY = tf.cond(self.doRestart, lambda: tf.identity(self.V1_A[l]), lambda: tf.identity(self.V1_Y[l]))
+                            assignList.append(self.oldA[l].assign(self.V1_A[l]))
+                            assignList.append(self.oldY[l].assign(restartY))
+                        restartT = tf.cond(self.doRestart, lambda: tf.constant(1.0), lambda: tf.identity(self.T))
+                        assignList.append(self.oldT.assign(restartT))
+                        assignList.append(self.prevLoss.assign(self.loss))
+                    self.optimizerA0 = tf.tuple(assignList)
+                    #Makes sure the first step on a new batch never restarts
+                    for l in range(self.numLayers):
+                        resetList.append(self.oldA[l].assign(self.V1_A[l]))
+                        resetList.append(self.oldY[l].assign(self.V1_A[l]))
+                    resetList.append(self.prevLoss.assign(np.inf))
+                    self.resetRestart = tf.group(*resetList)
 
                 optimizerList = []
 
                 newT = (1+tf.sqrt(4*tf.square(self.oldT)))/2
                 for l in range(self.numLayers):
-                    newA = tf.nn.relu(tf.abs(self.oldY[l] - self.learningRateA[l] * self.reconGrads[l]) - self.thresh[l]*self.learningRateA[l]) * tf.sign(self.oldA[l])
+                    newA = tf.nn.relu(tf.abs(self.oldY[l] - self.stepA[l] * self.reconGrads[l]) - self.thresh[l]*self.stepA[l]) * tf.sign(self.oldA[l])
                     newY = newA + ((self.oldT-1)/(newT+1e-8))*(newA-self.oldA[l])
                     #We update actual variables
                     optimizerList.append(self.V1_Y[l].assign(newY))
@@ -208,6 +272,9 @@ class FISTATopDown(base):
 
                 self.optimizerW = tf.group(*optWList)
 
+                if(self.autoStepA):
+                    self.updateLipschitz = tf.group(*updateLipschitzList)
+
 
         with tf.name_scope("ReconVis"):
             self.visRecon = []
@@ -254,12 +321,16 @@ class FISTATopDown(base):
             self.h_v1_w = tf.histogram_summary('V1_W' + str(l), self.V1_W[l], name="V1_W")
             self.h_v1_a = tf.histogram_summary('V1_A' + str(l), self.V1_A[l], name="V1_A")
             self.h_log_v1_a = tf.histogram_summary('Log_V1_A' + str(l), self.log_V1_A[l], name="Log_V1_A")
+            if(self.autoStepA):
+                self.s_lipschitz = tf.scalar_summary('lipschitz' + str(l), self.lipschitz[l], name="lipschitz")
 
     def encodeImage(self, feedDict):
         #Reset all vars
         self.sess.run(self.resetV1)
         self.sess.run(self.resetY)
         self.sess.run(self.resetT)
+        if(self.restart is not None):
+            self.sess.run(self.resetRestart)
 
         for i in range(self.displayPeriod):
             #Run optimizer
@@ -286,6 +357,9 @@ class FISTATopDown(base):
         #Normalize weights
         for l in range(self.numLayers):
             self.sess.run(self.normalize_W[l])
+        #Dictionaries changed, so refresh the step sizes
+        if(self.autoStepA):
+            self.sess.run(self.updateLipschitz)
 
     def trainW(self):
         feedDict = {self.inputImage: self.currImg}
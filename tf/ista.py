@@ -4,7 +4,7 @@ import tensorflow as tf
 from base import base
 from plots.plotWeights import plot_weights
 from plots.plotRecon import plotRecon
-from .utils import sparse_weight_variable, weight_variable, node_variable, conv2d, conv2d_oneToMany, convertToSparse4d, save_sparse_csr
+from .utils import sparse_weight_variable, weight_variable, node_variable, conv2d, conv2d_oneToMany, active_atom_indices, active_conv2d_oneToMany, active_conv2d, convertToSparse4d, save_sparse_csr, sparse_fetch_ops, sparse_fetch_to_csr, pad_batch
 #Using pvp files for saving
 from pvtools import *
 
@@ -20,10 +20,17 @@ class ISTA(base):
         self.VStrideX = params['VStrideX']
         self.patchSizeY = params['patchSizeY']
         self.patchSizeX = params['patchSizeX']
+        #Restricts all but every activeSetPeriod-th step to the nonzero coefficients, 0 disables
+        self.activeSetPeriod = params.get('activeSetPeriod', 0)
+        #Active steps are only used while the working set is at most this fraction of the coefficients,
+        #since past that the gathers and scatters cost more than the dense convolutions
+        self.activeSetMaxFraction = params.get('activeSetMaxFraction', .05)
 
     def runModel(self):
         #Normalize weights to start
         self.normWeights()
+        #Load the next batch in the background while the first is encoded
+        self.startStage()
 
         #Training
         for i in range(self.numIterations):
@@ -39,7 +46,7 @@ class ISTA(base):
     #Constructor takes inputShape, which is a 3 tuple (ny, nx, nf) based on the size of the image being fed in
     def __init__(self, params, dataObj):
         super(ISTA, self).__init__(params, dataObj)
-        self.currImg = self.dataObj.getData(self.batchSize)
+        self.currImg = self.firstBatch()
 
     #Builds the model. inMatFilename should be the vgg file
     def buildModel(self, inputShape):
@@ -55,7 +62,7 @@ class ISTA(base):
         with tf.device(self.device):
             with tf.name_scope("inputOps"):
                 #Get convolution variables as placeholders
-                self.inputImage = node_variable(self.imageShape, "inputImage")
+                self.inputImage = self.stagedInput(self.imageShape, "inputImage")
                 #Scale inputImage
                 self.scaled_inputImage = self.inputImage/np.sqrt(self.patchSizeX*self.patchSizeY*inputShape[2])
 
@@ -69,9 +76,11 @@ class ISTA(base):
             with tf.name_scope("ISTA"):
                 #Soft threshold
                 self.V1_A = weight_variable(self.VShape, "V1_A", 1e-3)
+                #Per batch state, sized by batchSize
+                self.batchStateVars = [self.V1_A]
                 #Reinitializer
                 self.randV1 = tf.truncated_normal(self.VShape, mean=0, stddev=1e-3)
-                self.initV1 = self.V1_A.assign(self.randV1)
+                self.initV1 = self.V1_A.assign(self.randV1 * self.rowMask4d)
 
 
             with tf.name_scope("Recon"):
@@ -105,8 +114,29 @@ class ISTA(base):
                             self.V1_W
                         ])
 
+            if(self.activeSetPeriod):
+                with tf.name_scope("ActiveOpt"):
+                    #Working set of coefficients, refreshed by a dense step every activeSetPeriod steps
+                    #The shrinkage keeps zeros at zero, so the nonzeros are all that can change until the next dense step
+                    self.V1_ws = tf.Variable(tf.ones(self.VShape), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="V1_ws")
+                    #Evaluates to the fraction of the real rows' coefficients in the working set
+                    self.updateWs = tf.reduce_sum(self.V1_ws.assign(tf.cast(tf.not_equal(self.V1_A, 0), tf.float32)) * self.rowMask4d)/(tf.reduce_sum(self.rowMask)*np.prod(self.VShape[1:]))
+                    wsIdx = tf.where(tf.not_equal(self.V1_ws, 0))
+                    #Atom element indices of the working set, built once for both the recon and its adjoint
+                    wsAtomIdx = active_atom_indices(wsIdx, self.WShape, self.imageShape, self.VStrideY, self.VStrideX)
+                    #Same update as optimizerA, restricted to the working set
+                    wsA = tf.gather_nd(self.V1_A, wsIdx)
+                    activeRecon = active_conv2d_oneToMany(wsIdx, wsAtomIdx, wsA, self.V1_W, self.imageShape)
+                    activeError = self.scaled_inputImage - activeRecon
+                    #Gradient of reconError wrt A
+                    wsGrad = -(2.0/self.batchSize) * active_conv2d(wsIdx, wsAtomIdx, activeError, self.V1_W)
+                    newWsA = tf.nn.relu(tf.abs(wsA - self.learningRateA*wsGrad) - self.thresh*self.learningRateA) * tf.sign(wsA)
+                    self.activeOptimizerA = tf.scatter_nd_update(self.V1_A, wsIdx, newWsA)
+
             with tf.name_scope("stats"):
                 self.nnz = tf.reduce_mean(tf.cast(tf.not_equal(self.V1_A, 0), tf.float32))
+                #Nonzeros of V1_A, fetched by evalData instead of the dense array
+                (self.V1_A_rowCounts, self.V1_A_indices, self.V1_A_values) = sparse_fetch_ops(self.V1_A)
 
                 self.errorStd = tf.sqrt(tf.reduce_mean(tf.square(self.error-tf.reduce_mean(self.error))))*np.sqrt(self.patchSizeY*self.patchSizeX*inputShape[2])
                 self.l1_mean = tf.reduce_mean(tf.abs(self.V1_A))
@@ -133,13 +163,18 @@ class ISTA(base):
 
         self.h_normVals = tf.histogram_summary('normVals', self.normVals, name="normVals")
 
-    def encodieImage(self, feedDict):
+    def encodeImage(self, feedDict):
         #Reinitialize v1
         self.sess.run(self.initV1)
 
         for i in range(self.displayPeriod):
             #Run optimizer
-            self.sess.run(self.optimizerA, feed_dict=feedDict)
+            if(self.activeSetPeriod and i%self.activeSetPeriod != 0 and useActive):
+                self.sess.run(self.activeOptimizerA, feed_dict=feedDict)
+            else:
+                self.sess.run(self.optimizerA, feed_dict=feedDict)
+                if(self.activeSetPeriod):
+                    useActive = self.sess.run(self.updateWs) <= self.activeSetMaxFraction
             self.timestep+=1
             if((i+1)%self.writeStep == 0):
                 summary = self.sess.run(self.mergedSummary, feed_dict=feedDict)
@@ -150,7 +185,7 @@ class ISTA(base):
     #Trains model for numSteps
     def trainA(self, save):
         #Define session
-        feedDict = {self.inputImage: self.currImg}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg})
         self.encodeImage(feedDict)
 
         if(save):
@@ -162,7 +197,7 @@ class ISTA(base):
         self.sess.run(self.normalize_W)
 
     def trainW(self):
-        feedDict = {self.inputImage: self.currImg}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg})
 
         #Visualization
         if (self.plotTimestep % self.plotPeriod == 0):
@@ -176,45 +211,60 @@ class ISTA(base):
         #Update weights
         self.sess.run(self.optimizerW, feed_dict=feedDict)
         #New image
-        self.currImg = self.dataObj.getData(self.batchSize)
+        self.currImg = self.nextBatch()
         self.plotTimestep += 1
 
 
     #Finds sparse encoding of inData
     #inData must be in the shape of the image
     #[batch, nY, nX, nF]
-    def evalData(self, inData):
+    def evalData(self, inData, returnSparse=False):
         (nb, ny, nx, nf) = inData.shape
-        #Check size
-        assert(nb == self.batchSize)
+        #Check size, smaller batches (e.g. the last batch of evalSet) are padded below
+        assert(nb <= self.batchSize)
         assert(ny == self.inputShape[0])
         assert(nx == self.inputShape[1])
         assert(nf == self.inputShape[2])
+        #The graph batch size is fixed, so blank images fill the rest of the batch and their codes are dropped
+        inData = pad_batch(inData, self.batchSize)
+        #Padded rows are held at zero so they don't change the real rows' codes
+        self.setValidRows(nb)
 
         feedDict = {self.inputImage: inData}
 
         self.encodeImage(feedDict)
+        self.setValidRows(self.batchSize)
 
+        if(returnSparse):
+            #Only the nonzeros of thresholded v1 are fetched, as a [batch, ny*nx*nf] csr matrix
+            (rowCounts, indices, values) = self.sess.run([self.V1_A_rowCounts, self.V1_A_indices, self.V1_A_values])
+            return sparse_fetch_to_csr(rowCounts, indices, values, int(np.prod(self.VShape[1:])))[:nb]
         #Get thresholded v1 as an output
         outVals = self.V1_A.eval(session=self.sess)
-        return outVals
+        return outVals[:nb]
 
-    def evalSet(self, evalDataObj, outFilename):
-        numImages = evalDataObj.numImages
+    #Frame times are image indices, starting at timeOffset
+    def evalSet(self, evalDataObj, outFilename, timeOffset=0):
+        #Number of images in the (possibly rangeIdx limited) list
+        numImages = evalDataObj.numData
         #skip must be 1 for now
         assert(evalDataObj.skip == 1)
+        #Batches are read here, so no stage thread may be reading the data object
+        self.stopStage()
         numIterations = int(np.ceil(float(numImages)/self.batchSize))
 
         pvFile = pvpOpen(outFilename, 'w')
         for it in range(numIterations):
             print(str((float(it)*100)/numIterations) + "% done (" + str(it) + " out of " + str(numIterations) + ")")
             #Evaluate
-            npV1_A = self.evalData(self.currImg)
-            v1Sparse = convertToSparse4d(npV1_A)
-            time = range(it*self.batchSize, (it+1)*self.batchSize)
+            #Only the remaining images of the last batch are encoded, evalData holds the padded rows at zero
+            numValid = min(self.batchSize, numImages - it*self.batchSize)
+            v1Sparse = self.evalData(self.currImg[:numValid], returnSparse=True)
+            time = range(timeOffset + it*self.batchSize, timeOffset + it*self.batchSize + numValid)
             data = {"values":v1Sparse, "time":time}
             pvFile.write(data, shape=(self.VShape[1], self.VShape[2], self.VShape[3]))
-            self.currImg = self.dataObj.getData(self.batchSize)
+            if(it+1 < numIterations):
+                self.currImg = self.dataObj.getData(self.batchSize)
         pvFile.close()
 
     def writePvpWeights(self, outputPrefix, rect=False):
@@ -7,6 +7,7 @@ from plots.plotRecon import plotRecon
 from .utils import *
 #Using pvp files for saving
 from pvtools import *
+from .code_writer import pvpCodeWriter
 
 class LCA(base):
     #Sets dictionary of params to member variables
@@ -20,10 +21,21 @@ class LCA(base):
         self.VStrideX = params['VStrideX']
         self.patchSizeY = params['patchSizeY']
         self.patchSizeX = params['patchSizeX']
+        #Runs the LCA steps between summaries in a single in-graph loop
+        self.fusedEncode = params.get('fusedEncode', False)
+        #Restricts all but every activeSetPeriod-th step to a working set of coefficients, 0 disables
+        self.activeSetPeriod = params.get('activeSetPeriod', 0)
+        #Active steps are only used while the working set is at most this fraction of the coefficients,
+        #since past that the gathers and scatters cost more than the dense convolutions
+        self.activeSetMaxFraction = params.get('activeSetMaxFraction', .05)
+        #Working set keeps coefficients with U above activeSetMargin*thresh
+        self.activeSetMargin = params.get('activeSetMargin', .5)
 
     def runModel(self):
         #Normalize weights to start
         self.normWeights()
+        #Load the next batch in the background while the first is encoded
+        self.startStage()
 
         #Training
         for i in range(self.numIterations):
@@ -38,7 +50,7 @@ class LCA(base):
     #Constructor takes inputShape, which is a 3 tuple (ny, nx, nf) based on the size of the image being fed in
     def __init__(self, params, dataObj):
         super(LCA, self).__init__(params, dataObj)
-        self.currImg = self.dataObj.getData(self.batchSize)
+        self.currImg = self.firstBatch()
 
     #Builds the model. inMatFilename should be the vgg file
     def buildModel(self, inputShape):
@@ -54,7 +66,7 @@ class LCA(base):
         with tf.device(self.device):
             with tf.name_scope("inputOps"):
                 #Get convolution variables as placeholders
-                self.inputImage = node_variable(self.imageShape, "inputImage")
+                self.inputImage = self.stagedInput(self.imageShape, "inputImage")
                 #Scale inputImage
                 self.scaled_inputImage = self.inputImage/np.sqrt(self.patchSizeX*self.patchSizeY*inputShape[2])
 
@@ -68,6 +80,8 @@ class LCA(base):
             with tf.name_scope("LCA"):
                 self.V1_U = uniform_weight_variable(self.VShape, "V1_U", 0.0, 1.25*self.thresh)
                 self.V1_A = weight_variable(self.VShape, "V1_A", 1e-3)
+                #Per batch state, sized by batchSize
+                self.batchStateVars = [self.V1_U, self.V1_A]
 
             with tf.name_scope("Recon"):
                 assert(self.VStrideY >= 1)
@@ -101,8 +115,50 @@ class LCA(base):
                             self.V1_W
                         ])
 
+            with tf.name_scope("FusedOpt"):
+                #Same update as optimizerA0 followed by optimizerA, but looped numFusedSteps times in graph
+                self.numFusedSteps = tf.placeholder(tf.int32, shape=[], name="numFusedSteps")
+                def fusedCond(i, u, a):
+                    return i < self.numFusedSteps
+                def fusedBody(i, u, a):
+                    a = tf.nn.relu(u - self.thresh)
+                    fusedRecon = conv2d_oneToMany(a, self.V1_W, self.imageShape, "fusedRecon", self.VStrideY, self.VStrideX)
+                    fusedReconError = tf.reduce_mean(tf.reduce_sum(tf.square(self.scaled_inputImage - fusedRecon), reduction_indices=[1, 2, 3]))
+                    fusedGrad = tf.gradients(fusedReconError, [a])[0]
+                    u = u + self.learningRateA * (-fusedGrad + a - u)
+                    return (i+1, u, a)
+                (_, fusedU, fusedA) = tf.while_loop(fusedCond, fusedBody,
+                        [tf.constant(0), tf.identity(self.V1_U), tf.identity(self.V1_A)])
+                #V1_A is left as the activity the last U update was computed from, same as the stepped loop
+                self.fusedOptimizerA = tf.group(self.V1_U.assign(fusedU), self.V1_A.assign(fusedA))
+
+            if(self.activeSetPeriod):
+                with tf.name_scope("ActiveOpt"):
+                    #Working set of coefficients, refreshed by a dense step every activeSetPeriod steps
+                    self.V1_ws = tf.Variable(tf.ones(self.VShape), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="V1_ws")
+                    #Keeps coefficients whose U is close to threshold so they can still become active
+                    #Evaluates to the fraction of the real rows' coefficients in the working set
+                    self.updateWs = tf.reduce_sum(self.V1_ws.assign(tf.cast(self.V1_U > self.activeSetMargin*self.thresh, tf.float32)) * self.rowMask4d)/(tf.reduce_sum(self.rowMask)*np.prod(self.VShape[1:]))
+                    wsIdx = tf.where(tf.not_equal(self.V1_ws, 0))
+                    #Atom element indices of the working set, built once for both the recon and its adjoint
+                    wsAtomIdx = active_atom_indices(wsIdx, self.WShape, self.imageShape, self.VStrideY, self.VStrideX)
+                    #Same update as optimizerA0 followed by optimizerA, restricted to the working set
+                    #A is zero outside the working set, and U is left as is there
+                    wsU = tf.gather_nd(self.V1_U, wsIdx)
+                    wsA = tf.nn.relu(wsU - self.thresh)
+                    activeRecon = active_conv2d_oneToMany(wsIdx, wsAtomIdx, wsA, self.V1_W, self.imageShape)
+                    activeError = self.scaled_inputImage - activeRecon
+                    #Gradient of reconError wrt A
+                    wsGrad = -(2.0/self.batchSize) * active_conv2d(wsIdx, wsAtomIdx, activeError, self.V1_W)
+                    newWsU = wsU + self.learningRateA * (-wsGrad + wsA - wsU)
+                    self.activeOptimizerA = tf.group(
+                        self.V1_A.assign(tf.scatter_nd(wsIdx, wsA, self.VShape)),
+                        tf.scatter_nd_update(self.V1_U, wsIdx, newWsU))
+
             with tf.name_scope("stats"):
                 self.nnz = tf.reduce_mean(tf.cast(tf.not_equal(self.V1_A, 0), tf.float32))
+                #Nonzeros of V1_A, fetched by evalData instead of the dense array
+                (self.V1_A_rowCounts, self.V1_A_indices, self.V1_A_values) = sparse_fetch_ops(self.V1_A)
 
                 self.errorStd = tf.sqrt(tf.reduce_mean(tf.square(self.error-tf.reduce_mean(self.error))))*np.sqrt(self.patchSizeY*self.patchSizeX*inputShape[2])
                 self.l1_mean = tf.reduce_mean(tf.abs(self.V1_A))
@@ -112,6 +168,9 @@ class LCA(base):
                 #For log of activities
                 self.log_V1_A = tf.log(tf.abs(self.V1_A)+1e-15)
 
+            if(self.stopTol is not None):
+                self.buildStopCheck()
+
         #Summaries
         self.s_loss = tf.scalar_summary('loss', self.loss, name="lossSum")
         self.s_recon = tf.scalar_summary('recon error', self.reconError, name="reconError")
@@ -131,23 +190,66 @@ class LCA(base):
         self.h_normVals = tf.histogram_summary('normVals', self.normVals, name="normVals")
 
     def encodeImage(self, feedDict):
+        if(self.stopTol is not None):
+            self.resetConverged()
+        if(self.fusedEncode):
+            #The in graph loop is always dense
+            assert(not self.activeSetPeriod)
+            self.fusedEncodeImage(feedDict)
+            return
+        numSteps = self.displayPeriod
         for i in range(self.displayPeriod):
             #Run optimizer
-            #This calculates A
-            self.sess.run(self.optimizerA0, feed_dict=feedDict)
-            #This updates U based on loss function wrt A
-            self.sess.run(self.optimizerA, feed_dict=feedDict)
+            if(self.activeSetPeriod and i%self.activeSetPeriod != 0 and useActive):
+                self.sess.run(self.activeOptimizerA, feed_dict=feedDict)
+            else:
+                #This calculates A
+                self.sess.run(self.optimizerA0, feed_dict=feedDict)
+                #This updates U based on loss function wrt A
+                self.sess.run(self.optimizerA, feed_dict=feedDict)
+                if(self.activeSetPeriod):
+                    useActive = self.sess.run(self.updateWs) <= self.activeSetMaxFraction
             self.timestep+=1
             if((i+1)%self.writeStep == 0):
                 summary = self.sess.run(self.mergedSummary, feed_dict=feedDict)
                 self.train_writer.add_summary(summary, self.timestep)
             if((i+1)%self.progress == 0):
                 print("Timestep ", self.timestep)
+            if(self.stopTol is not None and (i+1)%self.stopPeriod == 0):
+                if(self.checkConverged(feedDict)):
+                    numSteps = i+1
+                    break
+        if(self.stopTol is not None):
+            self.reportEncodeSteps(numSteps)
+
+    #Runs displayPeriod LCA steps, one session call per writeStep (or stopPeriod if stopping early)
+    def fusedEncodeImage(self, feedDict):
+        fusedFeedDict = dict(feedDict)
+        i = 0
+        while(i < self.displayPeriod):
+            #Only break out of the graph loop at summary and convergence check boundaries
+            numSteps = min(self.writeStep - (i % self.writeStep), self.displayPeriod - i)
+            if(self.stopTol is not None):
+                numSteps = min(numSteps, self.stopPeriod - (i % self.stopPeriod))
+            fusedFeedDict[self.numFusedSteps] = numSteps
+            self.sess.run(self.fusedOptimizerA, feed_dict=fusedFeedDict)
+            self.timestep += numSteps
+            if((i+numSteps)%self.writeStep == 0):
+                summary = self.sess.run(self.mergedSummary, feed_dict=feedDict)
+                self.train_writer.add_summary(summary, self.timestep)
+            if((i+numSteps)//self.progress > i//self.progress):
+                print("Timestep ", self.timestep)
+            i += numSteps
+            if(self.stopTol is not None and i%self.stopPeriod == 0):
+                if(self.checkConverged(feedDict)):
+                    break
+        if(self.stopTol is not None):
+            self.reportEncodeSteps(i)
 
     #Trains model for numSteps
     def trainA(self, save):
         #Define session
-        feedDict = {self.inputImage: self.currImg}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg})
         self.encodeImage(feedDict)
 
         if(save):
@@ -159,7 +261,7 @@ class LCA(base):
         self.sess.run(self.normalize_W)
 
     def trainW(self):
-        feedDict = {self.inputImage: self.currImg}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg})
 
         #Visualization
         if (self.plotTimestep % self.plotPeriod == 0):
@@ -173,44 +275,59 @@ class LCA(base):
         #Update weights
         self.sess.run(self.optimizerW, feed_dict=feedDict)
         #New image
-        self.currImg = self.dataObj.getData(self.batchSize)
+        self.currImg = self.nextBatch()
         self.plotTimestep += 1
 
 
     #Finds sparse encoding of inData
     #inData must be in the shape of the image
     #[batch, nY, nX, nF]
-    def evalData(self, inData):
+    def evalData(self, inData, returnSparse=False):
         (nb, ny, nx, nf) = inData.shape
-        #Check size
-        assert(nb == self.batchSize)
+        #Check size, smaller batches (e.g. the last batch of evalSet) are padded below
+        assert(nb <= self.batchSize)
         assert(ny == self.inputShape[0])
         assert(nx == self.inputShape[1])
         assert(nf == self.inputShape[2])
+        #The graph batch size is fixed, so blank images fill the rest of the batch and their codes are dropped
+        inData = pad_batch(inData, self.batchSize)
+        #Padded rows are held at zero so they don't change the real rows' codes
+        self.setValidRows(nb)
 
         feedDict = {self.inputImage: inData}
         self.encodeImage(feedDict)
+        self.setValidRows(self.batchSize)
+        if(returnSparse):
+            #Only the nonzeros of thresholded v1 are fetched, as a [batch, ny*nx*nf] csr matrix
+            (rowCounts, indices, values) = self.sess.run([self.V1_A_rowCounts, self.V1_A_indices, self.V1_A_values])
+            return sparse_fetch_to_csr(rowCounts, indices, values, int(np.prod(self.VShape[1:])))[:nb]
         #Get thresholded v1 as an output
         outVals = self.V1_A.eval(session=self.sess)
-        return outVals
+        return outVals[:nb]
 
-    def evalSet(self, evalDataObj, outFilename):
-        numImages = evalDataObj.numImages
+    #Frame times are image indices, starting at timeOffset
+    def evalSet(self, evalDataObj, outFilename, timeOffset=0):
+        #Number of images in the (possibly rangeIdx limited) list
+        numImages = evalDataObj.numData
         #skip must be 1 for now
         assert(evalDataObj.skip == 1)
+        #Batches are read here, so no stage thread may be reading the data object
+        self.stopStage()
         numIterations = int(np.ceil(float(numImages)/self.batchSize))
 
-        pvFile = pvpOpen(outFilename, 'w')
+        #Sparse conversion and file writes happen on a background thread
+        codeWriter = pvpCodeWriter(outFilename, (self.VShape[1], self.VShape[2], self.VShape[3]))
         for it in range(numIterations):
             print(str((float(it)*100)/numIterations) + "% done (" + str(it) + " out of " + str(numIterations) + ")")
             #Evaluate
-            npV1_A = self.evalData(self.currImg)
-            v1Sparse = convertToSparse4d(npV1_A)
-            time = range(it*self.batchSize, (it+1)*self.batchSize)
-            data = {"values":v1Sparse, "time":time}
-            pvFile.write(data, shape=(self.VShape[1], self.VShape[2], self.VShape[3]))
-            self.currImg = self.dataObj.getData(self.batchSize)
-        pvFile.close()
+            #Only the remaining images of the last batch are encoded, evalData holds the padded rows at zero
+            numValid = min(self.batchSize, numImages - it*self.batchSize)
+            v1Sparse = self.evalData(self.currImg[:numValid], returnSparse=True)
+            time = range(timeOffset + it*self.batchSize, timeOffset + it*self.batchSize + numValid)
+            codeWriter.write(v1Sparse, time)
+            if(it+1 < numIterations):
+                self.currImg = self.dataObj.getData(self.batchSize)
+        codeWriter.close()
 
     def writePvpWeights(self, outputPrefix, rect=False):
         npw = self.sess.run(self.V1_W)
@@ -25,10 +25,16 @@ class LCA_ADAM(base):
         self.patchSizeX = params['patchSizeX']
         self.inputMult = params['inputMult']
         self.normalize = params['normalize']
+        #fc only: uses a cached Gram matrix W^T W and drive W^T x for the inner LCA steps
+        self.gramFc = params.get('gramFc', False)
+        #1-D dictionaries only: True/False forces FFT or direct convolution, None picks from kernel and signal length
+        self.fftConv = params.get('fftConv', None)
 
     def runModel(self):
         #Normalize weights to start
         self.normWeights()
+        #Load the next batch in the background while the first is encoded
+        self.startStage()
 
         #Training
         for i in range(self.numIterations):
@@ -45,8 +51,10 @@ class LCA_ADAM(base):
     #Constructor takes inputShape, which is a 3 tuple (ny, nx, nf) based on the size of the image being fed in
     def __init__(self, params, dataObj):
         super(LCA_ADAM, self).__init__(params, dataObj)
+        if(self.gramFc):
+            self.sess.run(self.updateGram)
         #TODO make mask optional
-        (self.currImg, self.currMask) = self.dataObj.getData(self.batchSize)
+        (self.currImg, self.currMask) = self.firstBatch()
 
     #Builds the model. inMatFilename should be the vgg file
     def buildModel(self, inputShape):
@@ -66,9 +74,9 @@ class LCA_ADAM(base):
         with tf.device(self.device):
             with tf.name_scope("inputOps"):
                 #Get convolution variables as placeholders
-                self.inputImage = node_variable(self.imageShape, "inputImage")
+                self.inputImage = self.stagedInput(self.imageShape, "inputImage")
                 defaultMask = tf.zeros(self.imageShape)
-                self.inputMask = tf.placeholder_with_default(defaultMask, self.imageShape)
+                self.inputMask = self.stagedInput(self.imageShape, "inputMask", default=defaultMask)
 
                 #Normalize image
                 if(self.normalize):
@@ -108,6 +116,8 @@ class LCA_ADAM(base):
                 self.V1_init = tf.random_uniform(self.VShape, 0, 1.25*self.thresh, dtype=tf.float32)
                 self.V1_U = uniform_weight_variable(self.VShape, "V1_U", 0.0, 1.25*self.thresh)
                 self.V1_A = weight_variable(self.VShape, "V1_A", 1e-3)
+                #Per batch state, sized by batchSize
+                self.batchStateVars = [self.V1_U, self.V1_A]
 
             with tf.name_scope("Recon"):
                 if(self.fc):
@@ -117,7 +127,14 @@ class LCA_ADAM(base):
                 else:
                     assert(self.VStrideY >= 1)
                     assert(self.VStrideX >= 1)
-                    self.recon = tf.nn.conv2d_transpose(self.V1_A, self.V1_W, self.imageShape, [1, self.VStrideY, self.VStrideX, 1], padding='SAME', name="recon")
+                    if(self.fftConv is None):
+                        self.fftConv = use_fft_conv1d(self.WShape, self.imageShape, self.VStrideX)
+                    if(self.fftConv):
+                        #Reconstruction and its gradients wrt A and W are done with FFTs
+                        print("Using FFT convolution for recon")
+                        self.recon = fft_conv1d_oneToMany(self.V1_A, self.V1_W, self.WShape, self.imageShape, self.VStrideX, "recon")
+                    else:
+                        self.recon = tf.nn.conv2d_transpose(self.V1_A, self.V1_W, self.imageShape, [1, self.VStrideY, self.VStrideX, 1], padding='SAME', name="recon")
 
                 #Unnormalize
                 self.unscaled_recon = self.recon/self.inputMult
@@ -153,26 +170,52 @@ class LCA_ADAM(base):
             with tf.name_scope("Opt"):
                 #Calculate A from U
                 self.optimizerA0 = self.V1_A.assign(tf.nn.relu(self.V1_U - self.thresh))
-                self.v1Reset = self.V1_U.assign(self.V1_init)
+                self.v1Reset = self.V1_U.assign(self.V1_init * self.rowMask4d)
 
                 self.optimizerA1 = tf.train.AdamOptimizer(self.learningRateA)
 
                 #Find gradient wrt A
-                self.lossGrad = self.optimizerA1.compute_gradients(self.reconError, [self.V1_A])
+                if(self.gramFc):
+                    assert(self.fc)
+                    #reconError sums over axis 1 and means over the rest, so its gradient is scaled by 2*ny/size
+                    gradScale = 2.0 * self.imageShape[1] / np.prod(self.imageShape)
+                    #Lateral inhibition matrix, only recomputed when the dictionary changes
+                    self.V1_G = tf.Variable(tf.zeros((self.numV, self.numV)), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="V1_G")
+                    self.updateGram = self.V1_G.assign(tf.matmul(self.V1_W, self.V1_W, transpose_a=True))
+                    #Drive W^T x, computed once per batch
+                    self.V1_drive = tf.Variable(tf.zeros(self.VShape), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="V1_drive")
+                    flat_input = tf.reshape(self.scaled_inputImage, [self.batchSize, -1])
+                    self.updateDrive = self.V1_drive.assign(tf.matmul(flat_input, self.V1_W))
+                    self.lossGrad = [(gradScale * (tf.matmul(self.V1_A, self.V1_G) - self.V1_drive), self.V1_A)]
+                else:
+                    self.lossGrad = self.optimizerA1.compute_gradients(self.reconError, [self.V1_A])
                 #self.checkGrad = tf.check_numerics(self.lossGrad[0][0], "grad error", name=None)
                 self.dU = [(self.lossGrad[0][0] - self.V1_A + self.V1_U, self.V1_U)];
 
                 #TODO add momentum or ADAM here
                 self.optimizerA = self.optimizerA1.apply_gradients(self.dU)
+                #Adam's moments for V1_U are batch sized as well
+                self.batchStateVars += [self.optimizerA1.get_slot(self.V1_U, n) for n in self.optimizerA1.get_slot_names()]
 
                 #self.optimizerW = tf.train.AdadeltaOptimizer(self.learningRateW, epsilon=1e-6).minimize(self.loss,
-                self.optimizerW = tf.train.AdamOptimizer(self.learningRateW, epsilon=1e-6).minimize(self.loss,
+                self.optimizerWObj = tf.train.AdamOptimizer(self.learningRateW, epsilon=1e-6)
+                self.optimizerW = self.optimizerWObj.minimize(self.loss,
                         var_list=[
                             self.V1_W
                         ])
 
+                #For data parallel training (see data_parallel.py), workers compute gradW with a dictionary
+                #loaded through setW, and the coordinator applies the averaged gradient with the same optimizer
+                self.gradW = tf.gradients(self.loss, [self.V1_W])[0]
+                self.inW = node_variable(self.WShape, "inW")
+                self.setW = self.V1_W.assign(self.inW)
+                self.inGradW = node_variable(self.WShape, "inGradW")
+                self.applyGradW = self.optimizerWObj.apply_gradients([(self.inGradW, self.V1_W)])
+
             with tf.name_scope("stats"):
                 self.nnz = tf.reduce_mean(tf.cast(tf.not_equal(self.V1_A, 0), tf.float32))
+                #Nonzeros of V1_A, fetched by evalData instead of the dense array
+                (self.V1_A_rowCounts, self.V1_A_indices, self.V1_A_values) = sparse_fetch_ops(self.V1_A)
 
                 self.imageStd = tf.sqrt(tf.reduce_mean(tf.square(self.scaled_inputImage - tf.reduce_mean(self.scaled_inputImage))))
                 self.errorStd = tf.sqrt(tf.reduce_mean(tf.square(self.error-tf.reduce_mean(self.error))))/self.imageStd
@@ -186,6 +229,9 @@ class LCA_ADAM(base):
                 #For log of activities
                 self.log_V1_A = tf.log(tf.abs(self.V1_A)+1e-13)
 
+            if(self.stopTol is not None):
+                self.buildStopCheck()
+
         #Summaries
         self.s_loss    = tf.summary.scalar('loss', self.loss)
         self.s_recon   = tf.summary.scalar('recon error', self.reconError)
@@ -208,6 +254,11 @@ class LCA_ADAM(base):
         progress_time = time.time()
         #Reset u
         self.sess.run(self.v1Reset)
+        if(self.gramFc):
+            self.sess.run(self.updateDrive, feed_dict=feedDict)
+        if(self.stopTol is not None):
+            self.resetConverged()
+        numSteps = self.displayPeriod
         for i in range(self.displayPeriod):
             #Run optimizer
             #This calculates A
@@ -226,12 +277,18 @@ class LCA_ADAM(base):
                 self.plotRecon()
             if(self.timestep%self.plotWeightPeriod == 0):
                 self.plotWeight()
+            if(self.stopTol is not None and (i+1)%self.stopPeriod == 0):
+                if(self.checkConverged(feedDict)):
+                    numSteps = i+1
+                    break
+        if(self.stopTol is not None):
+            self.reportEncodeSteps(numSteps)
         return self.sess.run(self.V1_A)
 
     #Trains model for numSteps
     def trainA(self, save):
         #Define session
-        feedDict = {self.inputImage: self.currImg, self.inputMask: self.currMask}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg, self.inputMask: self.currMask})
         self.encodeImage(feedDict)
 
         if(save):
@@ -241,6 +298,9 @@ class LCA_ADAM(base):
     def normWeights(self):
         #Normalize weights
         self.sess.run(self.normalize_W)
+        #Dictionary changed, so recompute the Gram matrix
+        if(self.gramFc):
+            self.sess.run(self.updateGram)
 
     def plotRecon(self):
         #Visualization
@@ -282,29 +342,60 @@ class LCA_ADAM(base):
             plot_weights(np_V1_W, plotStr)
 
     def trainW(self):
-        feedDict = {self.inputImage: self.currImg, self.inputMask: self.currMask}
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg, self.inputMask: self.currMask})
         #Update weights
         self.sess.run(self.optimizerW, feed_dict=feedDict)
         #New image
-        (self.currImg, self.currMask) = self.dataObj.getData(self.batchSize)
+        (self.currImg, self.currMask) = self.nextBatch()
+
+
+    #Encodes the current batch and returns the gradient of the loss wrt V1_W, instead of applying it
+    #like trainW. Used by data parallel workers
+    def computeGradW(self):
+        feedDict = self.inputFeedDict({self.inputImage: self.currImg, self.inputMask: self.currMask})
+        self.encodeImage(feedDict)
+        gradW = self.sess.run(self.gradW, feed_dict=feedDict)
+        #New image
+        (self.currImg, self.currMask) = self.nextBatch()
+        return gradW
+
+    #Replaces the dictionary, e.g. with the coordinator's dictionary in a data parallel worker
+    def loadW(self, npW):
+        self.sess.run(self.setW, feed_dict={self.inW: npW})
+        #Dictionary changed, so recompute the Gram matrix
+        if(self.gramFc):
+            self.sess.run(self.updateGram)
 
+    #Applies a dictionary gradient computed elsewhere (e.g. averaged over data parallel workers)
+    def trainWFromGrad(self, gradW):
+        self.sess.run(self.applyGradW, feed_dict={self.inGradW: gradW})
 
     #Finds sparse encoding of inData
     #inData must be in the shape of the image
     #[batch, nY, nX, nF]
-    def evalData(self, inData):
+    def evalData(self, inData, returnSparse=False):
         (nb, ny, nx, nf) = inData.shape
-        #Check size
-        assert(nb == self.batchSize)
+        #Check size, smaller batches (e.g. the last batch of evalSet) are padded below
+        assert(nb <= self.batchSize)
         assert(ny == self.imageShape[1])
         assert(nx == self.imageShape[2])
         assert(nf == self.imageShape[3])
+        #The graph batch size is fixed, so blank images fill the rest of the batch and their codes are dropped
+        inData = pad_batch(inData, self.batchSize)
+        #Padded rows are held at zero so they don't change the real rows' codes
+        self.setValidRows(nb)
 
-        feedDict = {self.inputImage: inData}
+        #Mask is fed explicitly so a staged training mask isn't picked up
+        feedDict = {self.inputImage: inData, self.inputMask: np.zeros(inData.shape)}
         self.encodeImage(feedDict)
+        self.setValidRows(self.batchSize)
+        if(returnSparse):
+            #Only the nonzeros of thresholded v1 are fetched, as a [batch, ny*nx*nf] csr matrix
+            (rowCounts, indices, values) = self.sess.run([self.V1_A_rowCounts, self.V1_A_indices, self.V1_A_values])
+            return sparse_fetch_to_csr(rowCounts, indices, values, int(np.prod(self.VShape[1:])))[:nb]
         #Get thresholded v1 as an output
         outVals = self.V1_A.eval(session=self.sess)
-        return outVals
+        return outVals[:nb]
 
     #def evalSet(self, evalDataObj, outFilename):
     #    numImages = evalDataObj.numImages
@@ -0,0 +1,81 @@
+import multiprocessing as mp
+import numpy as np
+import os
+import traceback
+from TFSparseCode.dataObj.pvp_reader import pvpReader
+from TFSparseCode.dataObj.utils import readList
+#Using pvp files for saving
+from pvtools import pvpOpen
+
+#Runs evalSet over disjoint shards of an image list, one encoder process (and tensorflow session)
+#per shard, then merges the shard code files in order into outFilename.
+#Each shard is a contiguous rangeIdx of the list, read in order, and writes its frames with the
+#global image index as the time, so the merged file matches a serial evalSet.
+
+#Processes are spawned, not forked, so each one gets a clean tensorflow runtime.
+#This should be called before any session is created in the calling process, and since spawned
+#processes import the calling script, its top level code must be under if __name__ == "__main__".
+
+#Encodes one shard in a worker process
+def eval_shard(solverCls, params, dataObjCls, dataArgs, dataKwargs, rangeIdx, shardFilename):
+    try:
+        dataObj = dataObjCls(*dataArgs, shuffle=False, rangeIdx=list(rangeIdx), **dataKwargs)
+        solver = solverCls(params, dataObj)
+        solver.evalSet(dataObj, shardFilename, timeOffset=int(rangeIdx[0]))
+        solver.closeSess()
+    except Exception:
+        traceback.print_exc()
+        raise
+
+#Appends every frame of the pvp files in inFilenames, in order, to outFilename
+def merge_pvp(inFilenames, outFilename, chunkFrames=1024):
+    outFile = pvpOpen(outFilename, 'w')
+    for fn in inFilenames:
+        reader = pvpReader(fn)
+        for start in range(0, reader.numFrames, chunkFrames):
+            frames = np.arange(start, min(start + chunkFrames, reader.numFrames))
+            data = {"values":reader.readSparse(frames), "time":reader.readTimes(frames)}
+            outFile.write(data, shape=reader.shape)
+    outFile.close()
+
+#solverCls is the model class (e.g. LCA), built with params in each worker
+#dataObjCls is built in each worker as dataObjCls(*dataArgs, shuffle=False, rangeIdx=shard, **dataKwargs)
+#Each worker's session gets threadsPerShard intra op threads (by default the cores split over shards)
+#listFilename is the list file the shards index into, dataArgs[0] by default. For pvpObj (and tfObj
+#with a sparse store) this is the gt list, dataArgs[1]
+def sharded_eval_set(solverCls, params, dataObjCls, dataArgs, outFilename, numShards, threadsPerShard=None, dataKwargs=None, listFilename=None):
+    if(dataKwargs is None):
+        dataKwargs = {}
+    if(threadsPerShard is None):
+        threadsPerShard = max(1, mp.cpu_count()//numShards)
+    if(listFilename is None):
+        listFilename = dataArgs[0]
+    #Only the list length is needed here, so no data object is built
+    numImages = len(readList(listFilename))
+    shards = [s for s in np.array_split(np.arange(numImages), numShards) if len(s) > 0]
+
+    ctx = mp.get_context('spawn')
+    shardFilenames = []
+    workers = []
+    for (k, rangeIdx) in enumerate(shards):
+        shardParams = dict(params)
+        #Separate run directories so shards don't share summaries and plots
+        shardParams['runDir'] = params['runDir'] + "shard" + str(k) + "/"
+        shardParams['intraOpThreads'] = threadsPerShard
+        shardParams['interOpThreads'] = 1
+        shardFilename = outFilename + ".shard" + str(k)
+        shardFilenames.append(shardFilename)
+        p = ctx.Process(target=eval_shard, args=(solverCls, shardParams, dataObjCls, dataArgs, dataKwargs, rangeIdx, shardFilename))
+        p.start()
+        workers.append(p)
+
+    for (k, p) in enumerate(workers):
+        p.join()
+        if(p.exitcode != 0):
+            print("Error: eval shard", k, "failed with exit code", p.exitcode)
+            assert(0)
+
+    print("Merging", len(shardFilenames), "shards into", outFilename)
+    merge_pvp(shardFilenames, outFilename)
+    for fn in shardFilenames:
+        os.remove(fn)
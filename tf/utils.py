@@ -14,6 +14,34 @@ def convertToSparse4d(m):
     mreshape = np.reshape(m, (nb, ny*nx*nf))
     return sparse.csr_matrix(mreshape)
 
+#Graph ops for fetching the nonzeros of V [batch, ...] instead of the dense tensor
+#Returns the number of nonzeros of each batch row, and the flat (within row) index and value
+#of each nonzero in row major order, which with the counts is the row's csr layout
+def sparse_fetch_ops(V):
+    nb = tf.shape(V)[0]
+    flatV = tf.reshape(V, [nb, -1])
+    nonzero = tf.not_equal(flatV, 0)
+    rowCounts = tf.reduce_sum(tf.cast(nonzero, tf.int32), reduction_indices=[1])
+    #tf.where returns coordinates in row major order
+    coords = tf.where(nonzero)
+    values = tf.gather_nd(flatV, coords)
+    indices = tf.cast(coords[:, 1], tf.int32)
+    return (rowCounts, indices, values)
+
+#Builds the [batch, rowSize] csr matrix from the fetched outputs of sparse_fetch_ops
+def sparse_fetch_to_csr(rowCounts, indices, values, rowSize):
+    indptr = np.concatenate(([0], np.cumsum(rowCounts)))
+    return sparse.csr_matrix((values, indices, indptr), shape=(len(rowCounts), rowSize))
+
+#Pads data [nb, ...] with zeros along the batch dimension up to batchSize
+def pad_batch(data, batchSize):
+    nb = data.shape[0]
+    if(nb == batchSize):
+        return data
+    outData = np.zeros((batchSize,) + data.shape[1:], dtype=data.dtype)
+    outData[:nb] = data
+    return outData
+
 def save_sparse_csr(filename,array):
     np.savez(filename,data = array.data ,indices=array.indices,
              indptr =array.indptr, shape=array.shape )
@@ -74,6 +102,100 @@ def conv2d(x, W, inName, stride = None):
 def conv2d_oneToMany(x, W, outShape, inName, yStride, xStride, padding='SAME'):
     return tf.nn.conv2d_transpose(x, W, outShape, [1, yStride, xStride, 1], padding=padding, name=inName)
 
+#Estimates the largest eigenvalue of D^T D, where D is the transposed convolution by W
+#(i.e., the reconstruction operator), with numIters steps of power iteration starting from v
+#Returns the new unit norm iterate and the eigenvalue estimate
+def conv_power_iteration(v, W, outShape, yStride, xStride, numIters):
+    def powerCond(i, v, eig):
+        return i < numIters
+    def powerBody(i, v, eig):
+        Dv = conv2d_oneToMany(v, W, outShape, "powerRecon", yStride, xStride)
+        DtDv = tf.gradients(tf.reduce_sum(tf.square(Dv))/2, [v])[0]
+        eig = tf.sqrt(tf.reduce_sum(tf.square(DtDv)))
+        return (i+1, DtDv/(eig+1e-12), eig)
+    v = v/(tf.sqrt(tf.reduce_sum(tf.square(v)))+1e-12)
+    (_, v, eig) = tf.while_loop(powerCond, powerBody, [tf.constant(0), v, tf.constant(0.0)])
+    return (v, eig)
+
+#Builds indices of every atom element for the coefficients at idx (an [n, 4] tensor of [b, y, x, k])
+#into an image of imageShape, matching the placement of conv2d_oneToMany with SAME padding
+#Returns [n, py, px, nf, 4] indices clipped into bounds, and a [n, py, px, nf] mask of which ones were in bounds
+#These are about 5 ints per atom element, so an active step only beats the dense convolutions while n is a
+#small fraction of the coefficients (see activeSetMaxFraction)
+def active_atom_indices(idx, WShape, imageShape, yStride, xStride):
+    (py, px, nf, numK) = WShape
+    (nb, ny, nx, nif) = imageShape
+    V_Y = int(np.ceil(float(ny)/yStride))
+    V_X = int(np.ceil(float(nx)/xStride))
+    padTop = max((V_Y-1)*yStride + py - ny, 0)//2
+    padLeft = max((V_X-1)*xStride + px - nx, 0)//2
+
+    (dy, dx, df) = np.meshgrid(range(py), range(px), range(nf), indexing='ij')
+    idx = tf.cast(idx, tf.int32)
+    b = idx[:, 0, None, None, None] + np.zeros((1, py, px, nf), dtype=np.int32)
+    y = idx[:, 1, None, None, None]*yStride - padTop + dy[None].astype(np.int32)
+    x = idx[:, 2, None, None, None]*xStride - padLeft + dx[None].astype(np.int32)
+    f = tf.zeros_like(b) + df[None].astype(np.int32)
+    valid = tf.logical_and(tf.logical_and(y >= 0, y < ny), tf.logical_and(x >= 0, x < nx))
+    y = tf.clip_by_value(y, 0, ny-1)
+    x = tf.clip_by_value(x, 0, nx-1)
+    return (tf.stack([b, y, x, f], axis=4), tf.cast(valid, tf.float32))
+
+#Same as conv2d_oneToMany, but only scatter-adds the atoms of the coefficients vals at idx
+#atomIdx is active_atom_indices of idx, shared with active_conv2d so the indices are only built once per step
+def active_conv2d_oneToMany(idx, atomIdx, vals, W, imageShape):
+    (atomIdx, valid) = atomIdx
+    atoms = tf.gather(tf.transpose(W, [3, 0, 1, 2]), idx[:, 3])
+    atoms = atoms * valid * vals[:, None, None, None]
+    return tf.scatter_nd(atomIdx, atoms, imageShape)
+
+#Adjoint of conv2d_oneToMany (i.e., strided conv2d of x with W), only evaluated at the coefficients at idx
+def active_conv2d(idx, atomIdx, x, W):
+    (atomIdx, valid) = atomIdx
+    patches = tf.gather_nd(x, atomIdx) * valid
+    atoms = tf.gather(tf.transpose(W, [3, 0, 1, 2]), idx[:, 3])
+    return tf.reduce_sum(patches * atoms, axis=[1, 2, 3])
+
+#FFT length for a 1-D transposed convolution of V_X*xStride upsampled coefficients with patchSizeX long atoms
+#Long enough that the circular convolution doesn't wrap
+def fft_conv1d_length(V_X, xStride, patchSizeX):
+    return int(2**np.ceil(np.log2(V_X*xStride + patchSizeX - 1)))
+
+#Picks FFT over direct convolution for 1-D dictionaries ([1, px, nf, numK] weights on [nb, 1, nx, nf] images)
+#Direct convolution costs about V_X*px multiplies per atom and channel, FFT about nFFT*log2(nFFT)
+#scaled by costFactor for the forward and inverse transforms
+def use_fft_conv1d(WShape, imageShape, xStride, costFactor=4):
+    (py, px, nf, numK) = WShape
+    (nb, ny, nx, nif) = imageShape
+    if(py != 1 or ny != 1):
+        return False
+    V_X = int(np.ceil(float(nx)/xStride))
+    nFFT = fft_conv1d_length(V_X, xStride, px)
+    return V_X*px > costFactor*nFFT*np.log2(nFFT)
+
+#Same as conv2d_oneToMany with SAME padding for 1-D dictionaries, computed in the frequency domain
+#x is [nb, 1, V_X, numK], W is [1, px, nf, numK]. Gradients wrt x and W go through the FFTs as well
+def fft_conv1d_oneToMany(x, W, WShape, outShape, xStride, inName):
+    (py, px, nf, numK) = WShape
+    (nb, ny, nx, nif) = outShape
+    assert(py == 1 and ny == 1)
+    V_X = int(np.ceil(float(nx)/xStride))
+    padLeft = max((V_X-1)*xStride + px - nx, 0)//2
+    nFFT = fft_conv1d_length(V_X, xStride, px)
+    with tf.name_scope(inName):
+        #Upsample coefficients by stride, [nb, numK, V_X*xStride]
+        up = tf.transpose(x[:, 0, :, :], [0, 2, 1])
+        if(xStride > 1):
+            up = tf.reshape(tf.stack([up] + [tf.zeros_like(up)]*(xStride-1), axis=3), [nb, numK, V_X*xStride])
+        #[freq, nb, numK]
+        up_f = tf.transpose(tf.spectral.rfft(up, fft_length=[nFFT]), [2, 0, 1])
+        #[freq, numK, nf]
+        W_f = tf.transpose(tf.spectral.rfft(tf.transpose(W[0, :, :, :], [1, 2, 0]), fft_length=[nFFT]), [2, 1, 0])
+        #Sum over atoms per frequency, [nb, nf, freq]
+        out_f = tf.transpose(tf.matmul(up_f, W_f), [1, 2, 0])
+        out = tf.spectral.irfft(out_f, fft_length=[nFFT])[:, :, padLeft:padLeft+nx]
+        return tf.reshape(tf.transpose(out, [0, 2, 1]), outShape)
+
 def maxpool_2x2(x, inName):
     return tf.nn.max_pool(x, ksize=[1, 2, 2, 1],
             strides=[1, 2, 2, 1], padding='SAME', name=inName)
@@ -82,85 +204,35 @@ def conv3d(x, w, inName):
     return tf.nn.conv3d(x, w, strides=[1, 1, 1, 1, 1], padding='SAME', name=inName)
 
 #Transposes data to permute strides to the output feature dimension
+#Output feature f + nf*kernelIdx holds input feature f, with
+#kernelIdx = (t%strideT)*strideY*strideX + (y%strideY)*strideX + (x%strideX)
+#Done with reshapes and transposes (like space_to_depth), so no index tensor is needed
 def transpose5dData(x, xShape, strideT, strideY, strideX):
     [nb, nt, ny, nx, nf] = xShape
-    print("Building output indices for conv3d")
-    #Build gather indices for output
-    #Must be in shape of target output data
-    dataIdxs = np.zeros((nb, nt/strideT, ny/strideY, nx/strideX, nf*strideT*strideY*strideX, 5)).astype(np.int32)
-    for iib in range(nb):
-        for iit in range(nt):
-            for iiy in range(ny):
-                for iix in range(nx):
-                    for iif in range(nf):
-                        #Calculate input indices given output indices
-                        oob = iib
-                        oot = iit/strideT
-                        ooy = iiy/strideY
-                        oox = iix/strideX
-                        kernelIdx = (iit%strideT)*strideY*strideX + (iiy%strideY)*strideX + (iix%strideX)
-                        oof = iif + nf*kernelIdx
-                        dataIdxs[oob, oot, ooy, oox, oof, :] = [iib, iit, iiy, iix, iif]
-    return tf.gather_nd(x, dataIdxs)
+    x = tf.reshape(x, [nb, nt//strideT, strideT, ny//strideY, strideY, nx//strideX, strideX, nf])
+    x = tf.transpose(x, [0, 1, 3, 5, 2, 4, 6, 7])
+    return tf.reshape(x, [nb, nt//strideT, ny//strideY, nx//strideX, strideT*strideY*strideX*nf])
 
 #Undo transepost5dData
 def undoTranspose5dData(x, xShape, strideT, strideY, strideX):
     #These shapes are in terms of the orig image
     [nb, nt, ny, nx, nf] = xShape
-    print("Building output indices for conv3d")
-    #Build gather indices for output
-    #Must be in shape of target output data
-    dataIdxs = np.zeros((nb, nt, ny, nx, nf, 5)).astype(np.int32)
-    for oob in range(nb):
-        for oot in range(nt):
-            for ooy in range(ny):
-                for oox in range(nx):
-                    for oof in range(nf):
-                        #Calculate input indices given output indices
-                        iib = oob
-                        iit = oot/strideT
-                        iiy = ooy/strideY
-                        iix = oox/strideX
-                        kernelIdx = (oot%strideT)*strideY*strideX + (ooy%strideY)*strideX + (oox%strideX)
-                        iif = oof + nf*kernelIdx
-                        dataIdxs[oob, oot, ooy, oox, oof, :] = [iib, iit, iiy, iix, iif]
-    return tf.gather_nd(x, dataIdxs)
+    x = tf.reshape(x, [nb, nt//strideT, ny//strideY, nx//strideX, strideT, strideY, strideX, nf])
+    x = tf.transpose(x, [0, 1, 4, 2, 5, 3, 6, 7])
+    return tf.reshape(x, [nb, nt, ny, nx, nf])
 
 #Transposes weight data for viewing
 def transpose5dWeight(w, wShape, strideT, strideY, strideX):
-    print("Building weight indices for conv3d")
     #These shapes are in terms of the already strided values
     [ntp, nyp, nxp, nifp, nofp] = wShape
-    #Translate to target output shape
-    ntp *= strideT
-    nyp *= strideY
-    nxp *= strideX
-    nofp = nofp/(strideT*strideX*strideY)
-
-    #Build gather indices for weights
-    #Must be in shape of target output weights
-    weightIdxs = np.zeros((ntp, nyp, nxp, nifp, nofp, 5)).astype(np.int32)
-    #Adding kernel number to end of features
-    for otp in range(ntp):
-        for oyp in range(nyp):
-            for oxp in range(nxp):
-                for oifp in range(nifp):
-                    for oofp in range(nofp):
-                        #Calculate output indices given input indices
-                        #Must reverse, as we're using conv2d as transpose conv2d
-                        #otp = int((ntp-itp-1)/strideT)
-                        #oyp = int((nyp-iyp-1)/strideY)
-                        #oxp = int((nxp-ixp-1)/strideX)
-                        #oifp = iifp #Input features stay the same
-                        itp = int((ntp - otp-1)/strideT)
-                        iyp = int((nyp - oyp-1)/strideY)
-                        ixp = int((nxp - oxp-1)/strideX)
-                        iifp=oifp
-                        #oofp uses iofp as offset, plus an nf stride based on which kernel it belongs to
-                        kernelIdx = (otp%strideT)*strideY*strideX + (oyp%strideY)*strideX + (oxp%strideX)
-                        iofp = oofp + nofp * kernelIdx
-                        weightIdxs[otp, oyp, oxp, oifp, oofp, :] = [itp, iyp, ixp, iifp, iofp]
-    return tf.gather_nd(w, weightIdxs)
+    nofp = nofp//(strideT*strideX*strideY)
+    #Split output features by kernel
+    w = tf.reshape(w, [ntp, nyp, nxp, nifp, strideT, strideY, strideX, nofp])
+    #Must reverse, as we're using conv2d as transpose conv2d
+    w = tf.reverse(w, [0, 1, 2])
+    #Interleave kernels into the patch dimensions
+    w = tf.transpose(w, [0, 4, 1, 5, 2, 6, 3, 7])
+    return tf.reshape(w, [ntp*strideT, nyp*strideY, nxp*strideX, nifp, nofp])
 
 def conv3d_oneToMany(x, xShape, w, wShape, strideT, strideY, strideX, inName):
     [ntp, nyp, nxp, nifp, nofp] = wShape
@@ -176,50 +248,18 @@ def conv3d_oneToMany(x, xShape, w, wShape, strideT, strideY, strideX, inName):
 
     assert(nifp == nf)
 
-    print("Building weight indices for conv3d")
-    #Build gather indices for weights
-    #Must be in shape of target output weights
-    weightIdxs = np.zeros((int(ntp/strideT), int(nyp/strideY), int(nxp/strideX), nifp, nofp*strideT*strideX*strideY, 5)).astype(np.int32)
-    #Adding kernel number to end of features
-    for itp in range(ntp):
-        for iyp in range(nyp):
-            for ixp in range(nxp):
-                for iifp in range(nifp):
-                    for iofp in range(nofp):
-                        #Calculate output indices given input indices
-                        #Must reverse, as we're using conv2d as transpose conv2d
-                        otp = int((ntp-itp-1)/strideT)
-                        oyp = int((nyp-iyp-1)/strideY)
-                        oxp = int((nxp-ixp-1)/strideX)
-                        oifp = iifp #Input features stay the same
-                        #oofp uses iofp as offset, plus an nf stride based on which kernel it belongs to
-                        kernelIdx = (itp%strideT)*strideY*strideX + (iyp%strideY)*strideX + (ixp%strideX)
-                        oofp = iofp + nofp * kernelIdx
-                        weightIdxs[otp, oyp, oxp, oifp, oofp, :] = [itp, iyp, ixp, iifp, iofp]
-
-
-    print("Building output indices for conv3d")
-    #Build gather indices for output
-    #Must be in shape of target output data
-    dataIdxs = np.zeros((nb, nt*strideT, ny*strideY, nx*strideX, nofp, 5)).astype(np.int32)
-    for oob in range(nb):
-        for oot in range(nt*strideT):
-            for ooy in range(ny*strideY):
-                for oox in range(nx*strideX):
-                    for oof in range(nofp):
-                        #Calculate input indices given output indices
-                        iib = oob
-                        iit = oot/strideT
-                        iiy = ooy/strideY
-                        iix = oox/strideX
-                        kernelIdx = (oot%strideT)*strideY*strideX + (ooy%strideY)*strideX + (oox%strideX)
-                        iif = oof + nofp*kernelIdx
-                        dataIdxs[oob, oot, ooy, oox, oof, :] = [iib, iit, iiy, iix, iif]
+    #Fold strides of the weights into the output feature dimension (inverse of transpose5dWeight)
+    #Output feature iofp + nofp*kernelIdx, with kernelIdx from the patch offset mod stride
+    w_reshape = tf.reshape(w, [ntp//strideT, strideT, nyp//strideY, strideY, nxp//strideX, strideX, nifp, nofp])
+    #Must reverse, as we're using conv2d as transpose conv2d
+    w_reshape = tf.reverse(w_reshape, [0, 2, 4])
+    w_reshape = tf.transpose(w_reshape, [0, 2, 4, 6, 1, 3, 5, 7])
+    w_reshape = tf.reshape(w_reshape, [ntp//strideT, nyp//strideY, nxp//strideX, nifp, nofp*strideT*strideY*strideX])
 
     #Build convolution structure
-    w_reshape = tf.gather_nd(w, weightIdxs)
     o_reshape = tf.nn.conv3d(x, w_reshape, strides=[1, 1, 1, 1, 1], padding='SAME', name=inName)
-    o = tf.gather_nd(o_reshape, dataIdxs)
+    #Unfold output features back into strided positions
+    o = undoTranspose5dData(o_reshape, [nb, nt*strideT, ny*strideY, nx*strideX, nofp], strideT, strideY, strideX)
     return o
 
 if __name__ == "__main__":